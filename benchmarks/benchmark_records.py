@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+SYNOPSIS
+
+    benchmark_records.py [-h] [-n NUM_FILES]
+
+DESCRIPTION
+
+    Measure the memory taken to keep the metadata of each file until the end
+    of a run, and the number of bytes pickled to send it between processes,
+    when the metadata is kept as a dictionary and as a
+    primavera_val.records.FileRecord.
+
+    The metadata is synthetic but like that of a real submission: a few
+    models, experiments and variables, many variants and a time range for
+    each file. Each dictionary is built with new strings and dates, as it
+    would be when unpickled in the parent process.
+"""
+from __future__ import print_function, division
+import argparse
+import gc
+import pickle
+import tracemalloc
+
+from iris.time import PartialDateTime
+
+from primavera_val.records import FileRecord
+
+
+def parse_args():
+    """
+    Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the memory used '
+                                                 'by the metadata of each '
+                                                 'file')
+    parser.add_argument('-n', '--num-files', type=int, default=100000,
+                        help='the number of files (default: %(default)s)')
+    return parser.parse_args()
+
+
+def make_metadata(index):
+    """
+    Create the metadata of a file as identified from its filename and
+    contents.
+    """
+    model = 'HadGEM3-GC31-{}'.format(['LM', 'MM', 'HM'][index % 3])
+    experiment = ['hist-1950', 'control-1950',
+                  'highres-future'][index // 3 % 3]
+    cmor_name = 'var{}'.format(index % 50)
+    variant = 'r{}i1p1f1'.format(index % 10 + 1)
+    year = 1950 + index % 100
+    return {
+        'basename': '{}_Amon_{}_{}_{}_gn_{}01-{}12.nc'.format(
+            cmor_name, model, experiment, variant, year, year),
+        'directory': '/gws/primavera/{}/{}/{}'.format(model, experiment,
+                                                       variant),
+        'cmor_name': cmor_name, 'table': ''.join(['A', 'mon']),
+        'climate_model': model, 'experiment': experiment,
+        'rip_code': variant, 'grid': ''.join(['g', 'n']),
+        'start_date': PartialDateTime(year=year, month=1),
+        'end_date': PartialDateTime(year=year, month=12),
+        'filesize': 1000000 + index, 'frequency': ''.join(['m', 'on']),
+        'var_name': cmor_name, 'units': ''.join(['K']),
+        'long_name': 'Variable {}'.format(index % 50),
+        'standard_name': 'standard_name_{}'.format(index % 50),
+        'time_units': ''.join(['days since 1950-01-01']),
+        'calendar': ''.join(['360_day']),
+        'activity_id': ''.join(['HighResMIP']),
+        'institute': ''.join(['MOHC']),
+    }
+
+
+def measure(num_files, convert):
+    """
+    Measure the memory retained by keeping `num_files` items made by
+    `convert` from the metadata of each file.
+
+    :returns: The number of bytes retained per file
+    """
+    gc.collect()
+    tracemalloc.start()
+    kept = [convert(make_metadata(index)) for index in range(num_files)]
+    gc.collect()
+    retained, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(kept) == num_files
+    return retained / num_files
+
+
+def main(args):
+    """
+    Run the benchmark
+    """
+    metadata = make_metadata(0)
+    print('{} files'.format(args.num_files))
+    print('{:<12}{:>16}{:>16}'.format('Type', 'Memory (bytes)',
+                                      'Pickled (bytes)'))
+    for name, convert in [('dict', dict), ('FileRecord', FileRecord)]:
+        per_file = measure(args.num_files, convert)
+        pickled = len(pickle.dumps(convert(metadata),
+                                   pickle.HIGHEST_PROTOCOL))
+        print('{:<12}{:>16.0f}{:>16}'.format(name, per_file, pickled))
+
+
+if __name__ == '__main__':
+    main(parse_args())
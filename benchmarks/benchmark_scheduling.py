@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+SYNOPSIS
+
+    benchmark_scheduling.py [-h] [-j JOBS] [-n NUM_FILES]
+                            [--huge-files HUGE_FILES] [--seconds SECONDS]
+                            [--seed SEED]
+
+DESCRIPTION
+
+    Compare the time taken to validate a skewed synthetic archive when the
+    files are handed to the workers in directory order and when the largest
+    files are handed out first.
+
+    The archive is made of sparse files, so it takes no disk space, with
+    sizes like a real submission: mostly small fx and monthly files, a few
+    larger daily files and one or two huge files that are each a
+    large part of the total work. Validating a file is simulated by sleeping
+    for a time proportional to its size, so the benchmark measures the
+    scheduling rather than the checks. The default archive has few enough
+    files that the fixed cost of handing each file to a worker is small
+    compared with the simulated work. Both the simulated makespan and the
+    measured wall-clock time through primavera_val.scheduling.run_files()
+    are reported, along with the ideal time: the total work divided by the
+    number of workers, or the time taken by the largest file if that is
+    longer.
+"""
+from __future__ import print_function, division
+import argparse
+import functools
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from primavera_val.scheduling import (estimate_makespan, file_cost,
+                                      order_longest_first, run_files)
+
+# The relative number and sizes in bytes of the kinds of file in the archive
+FILE_KINDS = [
+    (60, 20 * 1024, 200 * 1024),                  # fx
+    (30, 5 * 1024 ** 2, 50 * 1024 ** 2),          # monthly
+    (10, 500 * 1024 ** 2, 2 * 1024 ** 3),         # daily
+]
+
+# The fraction of the total work in each of the huge files added to the
+# archive, like a whole run of hourly model level data in a single file
+HUGE_FILE_FRACTION = 0.15
+
+
+def parse_args():
+    """
+    Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the scheduling '
+                                                 'of files across workers')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='the number of worker processes (default: '
+                             '%(default)s)')
+    parser.add_argument('-n', '--num-files', type=int, default=200,
+                        help='the number of files in the synthetic archive '
+                             '(default: %(default)s)')
+    parser.add_argument('--huge-files', type=int, default=2,
+                        choices=range(int(1. / HUGE_FILE_FRACTION)),
+                        metavar='HUGE_FILES',
+                        help='the number of those files that are each '
+                             '{:.0f}%% of the total work (default: '
+                             '%(default)s)'.format(100 * HUGE_FILE_FRACTION))
+    parser.add_argument('--seconds', type=float, default=8.,
+                        help='the total simulated work in seconds '
+                             '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the seed for the random file sizes '
+                             '(default: %(default)s)')
+    return parser.parse_args()
+
+
+def make_archive(directory, num_files, num_huge, rng):
+    """
+    Create sparse files with a skewed distribution of sizes, `num_huge` of
+    which are each HUGE_FILE_FRACTION of the total size.
+    """
+    weights = [kind[0] for kind in FILE_KINDS]
+    sizes = []
+    for _index in range(num_files - num_huge):
+        _weight, smallest, largest = rng.choices(FILE_KINDS, weights)[0]
+        sizes.append(rng.randint(smallest, largest))
+    huge_size = int(sum(sizes) * HUGE_FILE_FRACTION /
+                    (1. - num_huge * HUGE_FILE_FRACTION))
+    sizes.extend([huge_size] * num_huge)
+
+    filenames = []
+    for index, size in enumerate(sizes):
+        filename = os.path.join(directory, 'file_{:05}.nc'.format(index))
+        with open(filename, 'wb') as handle:
+            handle.truncate(size)
+        filenames.append(filename)
+    return filenames
+
+
+def simulate_validation(seconds_per_byte, filename):
+    """
+    Pretend to validate a file by sleeping for a time proportional to its
+    size.
+    """
+    time.sleep(file_cost(filename) * seconds_per_byte)
+    return filename
+
+
+def time_run(filenames, jobs, seconds_per_byte):
+    """
+    Time running the simulated validation of the files in the order given.
+    """
+    function = functools.partial(simulate_validation, seconds_per_byte)
+    start = time.time()
+    # give each file the same cost so that run_files() keeps the order
+    for _result in run_files(function, filenames, jobs,
+                             {filename: 0 for filename in filenames}):
+        pass
+    return time.time() - start
+
+
+def main(args):
+    """
+    Run the benchmark
+    """
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = make_archive(directory, args.num_files, args.huge_files,
+                                 rng)
+        costs = {filename: file_cost(filename) for filename in filenames}
+        seconds_per_byte = args.seconds / sum(costs.values())
+
+        # the order of os.listdir() is unrelated to the size of the files
+        directory_order = list(filenames)
+        rng.shuffle(directory_order)
+        longest_first = order_longest_first(filenames, costs)
+
+        ideal = max(args.seconds / args.jobs,
+                    max(costs.values()) * seconds_per_byte)
+        print('{} files, {:.1f} GB, {} workers'.format(
+            len(filenames), sum(costs.values()) / 1024 ** 3, args.jobs))
+        print('Largest file is {:.0%} of the total work'.format(
+            max(costs.values()) / sum(costs.values())))
+        print('Ideal time: {:.2f} s'.format(ideal))
+        print('{:<16}{:>14}{:>14}{:>10}'.format('Order', 'Simulated (s)',
+                                                'Measured (s)', 'vs ideal'))
+        for name, order in [('directory', directory_order),
+                            ('largest first', longest_first)]:
+            simulated = estimate_makespan(
+                [costs[filename] * seconds_per_byte for filename in order],
+                args.jobs)
+            measured = time_run(order, args.jobs, seconds_per_byte)
+            print('{:<16}{:>14.2f}{:>14.2f}{:>10.2f}'.format(
+                name, simulated, measured, measured / ideal))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -4,14 +4,25 @@
 """
 SYNOPSIS
 
-    validate_data.py [-h] [-f FILE_FORMAT] [-s] [-l LOG_LEVEL] directory
+    validate_data.py [-h] [-f FILE_FORMAT] [-s] [-c] [-l LOG_LEVEL]
+                     [--journal JOURNAL] [--resume] [--checks CHECKS]
+                     [--layout] [--layout-threshold NAME=VALUE]
+                     [--checksum] [--checksum-algorithms ALGORITHMS]
+                     [--manifest MANIFEST] [--dedupe] [-j JOBS]
+                     [--executor {serial,thread,process,dask}]
+                     [--scheduler-address ADDRESS] [--memory-budget MB]
+                     [--max-files-per-worker N] [--sample FRACTION|N]
+                     [--seed SEED] [--filesystem PATH[=JOBS[,MBPS]]]
+                     [--filesystem-jobs N] [--filesystem-bandwidth MBPS]
+                     [--progress] [--progress-interval SECONDS]
+                     [--serve SOCKET | --server SOCKET] [directory]
 
 DESCRIPTION
 
     A simple data validation test for PRIMAVERA stream 1 data files. The
-    following checks are performed on all files with a .nc suffix in the
-    directories below the top-level directory, or on the file specified if
-    using the -s option:
+    following checks are performed on all files with a .nc suffix and all
+    Zarr stores with a .zarr suffix in the directories below the top-level
+    directory, or on the file specified if using the -s option:
 
         1. filenames are correctly formatted
         2. that essential metadata items can be read from each file's contents
@@ -19,10 +30,16 @@ DESCRIPTION
         4. the data is contiguous
         5. that a random data point can be read from each file
 
+    After all of the files have been checked, the units, calendar, time
+    units, institute, standard name and activity id of the files in each
+    dataset are checked to be consistent.
+
 ARGUMENTS
 
     directory
-        the top-level directory of the files to check
+        the top-level directory of the files to check, or an
+        s3://bucket/prefix URL to check the netCDF files in object storage
+        (not required with --serve)
 
 OPTIONS
 
@@ -33,12 +50,132 @@ OPTIONS
         (CMIP5 or CMIP6) (default: CMIP6)
     -s, --single-file
         validate a single specified file rather than a directory
+    -c, --cell-measure
+        file is a cell measure
     -l LOG_LEVEL, --log-level LOG_LEVEL
         set logging level to one of debug, info, warn (the default), or error
+    --journal JOURNAL
+        record the outcome of each file in the specified journal file so that
+        an interrupted run can be resumed
+    --resume
+        skip the files already recorded in the journal and include their
+        outcomes in the final summary
+    --checks CHECKS
+        a comma separated list of the checks to run out of: filename,
+        contents, layout, times, contiguity, data and checksum (default: all
+        checks except layout and checksum). The
+        checks are run cheapest first and stop at the first failure, and the
+        file's contents are only loaded if a selected check needs them. The
+        filename check is always run as the other checks need the metadata in
+        the filename. The layout and checksum checks are only run when they
+        are selected here or with --layout, --checksum or --manifest
+    --layout
+        also check that the chunking and compression of each file's data
+        variable allow a map or a time series to be read from it without
+        reading too many chunks or decompressing too much data
+    --layout-threshold NAME=VALUE
+        change a threshold of the layout check, or disable it with a value of
+        none. Can be given more than once. The thresholds and their defaults
+        are: min_chunk_bytes (16384), max_chunk_bytes (536870912),
+        max_map_chunks (1000), max_map_amplification (100),
+        max_series_chunks (10000) and max_series_amplification (none)
+    --checksum
+        also calculate the checksums of each file that passes the other
+        checks, reading it once sequentially, and record them in the journal
+    --checksum-algorithms ALGORITHMS
+        a comma separated list of the checksum algorithms to use out of:
+        sha256, adler32 and md5 (default: sha256, or the algorithms in the
+        manifest). Implies --checksum
+    --manifest MANIFEST
+        check the size and checksums of each file against those in MANIFEST,
+        a file with a JSON object on each line with the filename, filesize
+        and any of sha256, adler32 and md5. Files that don't match or aren't
+        in the manifest fail validation, and files in the manifest that
+        aren't found are reported. Implies --checksum if the manifest has
+        any checksums
+    --dedupe
+        check only one of each set of identical cell measures or fixed
+        fields, as found from a fingerprint of the size and sampled contents
+        of each file confirmed by a hash of the whole file, and reuse its
+        outcome for the others. Each worker process keeps its own record of
+        the files that it has checked
+    -j JOBS, --jobs JOBS
+        the number of worker processes to validate the files in (default: 1,
+        or the number of CPUs with --serve, --executor or the --filesystem
+        options). The largest files are validated first so that the small
+        files fill the gaps at the end of the run. With auto, the run starts
+        with two workers and the number is changed while the throughput
+        improves, up to twice the number of CPUs. Use "-l info" to see the
+        number chosen and why
+    --executor {serial,thread,process,dask}
+        where to validate the files: in this process, in a pool of JOBS
+        threads, in a pool of JOBS worker processes or on the workers of a
+        Dask distributed cluster (default: serial, or process when JOBS is
+        more than one). A few more files than there are workers are
+        submitted at a time and the results are reported as each file
+        finishes. Threads only read one local netCDF file at a time, as the
+        netCDF and HDF5 libraries aren't thread-safe. The dask executor
+        needs dask.distributed to be installed
+    --scheduler-address ADDRESS
+        the address of the scheduler of an existing Dask cluster to validate
+        the files on with --executor dask, whose workers must be able to
+        import primavera_val and read the files. Without this a local
+        cluster of JOBS single-threaded worker processes is started
+    --memory-budget MB
+        the most resident memory in MB that each worker process may use.
+        A worker that is using more than this after a file is replaced by a
+        new worker. A file that needs more than this on its own is retried
+        once in a new worker while no other files are validated, and fails
+        validation if it needs more again, as does a file whose worker is
+        killed twice. Validates the files in worker processes, with one
+        worker unless -j is given. Can be used with --serve
+    --max-files-per-worker N
+        replace each worker process with a new one after it has validated N
+        files, which limits the growth of the caches of Iris, netCDF and
+        HDF5. Validates the files in worker processes, like --memory-budget
+    --sample FRACTION|N
+        only validate a random sample of the files, stratified by model,
+        experiment and table, and estimate the pass rate of all of the files
+        with a 95% confidence interval. Either a fraction, e.g. 0.01, or a
+        number of files
+    --seed SEED
+        the seed for the random sample so that it can be repeated
+    --filesystem PATH[=JOBS[,MBPS]]
+        treat the files below PATH as being on their own storage and
+        optionally limit the number of them validated at once and the MB per
+        second read from them. Can be given more than once. Files not below
+        any PATH are grouped by the device that they are on
+    --filesystem-jobs N
+        the maximum number of files on each storage to validate at once, for
+        storage without its own limit
+    --filesystem-bandwidth MBPS
+        the maximum MB per second to read from each storage, for storage
+        without its own limit. The bytes read from a file are estimated as
+        its header and a sample of its data, or its whole size when the
+        checksum check is run. When any of the --filesystem options are
+        given, the files on different storage are interleaved and -j
+        defaults to the number of CPUs
+    --progress
+        display the number of files validated, the files and MB per second,
+        the number of files that failed and the estimated time remaining,
+        which is estimated from the bytes left to validate. On a terminal
+        the progress is shown on a single line that is redrawn as the files
+        are validated, otherwise a line is written to stderr at the interval
+        set by --progress-interval, even while no files are finishing
+    --progress-interval SECONDS
+        the number of seconds between the lines of progress written when
+        stderr isn't a terminal (default: 60)
+    --serve SOCKET
+        run a validation server that keeps a pool of warm worker processes
+        and listens for files to validate on the specified Unix domain socket
+    --server SOCKET
+        send the files to the validation server listening on the specified
+        Unix domain socket rather than validating them in this process
 
 RETURNS
     0   if all files validated successfully
-    1   if any files failed validation
+    1   if any files failed validation or any datasets have inconsistent
+        metadata
 
     To get a message displayed showing if files passed validation use the
     "-l debug" option.
@@ -47,23 +184,44 @@ ENVIRONMENT VARIABLES
 
     The primavera-val directory must be in PYTHONPATH
 
+    The object store and credentials used for s3:// URLs are configured in
+    the usual way for the AWS SDK, for example with AWS_ENDPOINT_URL,
+    AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY
+
 DEPENDENCIES:
     Iris:
         http://scitools.org.uk/iris/ Tested under Iris 1.13 and Python 2.7 and with
         Python 3 and Iris 2.2
 """
 import argparse
+import functools
 import logging.config
+import multiprocessing
 import os
 import sys
 import warnings
 
-import iris
-
-from primavera_val import (identify_filename_metadata, load_cube, list_files,
-                           identify_contents_metadata, validate_file_contents,
-                           FileValidationError, identify_cell_measures_metadata,
-                           validate_cell_measures_contents)
+from primavera_val import (list_files, available_checks, select_checks,
+                           COST_WHOLE_FILE)
+from primavera_val.checksums import (CHECKSUM_ALGORITHMS, read_manifest,
+                                     validate_algorithms)
+from primavera_val.consistency import MetadataTable, consistency_metadata
+from primavera_val.executors import (EXECUTORS, available_executors,
+                                     make_executor)
+from primavera_val.journal import (ValidationJournal, read_journal, PASSED,
+                                   FAILED)
+from primavera_val.layout import DEFAULT_THRESHOLDS, validate_thresholds
+from primavera_val.object_store import absolute_path
+from primavera_val.progress import ProgressReporter, DEFAULT_INTERVAL
+from primavera_val.records import FileRecord
+from primavera_val.sampling import StratifiedSample
+from primavera_val.scheduling import (run_files, run_files_adaptive,
+                                      run_files_grouped, storage_group,
+                                      GroupLimits, file_cost)
+from primavera_val.server import (check_file, failed_result,
+                                  request_validation, serve,
+                                  ValidationServerError)
+from primavera_val.workers import WorkerLimits
 
 DEFAULT_LOG_LEVEL = logging.WARNING
 DEFAULT_LOG_FORMAT = '%(levelname)s: %(message)s'
@@ -80,8 +238,9 @@ def parse_args():
     """
     parser = argparse.ArgumentParser(description='Validate a directory of '
                                                  'PRIMAVERA data ')
-    parser.add_argument('directory', help='the top-level directory containing '
-                                          'the files to check')
+    parser.add_argument('directory', nargs='?', help='the top-level directory '
+                        'containing the files to check, or an '
+                        's3://bucket/prefix URL (not required with --serve)')
     parser.add_argument('-f', '--file-format', default='CMIP6',
                         help='the CMOR version of the input netCDF files '
                              'being submitted (CMIP5 or CMIP6) (default: '
@@ -94,8 +253,176 @@ def parse_args():
     parser.add_argument('-l', '--log-level', help='set logging level to one '
                                                   'of debug, info, warn (the '
                                                   'default), or error')
+    parser.add_argument('--journal', help='record the outcome of each file '
+                        'in the specified journal file so that an '
+                        'interrupted run can be resumed')
+    parser.add_argument('--resume', help='skip the files already recorded in '
+                        'the journal and include their outcomes in the final '
+                        'summary', action='store_true')
+    parser.add_argument('--checks', type=_check_names, help='a comma '
+                        'separated list of the checks to run, cheapest '
+                        'first, out of: {} (default: all checks except '
+                        'layout and checksum)'.format(
+                            ', '.join(available_checks())))
+    parser.add_argument('--layout', help='also check that the chunking and '
+                        'compression of each file allow maps and time series '
+                        'to be read efficiently', action='store_true')
+    parser.add_argument('--layout-threshold', metavar='NAME=VALUE',
+                        type=_threshold, action='append', help='change a '
+                        'threshold of the layout check, or disable it with '
+                        'none, out of: {}'.format(
+                            ', '.join(sorted(DEFAULT_THRESHOLDS))))
+    parser.add_argument('--checksum', help='also calculate the checksums '
+                        'of each file that passes the other checks',
+                        action='store_true')
+    parser.add_argument('--checksum-algorithms', metavar='ALGORITHMS',
+                        type=_check_names, help='a comma separated list of '
+                        'the checksum algorithms to use out of: {} (default: '
+                        'sha256, or the algorithms in the manifest)'.format(
+                            ', '.join(CHECKSUM_ALGORITHMS)))
+    parser.add_argument('--manifest', type=_manifest, help='check the size '
+                        'and checksums of each file against those in the '
+                        'specified manifest')
+    parser.add_argument('--dedupe', help='check only one of each set of '
+                        'identical cell measures or fixed fields and reuse '
+                        'its outcome for the others', action='store_true')
+    parser.add_argument('-j', '--jobs', type=_jobs, help='the number of '
+                        'worker processes to validate the files in, largest '
+                        'files first, or auto to choose the number from the '
+                        'measured throughput (default: 1, or the number of '
+                        'CPUs with --serve, --executor or the --filesystem '
+                        'options)')
+    parser.add_argument('--executor', choices=EXECUTORS, help='where to '
+                        'validate the files: in this process, in JOBS '
+                        'threads, in JOBS worker processes or on a Dask '
+                        'distributed cluster (default: serial, or process '
+                        'when JOBS is more than one)')
+    parser.add_argument('--scheduler-address', metavar='ADDRESS',
+                        help='the address of the scheduler of an existing '
+                        'Dask cluster to use with --executor dask (default: '
+                        'start a local cluster of JOBS workers)')
+    parser.add_argument('--memory-budget', metavar='MB', type=_positive_float,
+                        help='the most resident memory in MB that each '
+                        'worker process may use before it is replaced, and '
+                        'that a file may need before it fails validation')
+    parser.add_argument('--max-files-per-worker', metavar='N',
+                        type=_positive_int, help='replace each worker process '
+                        'with a new one after it has validated N files')
+    parser.add_argument('--sample', metavar='FRACTION|N', type=_sample_size,
+                        help='only validate a random sample of the files, '
+                        'stratified by model, experiment and table, and '
+                        'estimate the pass rate of all of the files. Either '
+                        'a fraction, e.g. 0.01, or a number of files')
+    parser.add_argument('--seed', type=int, help='the seed for the random '
+                        'sample so that it can be repeated')
+    parser.add_argument('--filesystem', metavar='PATH[=JOBS[,MBPS]]',
+                        type=_filesystem, action='append', help='treat the '
+                        'files below PATH as being on their own storage and '
+                        'optionally limit the number of them validated at '
+                        'once and the MB per second read from them. Can be '
+                        'given more than once')
+    parser.add_argument('--filesystem-jobs', metavar='N', type=_positive_int,
+                        help='the maximum number of files on each storage to '
+                        'validate at once, for storage without its own limit')
+    parser.add_argument('--filesystem-bandwidth', metavar='MBPS',
+                        type=_positive_float, help='the maximum MB per second '
+                        'to read from each storage, for storage without its '
+                        'own limit')
+    parser.add_argument('--progress', help='display the files validated, '
+                        'the throughput, the number of failures and the '
+                        'estimated time remaining', action='store_true')
+    parser.add_argument('--progress-interval', metavar='SECONDS',
+                        type=_positive_float, default=DEFAULT_INTERVAL,
+                        help='the number of seconds between the lines of '
+                        'progress written when stderr isn\'t a terminal '
+                        '(default: %(default)s)')
+    server_group = parser.add_mutually_exclusive_group()
+    server_group.add_argument('--serve', metavar='SOCKET', help='run a '
+                              'validation server that keeps a pool of warm '
+                              'worker processes and listens for files to '
+                              'validate on the specified Unix domain socket')
+    server_group.add_argument('--server', metavar='SOCKET', help='send the '
+                              'files to the validation server listening on '
+                              'the specified Unix domain socket rather than '
+                              'validating them in this process')
     args = parser.parse_args()
 
+    if not args.directory and not args.serve:
+        parser.error('the directory argument is required')
+    if args.jobs == 'auto' and (args.serve or args.server):
+        parser.error('--jobs auto cannot be used with --serve or --server')
+    if _storage_limited(args) and (args.serve or args.server or
+                                   args.jobs == 'auto'):
+        parser.error('the --filesystem options cannot be used with --serve, '
+                     '--server or --jobs auto')
+    if args.checks:
+        unknown = set(args.checks) - set(available_checks(args.cell_measure))
+        if unknown:
+            parser.error('unknown checks: {}'.format(', '.join(
+                sorted(unknown))))
+    if args.resume and not args.journal:
+        parser.error('--resume requires --journal')
+    if args.executor and (args.serve or args.server):
+        parser.error('--executor cannot be used with --serve or --server')
+    if args.executor and args.executor not in available_executors():
+        parser.error('the {} executor needs dask.distributed to be '
+                     'installed'.format(args.executor))
+    if args.scheduler_address and args.executor != 'dask':
+        parser.error('--scheduler-address requires --executor dask')
+    args.worker_limits = WorkerLimits(
+        int(args.memory_budget * 1024 ** 2) if args.memory_budget else None,
+        args.max_files_per_worker)
+    if any(args.worker_limits):
+        if args.executor and args.executor != 'process':
+            parser.error('--memory-budget and --max-files-per-worker can '
+                         'only be used with --executor process')
+        if args.server:
+            parser.error('--memory-budget and --max-files-per-worker cannot '
+                         'be used with --server, give them to --serve '
+                         'instead')
+    if args.progress and args.serve:
+        parser.error('--progress cannot be used with --serve')
+    if args.serve and (args.checksum or args.checksum_algorithms or
+                       args.manifest):
+        parser.error('the checksum options cannot be used with --serve')
+
+    if args.layout:
+        if args.cell_measure:
+            parser.error('--layout cannot be used with --cell-measure')
+        if args.checks is None:
+            args.checks = ['filename'] + [check.name
+                                          for check in select_checks()]
+        args.checks.append('layout')
+    options = {}
+    if args.layout_threshold:
+        if 'layout' not in (args.checks or []):
+            parser.error('--layout-threshold requires --layout')
+        thresholds = dict(args.layout_threshold)
+        try:
+            validate_thresholds(thresholds)
+        except ValueError as exc:
+            parser.error(exc.__str__())
+        options['layout'] = thresholds
+
+    algorithms = args.checksum_algorithms
+    if algorithms:
+        try:
+            validate_algorithms(algorithms)
+        except ValueError as exc:
+            parser.error(exc.__str__())
+    elif args.manifest:
+        algorithms = args.manifest.algorithms
+    if args.checksum or algorithms:
+        if args.checks is None:
+            args.checks = ['filename'] + [
+                check.name for check in select_checks(
+                    cell_measure=args.cell_measure)]
+        if 'checksum' not in args.checks:
+            args.checks.append('checksum')
+        if algorithms:
+            options['checksum'] = {'algorithms': algorithms}
+    args.options = options or None
+
     return args
 
 
@@ -103,17 +430,23 @@ def main(args):
     """
     Run the checks
     """
-    # the metadata found by the checks is used in the online PRIMAVERA
-    # validation but can be ignored in this simple check
-    _output = []
-
-    num_errors_found = 0
+    if args.serve:
+        try:
+            serve(args.serve, args.jobs, args.worker_limits)
+        except ValidationServerError as exc:
+            logger.error(exc.__str__())
+            sys.exit(1)
+        sys.exit(0)
 
     if args.single_file:
         data_files = [args.directory]
     else:
-        data_files = list_files(os.path.expandvars(
-            os.path.expanduser(args.directory)))
+        try:
+            data_files = list_files(os.path.expandvars(
+                os.path.expanduser(args.directory)))
+        except (IOError, OSError) as exc:
+            logger.error(exc.__str__())
+            sys.exit(1)
         if not data_files:
             msg = 'No data files found in directory: {}'.format(args.directory)
             logger.error(msg)
@@ -121,33 +454,431 @@ def main(args):
 
     logger.debug('%s files found.', len(data_files))
 
-    for filename in data_files:
-        try:
-            # run the four checks that the validate script runs
-            metadata = identify_filename_metadata(filename, args.file_format)
-            if not args.cell_measure:
-                cube = load_cube(filename)
-                metadata.update(identify_contents_metadata(cube, filename))
-                validate_file_contents(cube, metadata)
-            else:
-                cf = iris.fileformats.cf.CFReader(filename)
-                metadata.update(identify_cell_measures_metadata(cf, filename))
-                validate_cell_measures_contents(cf, metadata)
-
-        except FileValidationError as exc:
-            logger.warning('File failed validation:\n%s', exc.__str__())
-            num_errors_found += 1
-        else:
-            _output.append(metadata)
-
-    if num_errors_found:
-        logger.error('%s files failed validation', num_errors_found)
+    missing = []
+    if args.manifest and not args.single_file:
+        missing = args.manifest.missing(data_files)
+
+    sample = None
+    if args.sample:
+        sample = StratifiedSample(data_files, args.sample, args.file_format,
+                                  args.seed)
+        data_files = sample.files
+        logger.debug('%s files sampled from %s strata.', len(data_files),
+                     len(sample.population))
+
+    summary = _RunSummary(sample)
+    total_files = len(data_files)
+    replayed = []
+
+    if args.resume:
+        completed = read_journal(args.journal)
+        data_files, replayed = _replay_journal(data_files, completed)
+        for result in replayed:
+            if args.manifest:
+                result = _verify_manifest(args.manifest, result)
+            summary.add(result)
+
+    progress = None
+    costs = None
+    if args.progress:
+        # the sizes estimate the time remaining and are reused to order the
+        # files largest first
+        costs = {filename: file_cost(filename) for filename in data_files}
+        progress = ProgressReporter(
+            total_files, interval=args.progress_interval,
+            completed=len(replayed),
+            failed=sum(1 for result in replayed
+                       if result['status'] == FAILED),
+            total_bytes=sum(costs.values())
+        )
+        progress.start()
+
+    journal = None
+    if args.journal:
+        journal = ValidationJournal(args.journal, resume=args.resume)
+
+    executor = None
+    if args.executor or any(args.worker_limits):
+        workers = args.jobs
+        if workers == 'auto':
+            workers = 2 * multiprocessing.cpu_count()
+        elif not (workers or args.executor or _storage_limited(args)):
+            # the worker limits need a worker process, but just one
+            workers = 1
+        executor = make_executor(args.executor or 'process', workers,
+                                 args.scheduler_address, args.worker_limits,
+                                 failed_result)
+        logger.debug('Validating files with %s', executor)
+
+    if args.server:
+        results = request_validation(args.server, data_files,
+                                     args.file_format, args.cell_measure,
+                                     args.checks, args.options, args.dedupe)
+    elif _storage_limited(args):
+        prefixes = [prefix for prefix, _limits in args.filesystem or []]
+        results = run_files_grouped(
+            _check_file_function(args), data_files,
+            args.jobs or (executor.workers if executor else
+                          multiprocessing.cpu_count()),
+            {filename: storage_group(filename, prefixes)
+             for filename in data_files},
+            dict(args.filesystem or []),
+            _group_limits(args.filesystem_jobs, args.filesystem_bandwidth),
+            costs=costs, executor=executor,
+            whole_file=_reads_whole_file(args)
+        )
+    elif args.jobs == 'auto':
+        results = run_files_adaptive(_check_file_function(args), data_files,
+                                     costs=costs, executor=executor)
+    elif executor or (args.jobs and args.jobs > 1):
+        results = run_files(_check_file_function(args), data_files, args.jobs,
+                            costs=costs, executor=executor)
+    else:
+        results = (check_file(filename, args.file_format, args.cell_measure,
+                              args.checks, args.options, args.dedupe)
+                   for filename in data_files)
+
+    try:
+        for result in results:
+            if args.manifest:
+                result = _verify_manifest(args.manifest, result)
+            if progress:
+                progress.add(result)
+            summary.add(result)
+            if journal:
+                metadata = result.get('metadata')
+                journal.record(result['filename'], result['status'],
+                               result.get('message'),
+                               consistency_metadata(metadata)
+                               if metadata is not None else None,
+                               result.get('checksums'))
+    except ValidationServerError as exc:
+        logger.error(exc.__str__())
+        sys.exit(1)
+    finally:
+        if progress:
+            progress.finish()
+        if journal:
+            journal.close()
+        if executor:
+            executor.shutdown()
+            if getattr(executor, 'replaced', 0):
+                logger.info('%s worker processes were replaced',
+                            executor.replaced)
+
+    if sample:
+        _report_sample(sample)
+
+    inconsistencies = summary.metadata_table.inconsistencies()
+    for inconsistency in inconsistencies:
+        logger.warning('Dataset failed validation:\n%s',
+                       inconsistency.__str__())
+    num_inconsistent = len({inconsistency.dataset
+                            for inconsistency in inconsistencies})
+    for filename in missing:
+        logger.warning('File in manifest not found: %s', filename)
+
+    if summary.num_errors_found or num_inconsistent or missing:
+        if summary.num_errors_found:
+            logger.error('%s files failed validation',
+                         summary.num_errors_found)
+        if num_inconsistent:
+            logger.error('%s datasets have inconsistent metadata',
+                         num_inconsistent)
+        if missing:
+            logger.error('%s files in the manifest were not found',
+                         len(missing))
         sys.exit(1)
     else:
         logger.debug('All files successfully validated.')
         sys.exit(0)
 
 
+class _RunSummary(object):
+    """
+    The outcomes of all of the files checked in this run.
+    """
+    def __init__(self, sample=None):
+        """
+        :param primavera_val.sampling.StratifiedSample sample: The sample of
+            files being checked, if only a sample is being checked
+        """
+        # the metadata found by the checks is used in the online PRIMAVERA
+        # validation but can be ignored in this simple check. It's kept as
+        # FileRecords as there can be millions of files.
+        self.output = []
+        self.num_errors_found = 0
+        self.metadata_table = MetadataTable()
+        self.sample = sample
+
+    def add(self, result):
+        """
+        Include the outcome of checking a single file in the summary.
+
+        :param dict result: The outcome in the format returned by
+            primavera_val.server.check_file()
+        """
+        if result['status'] == FAILED:
+            logger.warning('File failed validation:\n%s',
+                           result.get('message', result['filename']))
+            self.num_errors_found += 1
+        elif 'metadata' in result:
+            metadata = FileRecord.from_dict(result['metadata'])
+            if 'duplicate_of' in metadata:
+                logger.debug('File %s has the same contents as %s',
+                             result['filename'], metadata['duplicate_of'])
+            self.output.append(metadata)
+            self.metadata_table.append(metadata, result['filename'])
+
+        if self.sample:
+            self.sample.record(result['filename'], result['status'] == PASSED,
+                               result.get('message'))
+
+
+def _replay_journal(data_files, completed):
+    """
+    Remove the files that have already been validated from the list of files
+    to check and return the outcomes recorded for them.
+
+    :param list data_files: The paths of all of the files to check
+    :param dict completed: The journal records from the previous run keyed by
+        the absolute path of each file
+    :returns: A tuple of the list of files still to check and a list of the
+        journal records of the files that have already been checked
+    """
+    remaining = []
+    replayed = []
+
+    for filename in data_files:
+        record = completed.get(absolute_path(filename))
+        if record is None:
+            remaining.append(filename)
+        else:
+            replayed.append(record)
+
+    logger.debug('%s files already validated, %s files remaining.',
+                 len(replayed), len(remaining))
+
+    return remaining, replayed
+
+
+def _verify_manifest(manifest, result):
+    """
+    Check that a file that passed validation matches its entry in the
+    manifest.
+
+    :param primavera_val.checksums.Manifest manifest: The manifest
+    :param dict result: The outcome in the format returned by
+        primavera_val.server.check_file()
+    :returns: The outcome, which has failed if the file doesn't match the
+        manifest
+    """
+    if result['status'] != PASSED:
+        return result
+    filesize = (result.get('metadata') or {}).get('filesize')
+    if filesize is None:
+        filesize = file_cost(result['filename'])
+    problems = manifest.verify(result['filename'], filesize,
+                               result.get('checksums'))
+    if not problems:
+        return result
+    return {'filename': result['filename'], 'status': FAILED,
+            'message': 'File {} does not match the manifest: {}'.format(
+                os.path.basename(result['filename']), '; '.join(problems))}
+
+
+def _report_sample(sample):
+    """
+    Log the estimated pass rate of the files in the groups that were sampled,
+    which is the whole archive unless there were fewer samples than groups,
+    and the most common reasons for the sampled files failing.
+
+    :param primavera_val.sampling.StratifiedSample sample: The sample of files
+        that has been validated
+    """
+    estimate = sample.pass_rate()
+    if estimate is None:
+        logger.warning('No sampled files were validated.')
+        return
+
+    rate, lower, upper = estimate
+    logger.warning('%s of %s sampled files passed validation.',
+                   sample.num_passed, sample.num_sampled)
+    population = sum(sample.population.values())
+    if sample.num_covered < population:
+        logger.warning('Only %s of the %s files are in the groups of files '
+                       'that were sampled. Sample more files to cover them '
+                       'all.', sample.num_covered, population)
+    logger.warning('Estimated pass rate of %s files: %.1f%% (95%% '
+                   'confidence interval %.1f%% to %.1f%%)',
+                   sample.num_covered, 100. * rate, 100. * lower,
+                   100. * upper)
+
+    failures = sample.common_failures()
+    if failures:
+        logger.warning('Most common failures:\n%s', '\n'.join(
+            '{:>8}  {}'.format(count, message)
+            for message, count in failures))
+
+
+def _check_file_function(args):
+    """
+    Create a picklable function that validates a single file with the
+    options selected on the command line.
+    """
+    return functools.partial(check_file, file_format=args.file_format,
+                             cell_measure=args.cell_measure,
+                             checks=args.checks, options=args.options,
+                             dedupe=args.dedupe)
+
+
+def _storage_limited(args):
+    """
+    Determine whether files should be scheduled across storage groups.
+    """
+    return bool(args.filesystem or args.filesystem_jobs or
+                args.filesystem_bandwidth)
+
+
+def _reads_whole_file(args):
+    """
+    Determine whether any of the checks selected read the whole of each
+    file.
+    """
+    return any(check.cost == COST_WHOLE_FILE
+               for check in select_checks(args.checks, args.cell_measure))
+
+
+def _group_limits(jobs, bandwidth):
+    """
+    Create the limits of a storage group from a number of files and a
+    bandwidth in MB per second, either of which may be None.
+    """
+    return GroupLimits(jobs, bandwidth * 1024 ** 2 if bandwidth else None)
+
+
+def _filesystem(value):
+    """
+    Convert the value of a --filesystem argument to a tuple of the path and
+    its GroupLimits, or None if no limits are given.
+    """
+    path, _sep, limits = value.partition('=')
+    if not path:
+        raise argparse.ArgumentTypeError('a path is required: {}'.format(
+            value))
+    if not limits:
+        return path, None
+    jobs, _sep, bandwidth = limits.partition(',')
+    try:
+        return path, _group_limits(_positive_int(jobs) if jobs else None,
+                                   _positive_float(bandwidth)
+                                   if bandwidth else None)
+    except argparse.ArgumentTypeError:
+        raise argparse.ArgumentTypeError(
+            'must be PATH, PATH=JOBS or PATH=JOBS,MBPS: {}'.format(value))
+
+
+def _positive_int(value):
+    """
+    Convert an argument to a positive integer.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            'must be a positive number: {}'.format(value))
+    return number
+
+
+def _positive_float(value):
+    """
+    Convert an argument to a positive number.
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        number = 0.
+    if number <= 0.:
+        raise argparse.ArgumentTypeError(
+            'must be a positive number: {}'.format(value))
+    return number
+
+
+def _jobs(value):
+    """
+    Convert the value of the --jobs argument to either a positive number of
+    worker processes or 'auto'.
+    """
+    if value == 'auto':
+        return value
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(
+            'must be a positive number or auto: {}'.format(value))
+    return jobs
+
+
+def _threshold(value):
+    """
+    Convert the value of a --layout-threshold argument to a tuple of the
+    name and the value of the threshold, which is None if it's disabled.
+    """
+    name, _sep, threshold = value.partition('=')
+    if threshold.lower() == 'none':
+        return name, None
+    try:
+        return name, float(threshold) if '.' in threshold else int(threshold)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'must be NAME=VALUE where VALUE is a number or none: {}'.format(
+                value))
+
+
+def _manifest(value):
+    """
+    Read the manifest given as the value of the --manifest argument.
+    """
+    try:
+        return read_manifest(value)
+    except (IOError, OSError, ValueError) as exc:
+        raise argparse.ArgumentTypeError(exc.__str__())
+
+
+def _check_names(value):
+    """
+    Convert the value of the --checks argument to a list of check names.
+    """
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+def _sample_size(value):
+    """
+    Convert the value of the --sample argument to either a fraction (float)
+    or a number (int) of files.
+    """
+    try:
+        if '.' in value:
+            size = float(value)
+            valid = 0. < size <= 1.
+        else:
+            size = int(value)
+            valid = size > 0
+    except ValueError:
+        valid = False
+
+    if not valid:
+        raise argparse.ArgumentTypeError(
+            'must be a fraction between 0 and 1 or a positive number of '
+            'files: {}'.format(value))
+
+    return size
+
+
 if __name__ == '__main__':
     cmd_args = parse_args()
 
@@ -184,7 +915,14 @@ if __name__ == '__main__':
                 'handlers': ['default'],
                 'level': log_level,
                 'propagate': True
-            }
+            },
+            # the S3 client logs every request and its credentials
+            'botocore': {
+                'level': max(log_level, logging.WARNING),
+            },
+            'urllib3': {
+                'level': max(log_level, logging.WARNING),
+            },
         }
     })
 
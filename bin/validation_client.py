@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+SYNOPSIS
+
+    validation_client.py [-h] [-f FILE_FORMAT] [-c] [--checks CHECKS]
+                         [-l LOG_LEVEL] socket file [file ...]
+
+DESCRIPTION
+
+    Send files to a validation server started with
+    "validate_data.py --serve SOCKET" and report the outcome of each file.
+    Only the Python standard library is imported so that the client starts
+    quickly, which makes it suitable for validating files one at a time from
+    an upload hook.
+
+ARGUMENTS
+
+    socket
+        the Unix domain socket that the validation server is listening on
+    file
+        the files to validate
+
+OPTIONS
+
+    -h, --help
+        display a usage message
+    -f, --file-format
+        the CMOR version of the input netCDF files to be validated
+        (CMIP5 or CMIP6) (default: CMIP6)
+    -c, --cell-measure
+        files are cell measures
+    --checks CHECKS
+        a comma separated list of the checks to run (default: all checks)
+    -l LOG_LEVEL, --log-level LOG_LEVEL
+        set logging level to one of debug, info, warn (the default), or error
+
+RETURNS
+    0   if all files validated successfully
+    1   if any files failed validation or the server was unable to
+        validate them
+    2   if the validation server could not process the request
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+
+DEFAULT_LOG_FORMAT = '%(levelname)s: %(message)s'
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    """
+    Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(description='Validate PRIMAVERA data '
+                                                 'files using a validation '
+                                                 'server')
+    parser.add_argument('socket', help='the Unix domain socket that the '
+                                       'validation server is listening on')
+    parser.add_argument('files', nargs='+', help='the files to validate')
+    parser.add_argument('-f', '--file-format', default='CMIP6',
+                        help='the CMOR version of the input netCDF files '
+                             'being submitted (CMIP5 or CMIP6) (default: '
+                             '%(default)s)')
+    parser.add_argument('-c', '--cell-measure', help='files are cell '
+                        'measures', action='store_true')
+    parser.add_argument('--checks', help='a comma separated list of the '
+                        'checks to run (default: all checks)')
+    parser.add_argument('-l', '--log-level', default='warning',
+                        choices=['debug', 'info', 'warn', 'warning', 'error'],
+                        help='set logging level to one of debug, info, warn '
+                             '(the default), or error')
+    return parser.parse_args()
+
+
+def main(args):
+    """
+    Send the files to the server and report the results
+    """
+    request = {'paths': [os.path.abspath(path) for path in args.files],
+               'file_format': args.file_format,
+               'cell_measure': args.cell_measure}
+    if args.checks:
+        request['checks'] = [name.strip() for name in args.checks.split(',')
+                             if name.strip()]
+
+    num_errors_found = 0
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(args.socket)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as responses:
+            for line in responses:
+                response = json.loads(line.decode('utf-8'))
+                if 'error' in response and 'filename' in response:
+                    logger.warning('Unable to validate %s: %s',
+                                   response['filename'], response['error'])
+                    num_errors_found += 1
+                    continue
+                if 'error' in response:
+                    logger.error(response['error'])
+                    sys.exit(2)
+                if response.get('done'):
+                    break
+                if response['status'] == 'failed':
+                    logger.warning('File failed validation:\n%s',
+                                   response['message'])
+                    num_errors_found += 1
+                else:
+                    logger.debug('File passed validation: %s',
+                                 response['filename'])
+            else:
+                logger.error('Connection to validation server closed before '
+                             'all files were validated')
+                sys.exit(2)
+    except (IOError, OSError) as exc:
+        logger.error('Unable to communicate with validation server at %s: '
+                     '%s', args.socket, exc)
+        sys.exit(2)
+    finally:
+        sock.close()
+
+    if num_errors_found:
+        logger.error('%s files failed validation', num_errors_found)
+        sys.exit(1)
+    else:
+        logger.debug('All files successfully validated.')
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    logging.basicConfig(
+        level=getattr(logging, cmd_args.log_level.upper()),
+        format=DEFAULT_LOG_FORMAT
+    )
+    main(cmd_args)
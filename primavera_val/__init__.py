@@ -10,17 +10,57 @@ Requires:
         Tested under Iris 1.10 as installed at JASMIN
 """
 from __future__ import unicode_literals, division, absolute_import
+from collections import namedtuple
+import contextlib
 import datetime
+import json
 import os
 import random
 import re
+import threading
 
 import iris
+import iris.fileformats.cf
 from iris.time import PartialDateTime
 
+from primavera_val.checksums import file_checksums
+from primavera_val.dedupe import CONTENT_CACHE, fingerprint
+from primavera_val.object_store import (NetCDFObject, is_netcdf4_file,
+                                        is_s3_url, list_objects, object_size)
+from primavera_val.records import FileRecord
+from primavera_val.templates import dataset_of
+
 
 FREQUENCY_VALUES = ['ann', 'mon', 'day', '6hr', '3hr', '1hr', 'subhr', 'fx']
 
+# The cost classes of the checks, from cheapest to most expensive. Checks that
+# only need the filename, checks that need the file's header, checks that need
+# coordinate values, checks that read the data itself and checks that read
+# the whole file.
+COST_NAME = 0
+COST_HEADER = 1
+COST_COORDINATE = 2
+COST_DATA = 3
+COST_WHOLE_FILE = 4
+
+# A check on the contents of a file. `needs` is the name of the object that
+# must be loaded from the file before the check can be run, which is passed to
+# `function` along with the metadata identified so far and any options for the
+# check as keyword arguments. `function` raises FileValidationError if the
+# check fails and may return a dictionary of additional metadata.
+Check = namedtuple('Check', ['name', 'cost', 'needs', 'function'])
+
+# netCDF4-python and the netCDF and HDF5 libraries below it aren't thread-safe,
+# so local files are only loaded and checked through them by one thread at a
+# time, for example in a primavera_val.executors.ThreadExecutor. Zarr stores,
+# files in S3 and the checks that only read a file's bytes aren't serialised.
+NETCDF_LOCK = threading.RLock()
+
+# The Zarr, S3 and chunk layout back ends, and the libraries that they need,
+# are imported by the functions that use them rather than here, so that
+# importing this package doesn't need the libraries of back ends that aren't
+# used.
+
 
 class FileValidationError(Exception):
     """
@@ -52,11 +92,16 @@ def identify_filename_metadata(filename, file_format='CMIP6'):
     directory = os.path.dirname(filename)
     metadata = {'basename': basename, 'directory': directory}
 
+    from primavera_val.zarr_store import ZARR_SUFFIX, store_size
+
     # split the filename into sections
-    if basename.endswith('-clim.nc'):
-        filename_sects = basename.rpartition('-clim.nc')[0].split('_')
+    if basename.endswith(ZARR_SUFFIX):
+        stem = basename[:-len(ZARR_SUFFIX)]
     else:
-        filename_sects = basename.rpartition('.nc')[0].split('_')
+        stem = basename.rpartition('.nc')[0]
+    if stem.endswith('-clim'):
+        stem = stem[:-len('-clim')]
+    filename_sects = stem.split('_')
 
     # but if experiment present_day was in the filename, join these sections
     # back together. This should only occur in pre-PRIMAVERA data.
@@ -90,7 +135,12 @@ def identify_filename_metadata(filename, file_format='CMIP6'):
         if missing_value not in metadata:
             metadata[missing_value] = None
 
-    metadata['filesize'] = os.path.getsize(filename)
+    if is_s3_url(filename):
+        metadata['filesize'] = object_size(filename)
+    elif os.path.isdir(filename):
+        metadata['filesize'] = store_size(filename)
+    else:
+        metadata['filesize'] = os.path.getsize(filename)
 
     for freq in FREQUENCY_VALUES:
         if freq in metadata['table'].lower():
@@ -205,37 +255,145 @@ def validate_cell_measures_contents(cfreader, metadata):
     _check_cell_measure_point(cfreader, metadata)
 
 
+def validate_file(filename, file_format='CMIP6', cell_measure=False,
+                  checks=None, options=None, dedupe=False):
+    """
+    Run the checks on a single file, cheapest first, stopping at the first
+    check that fails. The file's contents are only loaded if one of the
+    selected checks needs them. The metadata in the filename is always
+    identified first as all of the other checks need it.
+
+    Cell measures and fixed fields are often identical between experiments
+    and ensemble members, so with `dedupe` the outcome of checking one of
+    them is reused for the later files in this process with the same
+    contents, variable and table.
+
+    :param str filename: The file's complete path
+    :param str file_format: The CMOR version of the netCDF files, one out of-
+        CMIP5 or CMIP6
+    :param bool cell_measure: True if the file contains a cell measure
+    :param list checks: The names of the checks to run (default: all of the
+        checks that are run by default)
+    :param dict options: Dictionaries of keyword arguments for the checks,
+        keyed by the name of the check
+    :param bool dedupe: Reuse the outcome of checking an identical cell
+        measure or fixed field
+    :returns: The identified metadata
+    :rtype: primavera_val.records.FileRecord
+    :raises FileValidationError: If the file fails any of the checks
+    """
+    metadata = FileRecord(identify_filename_metadata(filename, file_format))
+
+    cache_key = None
+    if dedupe and (cell_measure or metadata['frequency'] == 'fx'):
+        cache_key = _content_key(filename, metadata, cell_measure, checks,
+                                 options)
+    if cache_key is not None:
+        cached = CONTENT_CACHE.lookup(filename, cache_key)
+        if cached is not None:
+            if cached.message is not None:
+                msg = ('File {} has the same contents as {}, which failed '
+                       'validation:\n{}'.format(metadata['basename'],
+                                                 cached.filename,
+                                                 cached.message))
+                raise FileValidationError(msg)
+            metadata.update(cached.metadata)
+            metadata['duplicate_of'] = cached.filename
+            return metadata
+
+    from primavera_val.zarr_store import is_zarr_store
+
+    found = {}
+    loaded = {}
+    netcdf = not (is_s3_url(filename) or is_zarr_store(filename))
+    try:
+        for check in select_checks(checks, cell_measure):
+            with (NETCDF_LOCK if netcdf and check.needs != 'path' else
+                  _unlocked()):
+                if check.needs not in loaded:
+                    loaded[check.needs] = _LOADERS[check.needs](filename)
+                extra_metadata = check.function(
+                    loaded[check.needs], metadata,
+                    **(options or {}).get(check.name, {}))
+            if isinstance(extra_metadata, dict):
+                metadata.update(extra_metadata)
+                found.update(extra_metadata)
+    except FileValidationError as exc:
+        if cache_key is not None:
+            CONTENT_CACHE.add(filename, cache_key, message=exc.__str__())
+        raise
+
+    if cache_key is not None:
+        CONTENT_CACHE.add(filename, cache_key, metadata=found)
+    return metadata
+
+
+def select_checks(names=None, cell_measure=False):
+    """
+    Find the checks with the specified names, ordered from the cheapest to
+    the most expensive.
+
+    :param list names: The names of the checks (default: all of the checks
+        that are run by default)
+    :param bool cell_measure: True to select from the checks for cell
+        measures rather than those for other variables
+    :returns: A list of Check objects
+    :raises ValueError: If any of the names aren't known
+    """
+    if cell_measure:
+        registry = CELL_MEASURE_CHECKS + OPTIONAL_CELL_MEASURE_CHECKS
+    else:
+        registry = FILE_CHECKS + OPTIONAL_FILE_CHECKS
+
+    if names is None:
+        selected = list(CELL_MEASURE_CHECKS if cell_measure else FILE_CHECKS)
+    else:
+        unknown = set(names) - {check.name for check in registry} - {
+            'filename'}
+        if unknown:
+            raise ValueError('Unknown checks: {}. Available checks are: {}'.
+                             format(', '.join(sorted(unknown)),
+                                    ', '.join(available_checks(
+                                        cell_measure))))
+        selected = [check for check in registry if check.name in names]
+
+    return sorted(selected, key=lambda check: check.cost)
+
+
+def available_checks(cell_measure=False):
+    """
+    The names of all of the checks that can be selected.
+
+    :param bool cell_measure: True for the checks for cell measures rather
+        than those for other variables
+    :returns: A list of check names ordered from the cheapest to the most
+        expensive, including the checks that are only run when selected
+    """
+    registry = (CELL_MEASURE_CHECKS + OPTIONAL_CELL_MEASURE_CHECKS
+                if cell_measure else FILE_CHECKS + OPTIONAL_FILE_CHECKS)
+    return ['filename'] + [check.name for check in
+                           select_checks([check.name for check in registry],
+                                         cell_measure)]
+
+
 def load_cube(filename):
     """
-    Loads the specified file into a single Iris cube
+    Loads the specified netCDF file, Zarr store or netCDF file in S3 into a
+    single Iris cube
 
-    :param str filename: The path of the file to load
+    :param str filename: The path or s3:// URL of the file to load
     :returns: An Iris cube containing the loaded file
     :raises FileValidationError: If the file generates more than a single cube
     """
+    from primavera_val.zarr_store import is_zarr_store, load_zarr, make_cubes
+
     try:
-        try:
-            cubes = iris.load(filename)
-        except AttributeError:
-            # Until https://github.com/SciTools/iris/pull/2485 is complete
-            # add this fix for certain hybrid height (model level) variables
-            cubes = iris.load_raw(filename)
-            bounds_cubes = iris.cube.CubeList()
-            data_cube = None
-            for cube in cubes:
-                if cube.var_name.endswith('_bnds'):
-                    bounds_cubes.append(cube)
-                else:
-                    data_cube = cube
-            if not bounds_cubes or not data_cube:
-                msg = ('Unable to find data and bounds when fixing hybrid '
-                       'height bounds in file: {}'.format(filename))
-                raise FileValidationError(msg)
-            for bounds_cube in bounds_cubes:
-                coord_name = bounds_cube.long_name.replace('+1/2', '')
-                bounds_coord = data_cube.coord(coord_name)
-                bounds_coord.bounds = bounds_cube.data
-            cubes = iris.cube.CubeList([data_cube])
+        if is_s3_url(filename):
+            cubes = make_cubes(NetCDFObject(filename), dataset_of(filename))
+        elif is_zarr_store(filename):
+            cubes = load_zarr(filename)
+        else:
+            cubes = _load_netcdf(filename)
     except Exception:
         msg = 'Unable to load data from file: {}'.format(filename)
         raise FileValidationError(msg)
@@ -253,28 +411,143 @@ def load_cube(filename):
     return var_cubes[0]
 
 
+def load_layout(filename):
+    """
+    Loads the chunking and compression layout of the data variable in the
+    specified file
+
+    :param str filename: The path of the file to load
+    :returns: The layout of the variable named in the filename
+    :rtype: primavera_val.layout.ChunkLayout
+    :raises FileValidationError: If the layout can't be read
+    """
+    from primavera_val.layout import read_layout
+
+    try:
+        return read_layout(filename)
+    except Exception:
+        msg = 'Unable to read the chunk layout of file: {}'.format(filename)
+        raise FileValidationError(msg)
+
+
+def load_cfreader(filename):
+    """
+    Loads the CF metadata from the specified netCDF file
+
+    :param str filename: The path of the file to load
+    :returns: The CF metadata from the file
+    :rtype: iris.fileformats.cf.CFReader
+    :raises FileValidationError: If the file is a Zarr store or in S3
+    """
+    from primavera_val.zarr_store import is_zarr_store
+
+    if is_zarr_store(filename) or is_s3_url(filename):
+        msg = ('Cell measures can only be validated in local netCDF files: '
+               '{}'.format(filename))
+        raise FileValidationError(msg)
+    return iris.fileformats.cf.CFReader(filename)
+
+
 def list_files(directory, suffix='.nc'):
     """
     Return a list of all the files with the specified suffix in the submission
-    directory structure and sub-directories.
+    directory structure and sub-directories. Zarr stores, which are
+    directories, are included as if they were files. If the directory is an
+    s3://bucket/prefix URL then the objects below the prefix are listed.
 
     :param str directory: The root directory of the submission
     :param str suffix: The suffix of the files of interest
-    :returns: A list of absolute filepaths
+    :returns: A list of absolute filepaths or s3:// URLs
     """
+    if is_s3_url(directory):
+        return list_objects(directory, suffix)
+
+    from primavera_val.zarr_store import is_zarr_store
+
     nc_files = []
 
     dir_files = os.listdir(directory)
     for filename in dir_files:
         file_path = os.path.join(directory, filename)
-        if os.path.isdir(file_path):
-            nc_files.extend(list_files(file_path))
+        if is_zarr_store(file_path):
+            nc_files.append(file_path)
+        elif os.path.isdir(file_path):
+            nc_files.extend(list_files(file_path, suffix))
         elif file_path.endswith(suffix):
             nc_files.append(file_path)
 
     return nc_files
 
 
+def _load_netcdf(filename):
+    """
+    Loads the cubes from the specified netCDF file. netCDF-4 files are
+    loaded in the same way as netCDF files in S3 so that they reuse the
+    coordinates of the earlier files in their dataset, and other files, or
+    netCDF-4 files that can't be loaded that way, are loaded by Iris.
+
+    :param str filename: The path of the file to load
+    :returns: The cubes in the file
+    :rtype: iris.cube.CubeList
+    """
+    if is_netcdf4_file(filename):
+        from primavera_val.zarr_store import make_cubes
+
+        try:
+            return make_cubes(NetCDFObject(filename), dataset_of(filename))
+        except Exception:
+            pass
+    try:
+        cubes = iris.load(filename)
+    except AttributeError:
+        # Until https://github.com/SciTools/iris/pull/2485 is complete
+        # add this fix for certain hybrid height (model level) variables
+        cubes = iris.load_raw(filename)
+        bounds_cubes = iris.cube.CubeList()
+        data_cube = None
+        for cube in cubes:
+            if cube.var_name.endswith('_bnds'):
+                bounds_cubes.append(cube)
+            else:
+                data_cube = cube
+        if not bounds_cubes or not data_cube:
+            msg = ('Unable to find data and bounds when fixing hybrid '
+                   'height bounds in file: {}'.format(filename))
+            raise FileValidationError(msg)
+        for bounds_cube in bounds_cubes:
+            coord_name = bounds_cube.long_name.replace('+1/2', '')
+            bounds_coord = data_cube.coord(coord_name)
+            bounds_coord.bounds = bounds_cube.data
+        cubes = iris.cube.CubeList([data_cube])
+    return cubes
+
+
+@contextlib.contextmanager
+def _unlocked():
+    """
+    A context manager that does nothing, for the checks that aren't
+    serialised by NETCDF_LOCK. contextlib.nullcontext() needs Python 3.7.
+    """
+    yield
+
+
+def _content_key(filename, metadata, cell_measure, checks, options):
+    """
+    The key of a file's outcome in the content cache: the fingerprint of its
+    contents and everything else that the checks depend on, or None if the
+    file can't be fingerprinted.
+    """
+    if is_s3_url(filename) or os.path.isdir(filename):
+        return None
+    try:
+        file_fingerprint = fingerprint(filename)
+    except (IOError, OSError):
+        return None
+    return (file_fingerprint, metadata['cmor_name'], metadata['table'],
+            cell_measure, tuple(checks) if checks is not None else None,
+            json.dumps(options, sort_keys=True))
+
+
 def _get_frequency(table_name):
     """
     Finds the frequency of the data in the specified table name.
@@ -355,9 +628,12 @@ def _check_start_end_times(cube, metadata):
     file_start_date = metadata['start_date']
     file_end_date = metadata['end_date']
 
+    from primavera_val.zarr_store import ZARR_SUFFIX
+
     try:
         time = cube.coord('time')
-        if metadata['basename'].endswith('-clim.nc'):
+        if metadata['basename'].endswith(('-clim.nc',
+                                          '-clim' + ZARR_SUFFIX)):
             # climatology so use bounds
             data_start = time.units.num2date(time.bounds[0][0])
             data_end = time.units.num2date(time.bounds[-1][1])
@@ -467,6 +743,50 @@ def _check_data_point(cube, metadata):
         return True
 
 
+def _check_layout(layout, metadata, **thresholds):
+    """
+    Check whether the file's chunking and compression allow maps and time
+    series to be read from it efficiently
+
+    :param primavera_val.layout.ChunkLayout layout: The layout of the file's
+        data variable
+    :param dict metadata: Metadata obtained from the file
+    :param thresholds: Thresholds to use instead of those in
+        primavera_val.layout.DEFAULT_THRESHOLDS
+    :returns: True if the layout is within all of the thresholds
+    :raises FileValidationError: If the layout exceeds any of the thresholds
+    """
+    from primavera_val.layout import describe_layout, layout_problems
+
+    problems = layout_problems(layout, thresholds)
+    if problems:
+        msg = 'Inefficient chunk layout ({}) in file {}: {}'.format(
+            describe_layout(layout), metadata['basename'],
+            '; '.join(problems))
+        raise FileValidationError(msg)
+    return True
+
+
+def _check_checksums(filename, metadata, algorithms=None):
+    """
+    Calculate the checksums of the whole file
+
+    :param str filename: The file's complete path
+    :param dict metadata: Metadata obtained from the file
+    :param list algorithms: The names of the checksum algorithms to use
+        (default: primavera_val.checksums.DEFAULT_ALGORITHMS)
+    :returns: A dictionary containing the checksums keyed by algorithm
+    :raises FileValidationError: If the file can't be read
+    """
+    try:
+        checksums = file_checksums(filename, algorithms)
+    except (IOError, OSError):
+        msg = 'Unable to read file to calculate its checksums: {}'.format(
+            metadata['basename'])
+        raise FileValidationError(msg)
+    return {'checksums': checksums}
+
+
 def _check_cell_measure_point(cfreader, metadata):
     """
     Check if a data point can be read from a file containing a cell measure
@@ -500,3 +820,63 @@ def _check_cell_measure_point(cfreader, metadata):
         raise FileValidationError(msg)
     else:
         return True
+
+
+def _check_contents_metadata(cube, metadata):
+    """
+    Check that the essential metadata can be read from a file's contents.
+
+    :param iris.cube.Cube cube: The loaded file to check
+    :param dict metadata: Metadata obtained from the file
+    :returns: A dictionary of the identified metadata
+    """
+    return identify_contents_metadata(
+        cube, os.path.join(metadata['directory'], metadata['basename']))
+
+
+def _check_cell_measures_metadata(cfreader, metadata):
+    """
+    Check that the essential metadata can be read from a cell measure file's
+    contents.
+
+    :param iris.fileformats.cf.CFReader cfreader: The CF metadata from the
+        file
+    :param dict metadata: Metadata obtained from the file
+    :returns: A dictionary of the identified metadata
+    """
+    return identify_cell_measures_metadata(
+        cfreader, os.path.join(metadata['directory'], metadata['basename']))
+
+
+# The functions that load the objects needed by the checks from a file
+_LOADERS = {
+    'cube': load_cube,
+    'cfreader': load_cfreader,
+    'layout': load_layout,
+    'path': lambda filename: filename,
+}
+
+# The checks run on each file, in the order that they are run within each
+# cost class
+FILE_CHECKS = [
+    Check('contents', COST_HEADER, 'cube', _check_contents_metadata),
+    Check('times', COST_COORDINATE, 'cube', _check_start_end_times),
+    Check('contiguity', COST_COORDINATE, 'cube', _check_contiguity),
+    Check('data', COST_DATA, 'cube', _check_data_point),
+]
+
+# Checks that are only run on each file when they are selected by name
+OPTIONAL_FILE_CHECKS = [
+    Check('layout', COST_HEADER, 'layout', _check_layout),
+    Check('checksum', COST_WHOLE_FILE, 'path', _check_checksums),
+]
+
+CELL_MEASURE_CHECKS = [
+    Check('contents', COST_HEADER, 'cfreader', _check_cell_measures_metadata),
+    Check('data', COST_DATA, 'cfreader', _check_cell_measure_point),
+]
+
+# Checks that are only run on cell measures when they are selected by name
+OPTIONAL_CELL_MEASURE_CHECKS = [
+    Check('checksum', COST_WHOLE_FILE, 'path', _check_checksums),
+]
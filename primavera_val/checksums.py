@@ -0,0 +1,264 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+Calculate the checksums of files and verify them against a manifest.
+
+The checksums needed for publication are calculated by the workers in the
+same task that validates each file, so that a run reads each file once rather
+than validating the archive and then reading it all again. Each file is read
+sequentially in large blocks and every selected algorithm is updated from the
+same block.
+
+A manifest lists the expected size and checksums of each file, one JSON
+object per line:
+
+    {"filename": "/path/to/file.nc", "filesize": 1234, "sha256": "..."}
+
+Any of the algorithms in CHECKSUM_ALGORITHMS can be given for each file.
+Relative filenames are relative to the directory that the manifest is in, and
+files in object storage are given by their s3:// URLs.
+"""
+from __future__ import unicode_literals, division, absolute_import
+from collections import namedtuple
+import hashlib
+import io
+import json
+import os
+import zlib
+
+from primavera_val.object_store import absolute_path, is_s3_url, read_object
+
+
+# The algorithms that checksums can be calculated with
+CHECKSUM_ALGORITHMS = ['sha256', 'adler32', 'md5']
+
+DEFAULT_ALGORITHMS = ['sha256']
+
+# The number of bytes read from a file at a time
+READ_SIZE = 16 * 1024 ** 2
+
+# The expected size and checksums, keyed by algorithm, of a file
+ManifestEntry = namedtuple('ManifestEntry', ['filesize', 'checksums'])
+
+
+class _Adler32(object):
+    """
+    An Adler-32 checksum with the same interface as the hashlib algorithms.
+    """
+    def __init__(self):
+        self._value = zlib.adler32(b'')
+
+    def update(self, data):
+        self._value = zlib.adler32(data, self._value)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self._value & 0xffffffff)
+
+
+_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'adler32': _Adler32,
+    'md5': hashlib.md5,
+}
+
+
+def file_checksums(filename, algorithms=None, read_size=READ_SIZE):
+    """
+    Calculate the checksums of a file in a single sequential read. The
+    checksums of a Zarr store are those of the contents of all of the files
+    in it, in order of their paths relative to the store.
+
+    :param str filename: The path of the file or Zarr store, or the s3:// URL
+        of the file
+    :param list algorithms: The names of the algorithms (default:
+        DEFAULT_ALGORITHMS)
+    :param int read_size: The number of bytes to read at a time
+    :returns: The hexadecimal checksums keyed by the names of the algorithms
+    :rtype: dict
+    :raises ValueError: If any of the algorithms aren't known
+    :raises IOError: If the file can't be read
+    """
+    algorithms = algorithms or DEFAULT_ALGORITHMS
+    validate_algorithms(algorithms)
+    hashes = [_ALGORITHMS[name]() for name in algorithms]
+
+    if is_s3_url(filename):
+        for block in read_object(filename, read_size):
+            for checksum in hashes:
+                checksum.update(block)
+        return {name: checksum.hexdigest()
+                for name, checksum in zip(algorithms, hashes)}
+
+    buf = bytearray(read_size)
+    view = memoryview(buf)
+    for path in _store_files(filename):
+        with io.open(path, 'rb', buffering=0) as handle:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(handle.fileno(), 0, 0,
+                                 os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                num_read = handle.readinto(buf)
+                if not num_read:
+                    break
+                for checksum in hashes:
+                    checksum.update(view[:num_read])
+
+    return {name: checksum.hexdigest()
+            for name, checksum in zip(algorithms, hashes)}
+
+
+def validate_algorithms(algorithms):
+    """
+    Check that checksums can be calculated with the algorithms.
+
+    :param list algorithms: The names of the algorithms, or None for the
+        defaults
+    :raises ValueError: If any of the algorithms aren't known
+    """
+    if algorithms is None:
+        return
+    if not isinstance(algorithms, list) or not algorithms:
+        raise ValueError('The checksum algorithms must be a list of names')
+    unknown = set(algorithms) - set(CHECKSUM_ALGORITHMS)
+    if unknown:
+        raise ValueError('Unknown checksum algorithms: {}. Available '
+                         'algorithms are: {}'.format(
+                             ', '.join(sorted(unknown)),
+                             ', '.join(CHECKSUM_ALGORITHMS)))
+
+
+class Manifest(object):
+    """
+    The expected sizes and checksums of the files in a submission.
+
+    Files are looked up by their absolute path, or by their name if the path
+    isn't in the manifest and only one file in the manifest has that name.
+    """
+    def __init__(self, entries):
+        """
+        :param dict entries: ManifestEntry objects keyed by the absolute path
+            of each file
+        """
+        self.entries = entries
+        self._by_name = {}
+        for path in entries:
+            self._by_name.setdefault(os.path.basename(path), []).append(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def algorithms(self):
+        """
+        The names of all of the algorithms that the manifest has checksums
+        for.
+        """
+        found = set()
+        for entry in self.entries.values():
+            found.update(entry.checksums)
+        return [name for name in CHECKSUM_ALGORITHMS if name in found]
+
+    def find(self, filename):
+        """
+        :param str filename: The path of a file
+        :returns: The path in the manifest that the file matches, or None
+        """
+        path = absolute_path(filename)
+        if path in self.entries:
+            return path
+        matches = self._by_name.get(os.path.basename(path), [])
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+    def verify(self, filename, filesize, checksums):
+        """
+        Compare a file's size and checksums with those in the manifest.
+        Checksums that aren't in both are ignored, but it is a difference if
+        the manifest has checksums for the file and none of them were
+        calculated.
+
+        :param str filename: The path of the file
+        :param int filesize: The size of the file in bytes
+        :param dict checksums: The file's checksums keyed by algorithm
+        :returns: A description of each difference, which is empty if the
+            file matches
+        :rtype: list
+        """
+        path = self.find(filename)
+        if path is None:
+            return ['not in the manifest']
+        entry = self.entries[path]
+
+        problems = []
+        if entry.filesize is not None and entry.filesize != filesize:
+            problems.append('size {} does not match {} in the '
+                            'manifest'.format(filesize, entry.filesize))
+        for name in CHECKSUM_ALGORITHMS:
+            expected = entry.checksums.get(name)
+            actual = (checksums or {}).get(name)
+            if expected and actual and expected.lower() != actual:
+                problems.append('{} checksum {} does not match {} in the '
+                                'manifest'.format(name, actual, expected))
+        expected = [name for name in CHECKSUM_ALGORITHMS
+                    if entry.checksums.get(name)]
+        if expected and not set(expected) & set(checksums or {}):
+            problems.append('none of its checksums in the manifest ({}) '
+                            'were calculated'.format(', '.join(expected)))
+        return problems
+
+    def missing(self, filenames):
+        """
+        :param list filenames: The paths of the files that were found
+        :returns: The paths in the manifest that none of the files match
+        :rtype: list
+        """
+        found = {self.find(filename) for filename in filenames}
+        return sorted(set(self.entries) - found)
+
+
+def read_manifest(path):
+    """
+    Read a manifest of the expected sizes and checksums of files.
+
+    :param str path: The path of the manifest
+    :returns: The manifest
+    :rtype: Manifest
+    :raises ValueError: If a line of the manifest can't be understood
+    :raises IOError: If the manifest can't be read
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    entries = {}
+    with io.open(path, 'rb') as handle:
+        for line_num, line in enumerate(handle, start=1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line.decode('utf-8'))
+                filename = item['filename']
+                if not is_s3_url(filename):
+                    filename = os.path.abspath(os.path.join(directory,
+                                                            filename))
+                filesize = item.get('filesize')
+                if filesize is not None:
+                    filesize = int(filesize)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise ValueError('Unable to read line {} of manifest '
+                                 '{}'.format(line_num, path))
+            entries[filename] = ManifestEntry(
+                filesize, {name: item[name] for name in CHECKSUM_ALGORITHMS
+                           if item.get(name)})
+    return Manifest(entries)
+
+
+def _store_files(filename):
+    """
+    The paths of the files to read the contents of, in order.
+    """
+    if not os.path.isdir(filename):
+        return [filename]
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(filename):
+        dirnames.sort()
+        paths.extend(os.path.join(dirpath, name) for name in filenames)
+    return sorted(paths, key=lambda path: os.path.relpath(path, filename))
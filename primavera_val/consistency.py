@@ -0,0 +1,178 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+Checks that the metadata read from the contents of each file agrees across
+all of the files in a dataset.
+
+The metadata from each file is stored in a compact columnar table, where each
+string is stored once and each row holds just an integer code, so that the
+table stays small for hundreds of thousands of files and the comparisons can
+be made on whole columns at once with numpy.
+"""
+from __future__ import unicode_literals, division, absolute_import
+from array import array
+
+import numpy as np
+
+
+# The filename components that together identify a dataset
+DATASET_FIELDS = ['cmor_name', 'table', 'climate_model', 'experiment',
+                  'rip_code', 'grid']
+
+# The items of contents metadata that must agree across a dataset
+CONSISTENCY_FIELDS = ['units', 'calendar', 'time_units', 'institute',
+                      'standard_name', 'activity_id']
+
+
+class _CodedColumn(object):
+    """
+    A column of values where each distinct value is stored once and each row
+    holds the integer code of its value.
+    """
+    def __init__(self):
+        self.values = []
+        self.codes = array(str('l'))
+        self._lookup = {}
+
+    def append(self, value):
+        try:
+            code = self._lookup[value]
+        except KeyError:
+            code = len(self.values)
+            self._lookup[value] = code
+            self.values.append(value)
+        self.codes.append(code)
+
+    def as_array(self):
+        # the array module's 'l' type code is a C long, as is numpy's
+        return np.frombuffer(self.codes, dtype=str('l'))
+
+
+class DatasetInconsistency(object):
+    """
+    The different values of one item of metadata found in a single dataset.
+    """
+    def __init__(self, dataset, field, values):
+        """
+        :param str dataset: The name of the dataset
+        :param str field: The name of the item of metadata
+        :param dict values: For each value found, a tuple of the number of
+            files with that value and the name of the first of these files
+        """
+        self.dataset = dataset
+        self.field = field
+        self.values = values
+
+    def __str__(self):
+        details = ['{!r} in {} files (e.g. {})'.format(value, count, example)
+                   for value, (count, example) in sorted(
+                       self.values.items(), key=lambda item: -item[1][0])]
+        return 'Dataset {} has inconsistent {}: {}'.format(
+            self.dataset, self.field, '; '.join(details))
+
+
+class MetadataTable(object):
+    """
+    A columnar table of the metadata identified from each file.
+    """
+    def __init__(self, fields=None):
+        """
+        :param list fields: The items of metadata to compare across each
+            dataset (default: CONSISTENCY_FIELDS)
+        """
+        self.fields = list(fields or CONSISTENCY_FIELDS)
+        self.filenames = []
+        self._datasets = _CodedColumn()
+        self._columns = {field: _CodedColumn() for field in self.fields}
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def append(self, metadata, filename=None):
+        """
+        Add the metadata from a single file to the table.
+
+        :param dict metadata: The filename and contents metadata from the file
+        :param str filename: The name of the file (default: the basename in
+            `metadata`)
+        """
+        self.filenames.append(filename or metadata['basename'])
+        self._datasets.append(dataset_name(metadata))
+        for field in self.fields:
+            self._columns[field].append(metadata.get(field))
+
+    def inconsistencies(self):
+        """
+        Find the datasets that contain files with different values of any of
+        the items of metadata.
+
+        :returns: A list of DatasetInconsistency objects, sorted by dataset
+        """
+        found = []
+        if not self.filenames:
+            return found
+
+        datasets = self._datasets.as_array().astype(np.int64)
+        num_datasets = len(self._datasets.values)
+
+        for field in self.fields:
+            column = self._columns[field]
+            num_values = len(column.values)
+            if num_values < 2:
+                continue
+            values = column.as_array().astype(np.int64)
+
+            # count the distinct values in each dataset
+            pairs = np.unique(datasets * num_values + values)
+            distinct = np.bincount(pairs // num_values,
+                                   minlength=num_datasets)
+
+            for dataset_code in np.flatnonzero(distinct > 1):
+                found.append(self._describe(field, dataset_code, datasets,
+                                            values))
+
+        found.sort(key=lambda inconsistency: (inconsistency.dataset,
+                                              self.fields.index(
+                                                  inconsistency.field)))
+        return found
+
+    def _describe(self, field, dataset_code, datasets, values):
+        """
+        Summarise the values of `field` found in a single dataset.
+        """
+        column = self._columns[field]
+        rows = np.flatnonzero(datasets == dataset_code)
+        row_values, first_rows, counts = np.unique(
+            values[rows], return_index=True, return_counts=True)
+        summary = {}
+        for value_code, first_row, count in zip(row_values, first_rows,
+                                                counts):
+            summary[column.values[value_code]] = (
+                int(count), self.filenames[rows[first_row]])
+        return DatasetInconsistency(self._datasets.values[dataset_code],
+                                    field, summary)
+
+
+def dataset_name(metadata):
+    """
+    Generate the name of the dataset that a file belongs to from its
+    filename metadata.
+
+    :param dict metadata: The metadata identified from the file
+    :returns: The dataset's name
+    :rtype: str
+    """
+    return '_'.join(metadata[field] for field in DATASET_FIELDS
+                    if metadata.get(field))
+
+
+def consistency_metadata(metadata):
+    """
+    Extract just the items of metadata that are needed to check a file's
+    consistency with the rest of its dataset.
+
+    :param dict metadata: The metadata identified from the file
+    :returns: A dictionary of the items required by MetadataTable
+    """
+    return {field: metadata.get(field)
+            for field in ['basename'] + DATASET_FIELDS + CONSISTENCY_FIELDS}
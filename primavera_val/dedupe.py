@@ -0,0 +1,150 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+Reuse the outcome of validating a file for other files with the same
+contents.
+
+Every experiment and ensemble member has its own copy of fixed fields such as
+areacella, sftlf and orog, and the copies are usually identical. Rather than
+opening every copy, each file is given a cheap fingerprint of its size and a
+hash of its header and of blocks sampled through the rest of it. When a file
+has the same fingerprint as one that has already been validated, the whole of
+both files is hashed to confirm that their contents really are the same
+before the earlier outcome is reused.
+
+The cache belongs to the process that validates the files, so with several
+worker processes each unique file may be validated once in each worker.
+"""
+from __future__ import unicode_literals, division, absolute_import
+from collections import namedtuple
+import hashlib
+import io
+import os
+
+from primavera_val.checksums import file_checksums
+
+
+# The number of bytes at the start of a file that are always hashed, which
+# covers the header of a netCDF file
+HEADER_BYTES = 64 * 1024
+
+# The number of blocks sampled from the rest of a file and the size of each
+SAMPLE_BLOCKS = 8
+SAMPLE_BYTES = 4 * 1024
+
+# The maximum number of outcomes kept in a cache
+MAX_ENTRIES = 100000
+
+# The outcome of validating a file: either the metadata found by the checks
+# or the message from the check that failed. `full_hash` is the SHA-256 of
+# the whole file, or None until it's needed.
+CachedOutcome = namedtuple('CachedOutcome', ['filename', 'metadata',
+                                             'message', 'full_hash'])
+
+
+def fingerprint(filename):
+    """
+    Calculate a cheap fingerprint of a file's contents from its size and a
+    hash of its first HEADER_BYTES and of SAMPLE_BLOCKS blocks spread evenly
+    through the rest of it. Files with different fingerprints have different
+    contents, but files with the same fingerprint may not be identical.
+
+    :param str filename: The path of the file
+    :returns: The fingerprint
+    :rtype: str
+    :raises IOError: If the file can't be read
+    """
+    size = os.path.getsize(filename)
+    sha = hashlib.sha256()
+    with io.open(filename, 'rb') as handle:
+        sha.update(handle.read(HEADER_BYTES))
+        remaining = size - HEADER_BYTES
+        if remaining > 0:
+            if remaining <= SAMPLE_BLOCKS * SAMPLE_BYTES:
+                sha.update(handle.read())
+            else:
+                step = (remaining - SAMPLE_BYTES) // (SAMPLE_BLOCKS - 1)
+                for index in range(SAMPLE_BLOCKS):
+                    handle.seek(HEADER_BYTES + index * step)
+                    sha.update(handle.read(SAMPLE_BYTES))
+    return '{}:{}'.format(size, sha.hexdigest())
+
+
+class ContentCache(object):
+    """
+    The outcomes of validating files, keyed by the fingerprint of each file
+    and anything else that the outcome depends on, such as the checks that
+    were run.
+    """
+    def __init__(self, max_entries=MAX_ENTRIES):
+        """
+        :param int max_entries: The maximum number of outcomes to keep. Once
+            there are this many, new outcomes aren't added.
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, filename, key):
+        """
+        Find the outcome of validating a file with the same contents.
+
+        :param str filename: The path of the file
+        :param tuple key: The file's fingerprint followed by anything else
+            that the outcome depends on
+        :returns: The outcome, or None if no file with the same contents has
+            been validated
+        :rtype: CachedOutcome
+        """
+        outcome = self._entries.get(key)
+        if outcome is None or outcome.filename == filename:
+            return None
+
+        # the fingerprints match, so confirm that the contents do
+        try:
+            full_hash = _full_hash(filename)
+            if outcome.full_hash is None:
+                outcome = outcome._replace(
+                    full_hash=_full_hash(outcome.filename))
+                self._entries[key] = outcome
+        except (IOError, OSError):
+            return None
+        if full_hash != outcome.full_hash:
+            return None
+
+        self.hits += 1
+        return outcome
+
+    def add(self, filename, key, metadata=None, message=None):
+        """
+        Record the outcome of validating a file, unless a file with the same
+        fingerprint is already recorded.
+
+        :param str filename: The path of the file
+        :param tuple key: The file's fingerprint followed by anything else
+            that the outcome depends on
+        :param dict metadata: The metadata found by the checks if the file
+            passed
+        :param str message: The reason that the file failed
+        """
+        if len(self._entries) >= self.max_entries:
+            return
+        self._entries.setdefault(
+            key, CachedOutcome(filename, dict(metadata or {}), message, None))
+
+    def clear(self):
+        """
+        Forget all of the outcomes.
+        """
+        self._entries.clear()
+
+
+# The cache used by primavera_val.validate_file() in this process
+CONTENT_CACHE = ContentCache()
+
+
+def _full_hash(filename):
+    return file_checksums(filename, ['sha256'])['sha256']
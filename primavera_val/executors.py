@@ -0,0 +1,297 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+The backends that files can be validated in.
+
+Validating a file is a function of just its path, so the files can be
+validated in any executor that can apply a function to a path. Each executor
+is given one file at a time with submit() and puts the outcome of each file
+on a queue as it finishes, which lets the schedulers in
+primavera_val.scheduling choose which file to start next and limit the number
+of files submitted but not yet finished.
+
+    serial
+        each file is validated in this process as it's submitted
+    thread
+        a pool of threads in this process, which suits storage whose latency
+        rather than the CPU limits a run. Local netCDF files are only read by
+        one thread at a time, as the netCDF and HDF5 libraries aren't
+        thread-safe, so this mostly helps with Zarr stores, files in S3 and
+        the checksum check.
+    process
+        a pool of worker processes on this machine, which are replaced when
+        they go over their memory budget or their maximum number of files
+    dask
+        the workers of a dask.distributed cluster, either an existing one
+        given by the address of its scheduler or a LocalCluster started for
+        the run. The workers must be able to import primavera_val and read
+        the files.
+"""
+from __future__ import unicode_literals, division, absolute_import
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import multiprocessing
+
+try:
+    import distributed
+except ImportError:
+    distributed = None
+
+from primavera_val.workers import NO_WORKER_LIMITS, WorkerPool
+
+
+# The number of files to keep submitted for each worker, so that a worker
+# can start its next file without waiting for this process to submit it
+FILES_PER_WORKER = 2
+
+logger = logging.getLogger(__name__)
+
+
+class Executor(object):
+    """
+    Applies a function to files and reports the outcome of each file on a
+    queue as it finishes.
+    """
+    def __init__(self, workers=1):
+        """
+        :param int workers: The number of files that can be validated at once
+        """
+        self.workers = workers
+
+    @property
+    def capacity(self):
+        """
+        The number of files to keep submitted but not yet finished.
+        """
+        return FILES_PER_WORKER * self.workers
+
+    def submit(self, function, filename, completed):
+        """
+        Start applying `function` to a file. When it finishes the file, the
+        result and None, or the file, None and the exception raised, are put
+        on the `completed` queue.
+
+        :param function: A picklable function that takes the path of a file
+        :param str filename: The path of the file
+        :param queue.Queue completed: The queue for the outcome
+        """
+        raise NotImplementedError
+
+    def shutdown(self):
+        """
+        Stop the executor, abandoning any files that haven't finished.
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+
+class SerialExecutor(Executor):
+    """
+    Validates each file in this process as soon as it's submitted.
+    """
+    @property
+    def capacity(self):
+        return 1
+
+    def submit(self, function, filename, completed):
+        try:
+            result = function(filename)
+        except Exception as exc:
+            completed.put((filename, None, exc))
+        else:
+            completed.put((filename, result, None))
+
+    def __str__(self):
+        return 'this process'
+
+
+class ThreadExecutor(Executor):
+    """
+    Validates files in a pool of threads in this process. validate_file()
+    holds primavera_val.NETCDF_LOCK while it reads a local netCDF file, so
+    only one thread at a time reads one.
+    """
+    def __init__(self, workers):
+        super(ThreadExecutor, self).__init__(workers)
+        self._pool = ThreadPoolExecutor(workers)
+        self._futures = set()
+
+    def submit(self, function, filename, completed):
+        future = self._pool.submit(function, filename)
+        self._futures.add(future)
+
+        def finished(future):
+            self._futures.discard(future)
+            if not future.cancelled():
+                completed.put(_outcome(filename, future))
+
+        future.add_done_callback(finished)
+
+    def shutdown(self):
+        for future in list(self._futures):
+            future.cancel()
+        self._pool.shutdown(wait=True)
+
+    def __str__(self):
+        return '{} threads'.format(self.workers)
+
+
+class ProcessExecutor(Executor):
+    """
+    Validates files in a pool of worker processes on this machine.
+    """
+    def __init__(self, workers, limits=NO_WORKER_LIMITS, initializer=None,
+                 failed=None, initial_workers=None):
+        """
+        :param int workers: The number of worker processes
+        :param primavera_val.workers.WorkerLimits limits: The memory budget
+            and maximum number of files of each worker process
+        :param initializer: A function to call in each new worker process
+        :param failed: A function that takes a file and the reason that it
+            couldn't be validated within the limits and returns the result
+            to report for the file (default: report a WorkerError)
+        :param int initial_workers: The number of worker processes to start
+            now, the others being started as they are needed (default: all
+            of them)
+        """
+        super(ProcessExecutor, self).__init__(workers)
+        self._pool = WorkerPool(workers, limits, initializer, failed,
+                                initial_workers)
+
+    @property
+    def replaced(self):
+        """
+        The number of worker processes that have been replaced.
+        """
+        return self._pool.replaced
+
+    def submit(self, function, filename, completed):
+        self._pool.submit(function, filename, completed)
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+    def __str__(self):
+        return '{} worker processes'.format(self.workers)
+
+
+class DaskExecutor(Executor):
+    """
+    Validates files on the workers of a dask.distributed cluster.
+    """
+    def __init__(self, address=None, workers=None):
+        """
+        :param str address: The address of the cluster's scheduler (default:
+            start a LocalCluster)
+        :param int workers: The number of single-threaded worker processes
+            in the LocalCluster (default: the number of CPUs)
+        :raises ImportError: If dask.distributed isn't installed
+        """
+        if distributed is None:
+            raise ImportError('dask.distributed is required to validate '
+                              'files on a Dask cluster')
+        self._cluster = None
+        if address:
+            self._client = distributed.Client(address)
+        else:
+            self._cluster = distributed.LocalCluster(
+                n_workers=workers or multiprocessing.cpu_count(),
+                threads_per_worker=1, processes=True,
+                dashboard_address=None
+            )
+            self._client = distributed.Client(self._cluster)
+        # keep a reference to each future until it finishes, as the cluster
+        # forgets the tasks of futures that are released
+        self._futures = set()
+        super(DaskExecutor, self).__init__(
+            max(sum(self._client.nthreads().values()), 1))
+        logger.debug('Connected to Dask scheduler %s',
+                     self._client.scheduler.address)
+
+    def submit(self, function, filename, completed):
+        future = self._client.submit(function, filename, pure=False)
+        self._futures.add(future)
+
+        def finished(future):
+            self._futures.discard(future)
+            if not future.cancelled():
+                completed.put(_outcome(filename, future))
+
+        future.add_done_callback(finished)
+
+    def shutdown(self):
+        if self._futures:
+            self._client.cancel(list(self._futures))
+        self._client.close()
+        if self._cluster is not None:
+            self._cluster.close()
+
+    def __str__(self):
+        return '{} threads on Dask cluster {}'.format(
+            self.workers, self._client.scheduler.address)
+
+
+# The names of the executors that can be chosen
+EXECUTORS = ['serial', 'thread', 'process', 'dask']
+
+
+def available_executors():
+    """
+    :returns: The names of the executors that can be used in this
+        environment
+    :rtype: list
+    """
+    return [name for name in EXECUTORS
+            if name != 'dask' or distributed is not None]
+
+
+def make_executor(name, workers=None, address=None, limits=None,
+                  failed=None):
+    """
+    Create an executor.
+
+    :param str name: The name of the executor, out of EXECUTORS
+    :param int workers: The number of workers (default: the number of CPUs).
+        Ignored by the serial executor and when connecting to an existing
+        Dask cluster.
+    :param str address: The address of the scheduler of an existing Dask
+        cluster
+    :param primavera_val.workers.WorkerLimits limits: The memory budget and
+        maximum number of files of each worker process of the process
+        executor
+    :param failed: A function that makes the result reported for a file
+        that the process executor couldn't validate within `limits`
+    :returns: The executor
+    :rtype: Executor
+    :raises ValueError: If the name isn't known, or `limits` are given for
+        an executor other than the process executor
+    """
+    if limits and any(limits) and name != 'process':
+        raise ValueError('Worker limits can only be used with the process '
+                         'executor')
+    workers = workers or multiprocessing.cpu_count()
+    if name == 'serial':
+        return SerialExecutor()
+    if name == 'thread':
+        return ThreadExecutor(workers)
+    if name == 'process':
+        return ProcessExecutor(workers, limits, failed=failed)
+    if name == 'dask':
+        return DaskExecutor(address, workers)
+    raise ValueError('Unknown executor: {}. Available executors are: '
+                     '{}'.format(name, ', '.join(EXECUTORS)))
+
+
+def _outcome(filename, future):
+    """
+    The outcome of a finished future in the form put on the completed queue.
+    """
+    error = future.exception()
+    if error is not None:
+        return filename, None, error
+    return filename, future.result(), None
@@ -0,0 +1,145 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+An append-only journal of the files that have been validated so that an
+interrupted run can be resumed without checking the same files again.
+
+Each line of the journal is a JSON object describing the outcome of
+validating a single file. Lines are flushed and synced to disk in batches so
+that the cost of the journal is small compared to the cost of the checks.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import io
+import json
+import logging
+import os
+import time
+
+from primavera_val.object_store import absolute_path
+
+
+PASSED = 'passed'
+FAILED = 'failed'
+
+# The maximum number of records, or seconds, between syncs to disk
+DEFAULT_SYNC_EVERY = 100
+DEFAULT_SYNC_INTERVAL = 30.
+
+logger = logging.getLogger(__name__)
+
+
+class ValidationJournal(object):
+    """
+    An append-only record of the outcome of validating each file.
+    """
+    def __init__(self, path, resume=False, sync_every=DEFAULT_SYNC_EVERY,
+                 sync_interval=DEFAULT_SYNC_INTERVAL):
+        """
+        :param str path: The path of the journal file
+        :param bool resume: If True then append to any existing journal,
+            otherwise any existing journal is overwritten
+        :param int sync_every: The maximum number of records to write before
+            syncing the journal to disk
+        :param float sync_interval: The maximum number of seconds between
+            syncs of the journal to disk
+        """
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+        if resume and os.path.exists(path):
+            self._handle = io.open(path, 'a+b')
+            self._terminate_partial_line()
+        else:
+            self._handle = io.open(path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, filename, status, message=None, metadata=None,
+               checksums=None):
+        """
+        Append the outcome of validating a file to the journal.
+
+        :param str filename: The path of the file that was validated
+        :param str status: Either PASSED or FAILED
+        :param str message: The reason that the file failed validation
+        :param dict metadata: Any JSON serialisable metadata from the file
+            that is needed when the run is resumed
+        :param dict checksums: The file's checksums keyed by algorithm
+        """
+        entry = {'filename': absolute_path(filename), 'status': status}
+        if message is not None:
+            entry['message'] = message
+        if metadata is not None:
+            entry['metadata'] = metadata
+        if checksums is not None:
+            entry['checksums'] = checksums
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        self._handle.write(line.encode('utf-8'))
+        self._unsynced += 1
+
+        if (self._unsynced >= self.sync_every or
+                time.time() - self._last_sync >= self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        """
+        Flush any buffered records and force them to be written to disk.
+        """
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        """
+        Sync any outstanding records and close the journal.
+        """
+        if not self._handle.closed:
+            self.sync()
+            self._handle.close()
+
+    def _terminate_partial_line(self):
+        """
+        If the previous run was killed part way through writing a record then
+        end the partial line so that new records start on a line of their own.
+        """
+        self._handle.seek(0, os.SEEK_END)
+        if self._handle.tell():
+            self._handle.seek(-1, os.SEEK_END)
+            if self._handle.read(1) != b'\n':
+                self._handle.write(b'\n')
+
+
+def read_journal(path):
+    """
+    Read the records from a journal written by a previous run. Lines that
+    cannot be decoded, for example because the run was killed while the line
+    was being written, are ignored. If a file appears more than once then the
+    last record for it is used.
+
+    :param str path: The path of the journal file
+    :returns: A dictionary of the records in the journal keyed by the
+        absolute path or s3:// URL of each file
+    """
+    records = {}
+
+    if not os.path.exists(path):
+        return records
+
+    with io.open(path, 'rb') as handle:
+        for line_num, line in enumerate(handle, start=1):
+            try:
+                entry = json.loads(line.decode('utf-8'))
+                records[entry['filename']] = entry
+            except (ValueError, KeyError, TypeError):
+                logger.debug('Ignoring unreadable line %s in journal %s',
+                             line_num, path)
+
+    return records
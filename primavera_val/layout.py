@@ -0,0 +1,301 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+Audit the chunking and compression of a file's data variable.
+
+Files that are chunked badly, for example with a chunk for every element or a
+single chunk spanning the whole time axis, pass the other checks but can make
+extracting data from them orders of magnitude slower. The cost of two typical
+ways of reading the data is estimated from the variable's layout:
+
+    map
+        all of the data at a single time
+    series
+        all of the times at a single point
+
+Each is described by the number of chunks read and the number of bytes that
+have to be decompressed, compared to the number of bytes that were wanted.
+A file fails the audit when any of these is outside its threshold.
+"""
+from __future__ import unicode_literals, division, absolute_import
+from collections import namedtuple
+import math
+import os
+
+import netCDF4
+import numpy as np
+
+from primavera_val.object_store import NetCDFObject, is_s3_url
+from primavera_val.zarr_store import ZarrStore, is_zarr_store
+
+
+# The thresholds that a file's layout is checked against. None disables a
+# threshold.
+DEFAULT_THRESHOLDS = {
+    # the smallest chunk, in uncompressed bytes, unless each chunk holds at
+    # least a whole map
+    'min_chunk_bytes': 16 * 1024,
+    # the largest chunk, in uncompressed bytes
+    'max_chunk_bytes': 512 * 1024 ** 2,
+    # the most chunks read to extract a map
+    'max_map_chunks': 1000,
+    # the most bytes decompressed for each byte wanted to extract a map
+    'max_map_amplification': 100.,
+    # the most chunks read to extract a time series
+    'max_series_chunks': 10000,
+    # the most bytes decompressed for each byte wanted to extract a time
+    # series. Disabled by default as CMOR chunks each time separately, which
+    # means that the whole file is read to extract a time series.
+    'max_series_amplification': None,
+}
+
+TIME_DIMENSION = 'time'
+
+# The layout of a variable. `chunks` is None for a contiguous variable and
+# `compression` is a list of descriptions of the filters and compressor.
+ChunkLayout = namedtuple('ChunkLayout', ['var_name', 'dimensions', 'shape',
+                                         'chunks', 'itemsize', 'compression'])
+
+# The estimated cost of reading part of a variable
+AccessCost = namedtuple('AccessCost', ['chunks', 'bytes_read',
+                                       'bytes_wanted'])
+
+
+def read_layout(filename, var_name=None):
+    """
+    Read the layout of a variable from a netCDF file, a Zarr store or a
+    netCDF file in S3. Only the header is read.
+
+    :param str filename: The path or s3:// URL of the file
+    :param str var_name: The name of the variable (default: the variable
+        named at the start of the filename)
+    :returns: The layout of the variable
+    :rtype: ChunkLayout
+    :raises KeyError: If the variable isn't in the file
+    """
+    if var_name is None:
+        var_name = os.path.basename(filename).split('_')[0]
+
+    if is_zarr_store(filename):
+        array = ZarrStore(filename).arrays[var_name]
+        compression = [codec['id'] for codec in array.filters]
+        if array.compressor:
+            compression.append(_describe_codec(array.compressor))
+        return ChunkLayout(var_name, tuple(array.dimensions), array.shape,
+                           array.chunks, array.dtype.itemsize, compression)
+
+    if is_s3_url(filename):
+        store = NetCDFObject(filename)
+        variable = store.variables[var_name]
+        compression = [name for name in ('shuffle', 'fletcher32')
+                       if getattr(variable, name)]
+        if variable.compression == 'gzip':
+            compression.append('zlib level {}'.format(
+                variable.compression_opts))
+        elif variable.compression:
+            compression.append(variable.compression)
+        return ChunkLayout(var_name, tuple(variable.dimensions),
+                           tuple(variable.shape),
+                           tuple(variable.chunks) if variable.chunks else
+                           None, np.dtype(variable.dtype).itemsize,
+                           compression)
+
+    with netCDF4.Dataset(filename) as dataset:
+        variable = dataset.variables[var_name]
+        chunking = variable.chunking()
+        filters = variable.filters() or {}
+        compression = [name for name in ('shuffle', 'fletcher32', 'szip',
+                                         'zstd', 'bzip2', 'blosc')
+                       if filters.get(name)]
+        if filters.get('zlib'):
+            compression.append('zlib level {}'.format(filters['complevel']))
+        return ChunkLayout(var_name, tuple(variable.dimensions),
+                           tuple(variable.shape),
+                           None if chunking in (None, 'contiguous') else
+                           tuple(chunking),
+                           np.dtype(variable.dtype).itemsize, compression)
+
+
+def effective_chunks(layout):
+    """
+    The shape of the blocks that the variable is read in. A contiguous
+    variable is treated as if each time is a separate chunk, as reading
+    contiguous values costs about the same however many there are.
+
+    :param ChunkLayout layout: The layout
+    :returns: The shape of a chunk
+    :rtype: tuple
+    """
+    if layout.chunks is not None:
+        return layout.chunks
+    time_axis = _time_axis(layout)
+    if time_axis is None:
+        return layout.shape
+    return tuple(1 if axis == time_axis else length
+                 for axis, length in enumerate(layout.shape))
+
+
+def chunk_bytes(layout):
+    """
+    :param ChunkLayout layout: The layout
+    :returns: The uncompressed size of a chunk in bytes
+    """
+    return _product(effective_chunks(layout)) * layout.itemsize
+
+
+def num_chunks(layout):
+    """
+    :param ChunkLayout layout: The layout
+    :returns: The number of chunks in the variable
+    """
+    return _product(_chunks_along(layout))
+
+
+def map_cost(layout):
+    """
+    Estimate the cost of reading all of the data at a single time, or the
+    whole variable if it has no time dimension.
+
+    :param ChunkLayout layout: The layout
+    :returns: The estimated cost
+    :rtype: AccessCost
+    """
+    time_axis = _time_axis(layout)
+    chunks = _product(count for axis, count in
+                      enumerate(_chunks_along(layout)) if axis != time_axis)
+    wanted = _product(length for axis, length in enumerate(layout.shape)
+                      if axis != time_axis) * layout.itemsize
+    return AccessCost(chunks, chunks * chunk_bytes(layout), wanted)
+
+
+def series_cost(layout):
+    """
+    Estimate the cost of reading all of the times at a single point.
+
+    :param ChunkLayout layout: The layout
+    :returns: The estimated cost, or None if the variable has no time
+        dimension
+    :rtype: AccessCost
+    """
+    time_axis = _time_axis(layout)
+    if time_axis is None:
+        return None
+    chunks = _chunks_along(layout)[time_axis]
+    return AccessCost(chunks, chunks * chunk_bytes(layout),
+                      layout.shape[time_axis] * layout.itemsize)
+
+
+def layout_problems(layout, thresholds=None):
+    """
+    Compare a variable's layout with the thresholds.
+
+    :param ChunkLayout layout: The layout
+    :param dict thresholds: Thresholds to use instead of those in
+        DEFAULT_THRESHOLDS
+    :returns: A description of each threshold that is exceeded
+    :rtype: list
+    :raises ValueError: If any of the thresholds aren't known
+    """
+    validate_thresholds(thresholds)
+    limits = dict(DEFAULT_THRESHOLDS)
+    limits.update(thresholds or {})
+
+    problems = []
+    size = chunk_bytes(layout)
+    if (_exceeds(limits['min_chunk_bytes'], size, below=True) and
+            map_cost(layout).chunks > 1):
+        problems.append('chunks of {} bytes are smaller than {}'.format(
+            size, limits['min_chunk_bytes']))
+    if (_exceeds(limits['max_chunk_bytes'], size) and
+            layout.chunks is not None):
+        problems.append('chunks of {} bytes are larger than {}'.format(
+            size, limits['max_chunk_bytes']))
+
+    for name, cost in [('map', map_cost(layout)),
+                       ('series', series_cost(layout))]:
+        if cost is None:
+            continue
+        if _exceeds(limits['max_{}_chunks'.format(name)], cost.chunks):
+            problems.append('reading a {} reads {} chunks, more than '
+                            '{}'.format(name, cost.chunks,
+                                        limits['max_{}_chunks'.format(name)]))
+        amplification = cost.bytes_read / max(cost.bytes_wanted, 1)
+        threshold = limits['max_{}_amplification'.format(name)]
+        if _exceeds(threshold, amplification):
+            problems.append('reading a {} decompresses {:.0f} times the '
+                            'bytes wanted, more than {}'.format(
+                                name, amplification, threshold))
+    return problems
+
+
+def validate_thresholds(thresholds):
+    """
+    Check that thresholds can be used by layout_problems().
+
+    :param dict thresholds: The thresholds
+    :raises ValueError: If any of the thresholds aren't known or aren't
+        numbers
+    """
+    if not thresholds:
+        return
+    unknown = set(thresholds) - set(DEFAULT_THRESHOLDS)
+    if unknown:
+        raise ValueError('Unknown layout thresholds: {}. Available '
+                         'thresholds are: {}'.format(
+                             ', '.join(sorted(unknown)),
+                             ', '.join(sorted(DEFAULT_THRESHOLDS))))
+    for name, value in thresholds.items():
+        if value is not None and not isinstance(value, (int, float)):
+            raise ValueError('Layout threshold {} must be a number: '
+                             '{}'.format(name, value))
+
+
+def describe_layout(layout):
+    """
+    :param ChunkLayout layout: The layout
+    :returns: A short description of the layout
+    :rtype: str
+    """
+    if layout.chunks is None:
+        description = 'contiguous'
+    else:
+        description = 'chunks {} of {}'.format(
+            'x'.join(str(length) for length in layout.chunks),
+            'x'.join(str(length) for length in layout.shape))
+    if layout.compression:
+        description += ', ' + ', '.join(layout.compression)
+    return description
+
+
+def _chunks_along(layout):
+    """
+    The number of chunks along each dimension.
+    """
+    return [int(math.ceil(length / chunk)) if chunk else 0
+            for length, chunk in zip(layout.shape, effective_chunks(layout))]
+
+
+def _time_axis(layout):
+    if TIME_DIMENSION in layout.dimensions:
+        return layout.dimensions.index(TIME_DIMENSION)
+    return None
+
+
+def _exceeds(threshold, value, below=False):
+    if threshold is None:
+        return False
+    return value < threshold if below else value > threshold
+
+
+def _describe_codec(codec):
+    level = codec.get('level', codec.get('clevel'))
+    if level is None:
+        return codec['id']
+    return '{} level {}'.format(codec['id'], level)
+
+
+def _product(values):
+    result = 1
+    for value in values:
+        result *= value
+    return result
@@ -0,0 +1,534 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+Validate netCDF files in S3-compatible object storage without downloading
+them.
+
+Files are given as s3://bucket/key URLs. Each file is read through a
+seekable file object that fetches byte ranges of the object on demand, so
+loading a file reads its header and the coordinate variables, and the data
+check reads the single chunk that its point is in, rather than the whole
+object. The object is fetched in blocks of BLOCK_SIZE bytes that are kept for
+the rest of the file's checks. Missing blocks that are needed at the same
+time are fetched together, with any that are less than MAX_GAP bytes apart
+coalesced into a single ranged GET, and the byte ranges of all of the
+coordinate variables are fetched in parallel before their values are read.
+
+Only netCDF-4 files can be read this way, as they are read with h5netcdf and
+h5py. The S3 client is shared by all of the threads in a process and keeps a
+pool of up to POOL_CONNECTIONS connections. Its endpoint, region and
+credentials are found by boto3 in the usual way, for example from the
+AWS_ENDPOINT_URL, AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environment
+variables when using MinIO or another S3-compatible store.
+
+Local netCDF-4 files are read in the same way, directly rather than through
+byte ranges, so that they too reuse the coordinates of the earlier files in
+their dataset (see primavera_val.templates).
+"""
+from __future__ import unicode_literals, division, absolute_import
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import json
+import os
+import threading
+
+try:
+    import boto3
+    import botocore.config
+    import botocore.exceptions
+    _S3_ERRORS = (botocore.exceptions.BotoCoreError,
+                  botocore.exceptions.ClientError)
+except ImportError:
+    boto3 = None
+    _S3_ERRORS = ()
+
+try:
+    import h5netcdf
+    import h5py
+except ImportError:
+    h5netcdf = None
+
+from primavera_val.templates import sample_ranges
+
+
+S3_SCHEME = 's3://'
+
+# The number of bytes fetched from an object at a time
+BLOCK_SIZE = 512 * 1024
+
+# Blocks that are needed at the same time and are less than this many bytes
+# apart are fetched in a single request, as reading the gap costs less than
+# another round trip
+MAX_GAP = 1024 ** 2
+
+# The maximum number of blocks kept for each object
+MAX_CACHED_BLOCKS = 256
+
+# The number of keys requested in each page when listing objects
+LIST_PAGE_SIZE = 1000
+
+# The maximum number of object sizes kept, which covers the listing of a
+# large submission without growing with every object ever opened
+MAX_CACHED_SIZES = 100000
+
+# The number of connections kept by the S3 client in each process, which is
+# also the number of byte ranges fetched at once
+POOL_CONNECTIONS = 16
+
+# The S3 client and the thread pool that fetches byte ranges, and the process
+# that created them
+_client = None
+_client_pid = None
+_fetchers = None
+_fetchers_pid = None
+
+# The sizes of the objects found when listing or opened, keyed by URL, with
+# the most recently used last
+_sizes = OrderedDict()
+
+
+def is_s3_url(path):
+    """
+    :param str path: The path to check
+    :returns: True if `path` is an s3:// URL
+    """
+    return path.startswith(S3_SCHEME)
+
+
+def split_url(url):
+    """
+    :param str url: An s3://bucket/key URL
+    :returns: A tuple of the bucket and key
+    :raises ValueError: If the URL has no bucket
+    """
+    bucket, _sep, key = url[len(S3_SCHEME):].partition('/')
+    if not is_s3_url(url) or not bucket:
+        raise ValueError('Not an s3://bucket/key URL: {}'.format(url))
+    return bucket, key
+
+
+def is_netcdf4_file(path):
+    """
+    :param str path: The path to check
+    :returns: True if `path` is a local netCDF-4 file and h5netcdf is
+        installed to read it
+    :rtype: bool
+    """
+    return (h5netcdf is not None and os.path.isfile(path) and
+            h5py.is_hdf5(path))
+
+
+def absolute_path(path):
+    """
+    :param str path: The path of a local file or an s3:// URL
+    :returns: The absolute path of a local file, or the URL unchanged
+    """
+    if is_s3_url(path):
+        return path
+    return os.path.abspath(path)
+
+
+def s3_client():
+    """
+    The S3 client used by all of the threads in this process. A new client
+    is created in each worker process as its connections can't be shared.
+
+    :raises ImportError: If boto3 isn't installed
+    """
+    global _client, _client_pid
+    if boto3 is None:
+        raise ImportError('boto3 is required to read files in object '
+                          'storage')
+    if _client is None or _client_pid != os.getpid():
+        _client = boto3.session.Session().client(
+            's3', config=botocore.config.Config(
+                max_pool_connections=POOL_CONNECTIONS,
+                retries={'mode': 'standard'}))
+        _client_pid = os.getpid()
+    return _client
+
+
+def list_objects(url, suffix='.nc'):
+    """
+    List the objects with the specified suffix below a prefix, a page at a
+    time. The sizes of the objects are kept so that they don't have to be
+    requested again.
+
+    :param str url: The s3://bucket/prefix URL to list
+    :param str suffix: The suffix of the objects of interest
+    :returns: A list of s3:// URLs
+    :raises IOError: If the objects can't be listed
+    """
+    bucket, prefix = split_url(url)
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    urls = []
+    try:
+        paginator = s3_client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(
+                Bucket=bucket, Prefix=prefix,
+                PaginationConfig={'PageSize': LIST_PAGE_SIZE}):
+            for item in page.get('Contents', []):
+                if item['Key'].endswith(suffix):
+                    object_url = '{}{}/{}'.format(S3_SCHEME, bucket,
+                                                  item['Key'])
+                    _remember_size(object_url, item['Size'])
+                    urls.append(object_url)
+    except _S3_ERRORS as exc:
+        raise IOError('Unable to list objects in {}: {}'.format(url, exc))
+    return urls
+
+
+def object_size(url):
+    """
+    :param str url: The s3:// URL of an object
+    :returns: The size of the object in bytes
+    :rtype: int
+    :raises IOError: If the object can't be found
+    """
+    size = _sizes.get(url)
+    if size is None:
+        bucket, key = split_url(url)
+        try:
+            response = s3_client().head_object(Bucket=bucket, Key=key)
+        except _S3_ERRORS as exc:
+            raise IOError('Unable to find object {}: {}'.format(url, exc))
+        size = response['ContentLength']
+    _remember_size(url, size)
+    return size
+
+
+def read_object(url, read_size):
+    """
+    Read the whole of an object sequentially.
+
+    :param str url: The s3:// URL of the object
+    :param int read_size: The number of bytes to read at a time
+    :returns: A generator of the blocks of bytes in the object
+    :raises IOError: If the object can't be read
+    """
+    bucket, key = split_url(url)
+    try:
+        body = s3_client().get_object(Bucket=bucket, Key=key)['Body']
+        for block in body.iter_chunks(read_size):
+            yield block
+    except _S3_ERRORS as exc:
+        raise IOError('Unable to read object {}: {}'.format(url, exc))
+
+
+def coalesce_ranges(ranges, max_gap=MAX_GAP):
+    """
+    Merge byte ranges that overlap or are less than `max_gap` bytes apart.
+
+    :param list ranges: Tuples of the start and stop of each range
+    :param int max_gap: Ranges that are closer than this are merged
+    :returns: The merged ranges in order
+    :rtype: list
+    """
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start - merged[-1][1] < max_gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+class S3File(io.RawIOBase):
+    """
+    A read-only, seekable file object for an object in S3 that fetches the
+    blocks of the object that are read and keeps the most recently used of
+    them.
+    """
+    def __init__(self, url, block_size=BLOCK_SIZE,
+                 max_blocks=MAX_CACHED_BLOCKS):
+        """
+        :param str url: The s3:// URL of the object
+        :param int block_size: The number of bytes fetched at a time
+        :param int max_blocks: The maximum number of blocks to keep
+        :raises IOError: If the object can't be found
+        """
+        super(S3File, self).__init__()
+        self.url = url
+        self.size = object_size(url)
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.requests = 0
+        self.bytes_fetched = 0
+        self._bucket, self._key = split_url(url)
+        self._position = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position {}'.format(offset))
+        self._position = offset
+        return self._position
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        start = self._position
+        stop = min(start + len(view), self.size)
+        if stop <= start:
+            return 0
+
+        first = start // self.block_size
+        blocks = self._get_blocks(range(first,
+                                        (stop - 1) // self.block_size + 1))
+        position = start
+        for index in sorted(blocks):
+            block = blocks[index]
+            offset = position - index * self.block_size
+            length = min(len(block) - offset, stop - position)
+            view[position - start:position - start + length] = \
+                block[offset:offset + length]
+            position += length
+        self._position = stop
+        return stop - start
+
+    def prefetch(self, ranges):
+        """
+        Fetch the blocks covering several byte ranges at once, so that they
+        don't have to be fetched one at a time as they are read.
+
+        :param list ranges: Tuples of the start and stop of each range
+        """
+        indices = set()
+        for start, stop in ranges:
+            if stop > start:
+                indices.update(range(start // self.block_size,
+                                     (min(stop, self.size) - 1) //
+                                     self.block_size + 1))
+        self._get_blocks(sorted(indices))
+
+    def _get_blocks(self, indices):
+        """
+        Find or fetch the blocks with the specified indices. The missing
+        blocks are fetched in as few requests as possible, in parallel.
+
+        :param list indices: The indices of the blocks
+        :returns: The contents of the blocks keyed by their indices
+        :rtype: dict
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            for index in indices:
+                if index in self._blocks:
+                    self._blocks.move_to_end(index)
+                    found[index] = self._blocks[index]
+                else:
+                    missing.append(index)
+        if not missing:
+            return found
+
+        ranges = coalesce_ranges(
+            [(index * self.block_size,
+              min((index + 1) * self.block_size, self.size))
+             for index in missing],
+            max(MAX_GAP, self.block_size))
+        if len(ranges) == 1:
+            contents = [self._fetch(ranges[0])]
+        else:
+            contents = list(_range_fetchers().map(self._fetch, ranges))
+
+        with self._lock:
+            for (start, stop), data in zip(ranges, contents):
+                for offset in range(start, stop, self.block_size):
+                    index = offset // self.block_size
+                    block = data[offset - start:
+                                 offset - start + self.block_size]
+                    found[index] = block
+                    self._blocks[index] = block
+                    self._blocks.move_to_end(index)
+            while len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+        return found
+
+    def _fetch(self, byte_range):
+        """
+        Fetch a single byte range of the object.
+        """
+        start, stop = byte_range
+        try:
+            response = s3_client().get_object(
+                Bucket=self._bucket, Key=self._key,
+                Range='bytes={}-{}'.format(start, stop - 1))
+            data = response['Body'].read()
+        except _S3_ERRORS as exc:
+            raise IOError('Unable to read bytes {}-{} of {}: {}'.format(
+                start, stop - 1, self.url, exc))
+        with self._lock:
+            self.requests += 1
+            self.bytes_fetched += len(data)
+        return data
+
+
+class NetCDFObject(object):
+    """
+    The variables and attributes of a netCDF-4 file in S3, read through
+    byte ranges, or of a local netCDF-4 file. Its `attributes`, `arrays` and
+    `read_arrays()` are like those of a primavera_val.zarr_store.ZarrStore
+    so that the same cubes can be made from it.
+    """
+    def __init__(self, url):
+        """
+        :param str url: The s3:// URL or the path of the file
+        :raises ImportError: If boto3 or h5netcdf isn't installed
+        :raises IOError: If the object can't be read
+        """
+        if h5netcdf is None:
+            raise ImportError('h5netcdf is required to read netCDF files in '
+                              'object storage')
+        self.url = url
+        # local files are read by HDF5 itself and so have no S3File
+        self.file = S3File(url) if is_s3_url(url) else None
+        self._h5file = h5py.File(self.file or url, 'r')
+        self._dataset = h5netcdf.File(self._h5file, 'r')
+        self.variables = self._dataset.variables
+        self.attributes = _attributes(self._dataset.attrs)
+        self.arrays = {name: _NetCDFArray(variable, self._dataset)
+                       for name, variable in self.variables.items()}
+
+    def read_arrays(self, names):
+        """
+        Read the whole of each of the variables, fetching the byte ranges
+        that they are stored in together first.
+
+        :param list names: The names of the variables
+        :returns: The values of the variables keyed by their names
+        :rtype: dict
+        """
+        ranges = []
+        for name in names:
+            ranges.extend(_byte_ranges(
+                self._h5file[self.variables[name].name]))
+        if self.file is not None:
+            self.file.prefetch(ranges)
+        return {name: self.arrays[name][...] for name in names}
+
+    def fingerprint_arrays(self, names):
+        """
+        Calculate a fingerprint of variables from their metadata, the sizes
+        of their stored chunks and samples of their first and last chunks,
+        without reading the whole of the variables.
+
+        :param list names: The names of the variables
+        :returns: The fingerprint
+        :rtype: str
+        """
+        sha = hashlib.sha256()
+        samples = []
+        for name in names:
+            array = self.arrays[name]
+            ranges = _byte_ranges(self._h5file[self.variables[name].name])
+            sha.update(json.dumps(
+                [name, array.shape, array.chunks, array.dtype.str,
+                 array.attributes, [stop - start for start, stop in ranges]],
+                sort_keys=True, default=repr).encode('utf-8'))
+            for start, stop in sorted(set(ranges[:1] + ranges[-1:])):
+                samples.extend((start + low, start + high) for low, high in
+                               sample_ranges(stop - start))
+        if self.file is not None:
+            self.file.prefetch(samples)
+            handle = self.file
+        else:
+            handle = open(self.url, 'rb')
+        try:
+            for start, stop in samples:
+                handle.seek(start)
+                sha.update(handle.read(stop - start))
+        finally:
+            if handle is not self.file:
+                handle.close()
+        return sha.hexdigest()
+
+
+class _NetCDFArray(object):
+    """
+    A netCDF variable with the same interface as a
+    primavera_val.zarr_store.ZarrArray.
+    """
+    def __init__(self, variable, dataset):
+        # h5netcdf variables only keep a weak reference to their dataset, so
+        # keep the dataset open for as long as the cube's lazy data needs it
+        self._dataset = dataset
+        self._variable = variable
+        self.shape = tuple(variable.shape)
+        self.dtype = variable.dtype
+        self.chunks = tuple(variable.chunks or self.shape)
+        self.dimensions = list(variable.dimensions)
+        self.attributes = _attributes(variable.attrs)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __getitem__(self, key):
+        return self._variable[key]
+
+
+def _attributes(attrs):
+    """
+    The attributes of a netCDF dataset or variable, with the text attributes
+    that are stored as fixed-length strings decoded.
+    """
+    return {key: value.decode('utf-8') if isinstance(value, bytes) else value
+            for key, value in attrs.items()}
+
+
+def _byte_ranges(dataset):
+    """
+    The byte ranges in the file that an HDF5 dataset's data is stored in.
+    Compact datasets are stored in the header and so have none.
+    """
+    dsid = dataset.id
+    offset = dsid.get_offset()
+    if offset is not None:
+        return [(offset, offset + dsid.get_storage_size())]
+    if dataset.chunks is None:
+        return []
+    ranges = []
+    for index in range(dsid.get_num_chunks()):
+        info = dsid.get_chunk_info(index)
+        ranges.append((info.byte_offset, info.byte_offset + info.size))
+    return ranges
+
+
+def _remember_size(url, size):
+    """
+    Keep the size of an object, forgetting the least recently used sizes
+    once MAX_CACHED_SIZES are kept.
+    """
+    _sizes[url] = size
+    _sizes.move_to_end(url)
+    while len(_sizes) > MAX_CACHED_SIZES:
+        _sizes.popitem(last=False)
+
+
+def _range_fetchers():
+    """
+    The thread pool that fetches byte ranges in this process. A new pool is
+    created in each worker process as threads don't survive a fork.
+    """
+    global _fetchers, _fetchers_pid
+    if _fetchers is None or _fetchers_pid != os.getpid():
+        _fetchers = ThreadPoolExecutor(POOL_CONNECTIONS)
+        _fetchers_pid = os.getpid()
+    return _fetchers
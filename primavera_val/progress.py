@@ -0,0 +1,227 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+Report the progress of a validation run while it's running.
+
+The outcome of every file is returned to the parent process however many
+workers the files are validated in, so the progress is counted there as each
+outcome arrives. On a terminal a single status line is redrawn in place a few
+times a second. Otherwise, for example in a batch job whose output goes to a
+file, a line is written at a fixed interval so that the output stays readable
+and small, from a background thread so that a line is still written while no
+files are finishing.
+
+The largest files are validated first, so the files per second rise through
+a run. The time remaining is therefore estimated from the bytes left to
+validate and the bytes per second when the sizes of the files are known.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import datetime
+import sys
+import threading
+import time
+
+from primavera_val.journal import FAILED
+from primavera_val.scheduling import file_cost
+
+
+# The minimum number of seconds between redrawing the status line on a
+# terminal
+LIVE_INTERVAL = 0.5
+
+# The default number of seconds between the lines written when the output
+# isn't a terminal
+DEFAULT_INTERVAL = 60.
+
+
+class ProgressReporter(object):
+    """
+    Count the files validated, the bytes in them and the number that failed,
+    and periodically display the throughput and the estimated time until the
+    run finishes.
+    """
+    def __init__(self, total, stream=None, interval=DEFAULT_INTERVAL,
+                 live=None, completed=0, failed=0, now=None,
+                 total_bytes=None):
+        """
+        :param int total: The number of files in the run, including any that
+            were validated by an earlier run
+        :param file stream: Where to write the progress (default: stderr)
+        :param float interval: The number of seconds between the lines
+            written when the progress isn't displayed live
+        :param bool live: Redraw a single status line in place (default: if
+            `stream` is a terminal)
+        :param int completed: The number of files already validated by an
+            earlier run, which aren't included in the throughput
+        :param int failed: The number of those files that failed
+        :param float now: The time that the run started (default: now)
+        :param int total_bytes: The total size of the files to validate in
+            this run, not including those validated by an earlier run
+            (default: estimate the time remaining from the files per second)
+        """
+        self.stream = sys.stderr if stream is None else stream
+        if live is None:
+            isatty = getattr(self.stream, 'isatty', None)
+            live = bool(isatty and isatty())
+        self.live = live
+        self.interval = LIVE_INTERVAL if live else interval
+        self.total = total
+        self.total_bytes = total_bytes
+        self.previously_completed = completed
+        self.num_files = 0
+        self.num_bytes = 0
+        self.num_failed = failed
+        self.start_time = time.time() if now is None else now
+        self._last_report = self.start_time
+        self._line_length = 0
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def completed(self):
+        """
+        The number of files validated, including those from an earlier run.
+        """
+        return self.previously_completed + self.num_files
+
+    def add(self, result, now=None):
+        """
+        Count the outcome of a file and display the progress if it's due.
+
+        :param dict result: The outcome in the format returned by
+            primavera_val.server.check_file()
+        :param float now: The current time (default: now)
+        """
+        now = time.time() if now is None else now
+        num_bytes = _result_size(result)
+        with self._lock:
+            self.num_files += 1
+            self.num_bytes += num_bytes
+            if result['status'] == FAILED:
+                self.num_failed += 1
+                if self.live:
+                    # the failure is about to be logged, so move the status
+                    # line out of its way and redraw it after the next file
+                    self.clear()
+                    self._last_report = now - self.interval
+                    return
+            if now - self._last_report >= self.interval:
+                self.report(now)
+
+    def start(self):
+        """
+        Start writing a line at each interval from a background thread, so
+        that the progress is reported even while no files finish, until
+        finish() is called. A live status line is only redrawn as files
+        finish, so that it doesn't get in the way of the failures logged.
+        """
+        if self.live or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._report_periodically,
+                                        name='ProgressReporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _report_periodically(self):
+        while True:
+            with self._lock:
+                wait = self._last_report + self.interval - time.time()
+                if wait <= 0.:
+                    self.report()
+                    wait = self.interval
+            if self._stopped.wait(wait):
+                return
+
+    def report(self, now=None):
+        """
+        Display the progress now.
+
+        :param float now: The current time (default: now)
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._last_report = now
+            line = self.status(now)
+            if self.live:
+                padding = ' ' * max(self._line_length - len(line), 0)
+                self.stream.write('\r' + line + padding)
+                self._line_length = len(line)
+            else:
+                self.stream.write('{} {}\n'.format(
+                    datetime.datetime.fromtimestamp(now).strftime(
+                        '%Y-%m-%d %H:%M:%S'), line))
+            self.stream.flush()
+
+    def clear(self):
+        """
+        Remove the status line from a terminal so that other output can be
+        written.
+        """
+        if self.live and self._line_length:
+            self.stream.write('\r' + ' ' * self._line_length + '\r')
+            self.stream.flush()
+            self._line_length = 0
+
+    def finish(self, now=None):
+        """
+        Display the final progress at the end of the run.
+
+        :param float now: The current time (default: now)
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.report(now)
+        if self.live:
+            self.stream.write('\n')
+            self.stream.flush()
+            self._line_length = 0
+
+    def status(self, now=None):
+        """
+        :param float now: The current time (default: now)
+        :returns: A description of the progress so far
+        :rtype: str
+        """
+        now = time.time() if now is None else now
+        elapsed = max(now - self.start_time, 0.)
+        files_rate = self.num_files / elapsed if elapsed else 0.
+        bytes_rate = self.num_bytes / elapsed if elapsed else 0.
+        percent = (100. * self.completed / self.total if self.total
+                   else 100.)
+        remaining = max(self.total - self.completed, 0)
+        remaining_bytes = (max(self.total_bytes - self.num_bytes, 0)
+                           if self.total_bytes is not None else 0)
+        if not remaining:
+            eta = '0:00:00'
+        elif remaining_bytes and bytes_rate:
+            eta = _format_duration(remaining_bytes / bytes_rate)
+        elif files_rate:
+            eta = _format_duration(remaining / files_rate)
+        else:
+            eta = 'unknown'
+        return ('{}/{} files ({:.1f}%), {:.2f} files/s, {:.1f} MB/s, {} '
+                'failed, elapsed {}, ETA {}'.format(
+                    self.completed, self.total, percent, files_rate,
+                    bytes_rate / 1024 ** 2, self.num_failed,
+                    _format_duration(elapsed), eta))
+
+
+def _result_size(result):
+    """
+    The size of the file that a result is for. Files that failed before
+    their metadata was found are measured on disk.
+    """
+    metadata = result.get('metadata')
+    if metadata is not None and metadata.get('filesize') is not None:
+        return metadata['filesize']
+    return file_cost(result['filename'])
+
+
+def _format_duration(seconds):
+    """
+    Format a number of seconds as hours, minutes and seconds.
+    """
+    return '{}'.format(datetime.timedelta(seconds=int(round(seconds))))
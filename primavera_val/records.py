@@ -0,0 +1,248 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+A compact record of the metadata identified from a single file.
+
+A run over a few million files keeps the metadata of every file that passed
+until the end of the run and sends it from the worker processes to the parent
+process. As a dictionary the metadata of a file takes over a kilobyte, so it
+is instead stored in a FileRecord, which has a fixed slot for each item. The
+strings that are shared between files, such as the model and experiment, are
+interned so that each is only stored once, and the start and end dates are
+stored as integers rather than PartialDateTime objects.
+
+A FileRecord can be read like a dictionary and converted to a dictionary with
+to_dict() when one is needed.
+"""
+from __future__ import unicode_literals, division, absolute_import
+
+from iris.time import PartialDateTime
+
+
+# The items of metadata that have a slot in a FileRecord, in the order that
+# they're stored
+RECORD_FIELDS = ['basename', 'directory', 'cmor_name', 'table',
+                 'climate_model', 'experiment', 'rip_code', 'grid',
+                 'start_date', 'end_date', 'filesize', 'frequency',
+                 'var_name', 'units', 'long_name', 'standard_name',
+                 'time_units', 'calendar', 'activity_id', 'institute']
+
+# The items that are stored as encoded dates
+DATE_FIELDS = ['start_date', 'end_date']
+
+# The items that are unique to each file and so aren't worth interning
+UNIQUE_FIELDS = ['basename']
+
+# The components of a PartialDateTime that are encoded, from the most
+# significant, and the number of decimal digits that each is given
+_DATE_COMPONENTS = [('year', 4), ('month', 2), ('day', 2), ('hour', 2),
+                    ('minute', 2), ('second', 2)]
+
+# The strings that have been interned, keyed by themselves
+_INTERNED = {}
+
+# Marks a slot that hasn't been set
+_UNSET = object()
+
+
+class FileRecord(object):
+    """
+    The metadata identified from a single file, stored compactly.
+
+    Items can be read with record['cmor_name'] or record.get('cmor_name')
+    like a dictionary. Items that don't have a slot are kept in a dictionary
+    of their own.
+    """
+    __slots__ = ['_' + field for field in RECORD_FIELDS] + ['_extra']
+
+    def __init__(self, metadata=None):
+        """
+        :param dict metadata: The metadata to store
+        """
+        self._extra = None
+        if metadata:
+            for key, value in metadata.items():
+                self[key] = value
+
+    @classmethod
+    def from_dict(cls, metadata):
+        """
+        Create a record from a dictionary, or return the metadata unchanged
+        if it's already a record.
+
+        :param metadata: A dictionary or FileRecord
+        :returns: A FileRecord
+        """
+        if isinstance(metadata, cls):
+            return metadata
+        return cls(metadata)
+
+    def to_dict(self):
+        """
+        :returns: A new dictionary of all of the items in the record, with
+            the dates as PartialDateTime objects
+        """
+        return {key: self[key] for key in self.keys()}
+
+    def keys(self):
+        """
+        :returns: A list of the names of the items in the record
+        """
+        names = [field for field in RECORD_FIELDS
+                 if getattr(self, _SLOTS[field], _UNSET) is not _UNSET]
+        if self._extra:
+            names.extend(self._extra)
+        return names
+
+    def items(self):
+        """
+        :returns: A list of (name, value) tuples of the items in the record
+        """
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        """
+        :param str key: The name of the item
+        :param default: The value to return if the item isn't in the record
+        :returns: The value of the item
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        if key in _SLOTS:
+            value = getattr(self, _SLOTS[key], _UNSET)
+            if value is _UNSET:
+                raise KeyError(key)
+            if key in DATE_FIELDS:
+                return decode_date(value)
+            return value
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _SLOTS:
+            if key in DATE_FIELDS:
+                value = encode_date(value)
+            elif key not in UNIQUE_FIELDS:
+                value = _intern(value)
+            setattr(self, _SLOTS[key], value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __eq__(self, other):
+        if isinstance(other, (FileRecord, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def update(self, metadata):
+        """
+        Add the items in a dictionary to the record.
+
+        :param dict metadata: The items to add
+        """
+        for key, value in metadata.items():
+            self[key] = value
+
+    def __repr__(self):
+        return 'FileRecord({!r})'.format(self.to_dict())
+
+    def __reduce__(self):
+        # pickle the stored values as a tuple, without the names of the slots,
+        # so that less is sent between processes
+        values = []
+        unset = []
+        for field in RECORD_FIELDS:
+            value = getattr(self, _SLOTS[field], _UNSET)
+            if value is _UNSET:
+                unset.append(field)
+                value = None
+            values.append(value)
+        return _restore_record, (tuple(values), tuple(unset), self._extra)
+
+
+_SLOTS = {field: '_' + field for field in RECORD_FIELDS}
+
+
+def encode_date(date):
+    """
+    Encode a PartialDateTime as a single integer. The components are stored
+    as decimal digits, YYYYMMDDhhmmss, followed by a final digit of the
+    number of components that are set, e.g. 1951-01 is 195101000000002.
+
+    :param iris.time.PartialDateTime date: The date to encode, or None
+    :returns: The encoded date, or None
+    :rtype: int
+    """
+    if date is None:
+        return None
+    code = 0
+    num_components = 0
+    for name, digits in _DATE_COMPONENTS:
+        value = getattr(date, name)
+        code = code * 10 ** digits + (value or 0)
+        if value is not None:
+            num_components += 1
+    return code * 10 + num_components
+
+
+def decode_date(code):
+    """
+    Decode a date encoded by encode_date().
+
+    :param int code: The encoded date, or None
+    :returns: The date, or None
+    :rtype: iris.time.PartialDateTime
+    """
+    if code is None:
+        return None
+    num_components = code % 10
+    code //= 10
+    values = {}
+    for name, digits in reversed(_DATE_COMPONENTS):
+        code, values[name] = divmod(code, 10 ** digits)
+    return PartialDateTime(**{name: values[name] for name, _digits in
+                              _DATE_COMPONENTS[:num_components]})
+
+
+def _intern(value):
+    """
+    Return a single shared copy of a string, or the value unchanged if it
+    isn't a string.
+    """
+    if isinstance(value, str):
+        return _INTERNED.setdefault(value, value)
+    return value
+
+
+def _restore_record(values, unset, extra):
+    """
+    Recreate a pickled FileRecord, interning its strings in this process.
+    """
+    record = FileRecord()
+    for field, value in zip(RECORD_FIELDS, values):
+        if field in unset:
+            continue
+        if field not in UNIQUE_FIELDS and field not in DATE_FIELDS:
+            value = _intern(value)
+        setattr(record, _SLOTS[field], value)
+    record._extra = extra
+    return record
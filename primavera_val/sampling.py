@@ -0,0 +1,237 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+Validate a stratified random sample of the files in an archive to quickly
+estimate the proportion of files that would pass a full validation.
+
+The files are grouped into strata by the climate model, experiment and table
+in their filenames, a random sample is drawn from each stratum in proportion
+to its size, and the pass rate of the whole archive is estimated with a
+confidence interval from the outcomes of the sampled files. When there are
+fewer samples than strata, the estimate only covers the files in the strata
+that were sampled.
+"""
+from __future__ import unicode_literals, division, absolute_import
+from collections import Counter
+import math
+import os
+import random
+import re
+
+
+# The filename components used to group files into strata
+STRATA_FIELDS = ['climate_model', 'experiment', 'table']
+
+# The position of each of the STRATA_FIELDS in a CMIP5 or CMIP6 filename
+_FIELD_INDICES = {'table': 1, 'climate_model': 2, 'experiment': 3}
+
+# The stratum used for files whose names can't be parsed
+UNKNOWN_STRATUM = ('unknown', 'unknown', 'unknown')
+
+# The standard normal quantile for a two-sided 95% confidence interval
+Z_95 = 1.959964
+
+
+class StratifiedSample(object):
+    """
+    A stratified random sample of files and the outcomes of validating them.
+    """
+    def __init__(self, filenames, size, file_format='CMIP6', seed=None):
+        """
+        :param list filenames: The paths of all of the files in the archive
+        :param size: Either the fraction (a float between 0 and 1) or the
+            number (an int) of files to sample
+        :param str file_format: The CMOR version of the netCDF files, one
+            out of- CMIP5 or CMIP6
+        :param int seed: The seed for the random number generator so that a
+            sample can be repeated
+        """
+        strata = {}
+        for filename in filenames:
+            strata.setdefault(_stratum(filename, file_format),
+                              []).append(filename)
+
+        if isinstance(size, float):
+            num_samples = int(math.ceil(size * len(filenames)))
+        else:
+            num_samples = size
+        num_samples = min(num_samples, len(filenames))
+
+        rng = random.Random(seed)
+        quotas = _allocate(num_samples, {stratum: len(files) for
+                                         stratum, files in strata.items()})
+
+        self.population = {}
+        self.files = []
+        self._stratum_of = {}
+        self._passed = Counter()
+        self._sampled = Counter()
+        self._failures = Counter()
+
+        for stratum in sorted(strata):
+            self.population[stratum] = len(strata[stratum])
+            for filename in rng.sample(strata[stratum], quotas[stratum]):
+                self.files.append(filename)
+                self._stratum_of[os.path.abspath(filename)] = stratum
+
+    def record(self, filename, passed, message=None):
+        """
+        Record the outcome of validating one of the sampled files.
+
+        :param str filename: The path of the file
+        :param bool passed: True if the file passed validation
+        :param str message: The reason that the file failed validation
+        """
+        stratum = self._stratum_of[os.path.abspath(filename)]
+        self._sampled[stratum] += 1
+        if passed:
+            self._passed[stratum] += 1
+        else:
+            self._failures[_generalise_message(message or '', filename)] += 1
+
+    @property
+    def num_sampled(self):
+        return sum(self._sampled.values())
+
+    @property
+    def num_passed(self):
+        return sum(self._passed.values())
+
+    @property
+    def num_covered(self):
+        """
+        The number of files in the strata that have had files validated,
+        which the estimated pass rate applies to.
+        """
+        return sum(self.population[stratum] for stratum in self._sampled)
+
+    def pass_rate(self):
+        """
+        Estimate the proportion of files that would pass validation, with a
+        95% confidence interval. The estimate covers the files in the strata
+        that have had files validated, which is the whole archive when every
+        stratum has been sampled, and `num_covered` gives the number of them.
+
+        The stratified estimate is the mean of the pass rates in each stratum
+        weighted by the stratum's size. The interval is a Wilson score
+        interval using the effective sample size of the stratified estimate,
+        which remains sensible when every sampled file passes.
+
+        :returns: A tuple of the estimated pass rate and the lower and upper
+            bounds of the confidence interval, or None if no files have been
+            validated
+        """
+        population = self.num_covered
+        if not population:
+            return None
+
+        rate = 0.
+        variance = 0.
+        for stratum, num_sampled in self._sampled.items():
+            weight = self.population[stratum] / population
+            stratum_rate = self._passed[stratum] / num_sampled
+            rate += weight * stratum_rate
+            if num_sampled > 1:
+                correction = 1. - num_sampled / self.population[stratum]
+                variance += (weight ** 2 * correction * stratum_rate *
+                             (1. - stratum_rate) / (num_sampled - 1))
+
+        if variance > 0.:
+            effective_size = min(rate * (1. - rate) / variance,
+                                 population)
+        else:
+            effective_size = self.num_sampled
+
+        lower, upper = _wilson_interval(rate, effective_size)
+        return rate, lower, upper
+
+    def common_failures(self, number=5):
+        """
+        The most common reasons for sampled files failing validation.
+
+        :param int number: The maximum number of reasons to return
+        :returns: A list of tuples of the generalised message and the number
+            of sampled files that failed with it
+        """
+        return self._failures.most_common(number)
+
+
+def _stratum(filename, file_format):
+    """
+    Identify the stratum that a file belongs to from its name alone, without
+    accessing the file. CMIP5 and CMIP6 filenames have the table, model and
+    experiment in the same positions.
+    """
+    if file_format not in ('CMIP5', 'CMIP6'):
+        raise NotImplementedError('file_format must be CMIP5 or CMIP6')
+    stem = os.path.basename(filename.rstrip('/')).rpartition('.')[0]
+    sections = stem.split('_')
+    if len(sections) < 5:
+        return UNKNOWN_STRATUM
+    # as in identify_filename_metadata(), the experiment present_day is split
+    # in two in pre-PRIMAVERA data
+    if sections[3] == 'present' and sections[4] == 'day':
+        sections[3] += '_' + sections.pop(4)
+    return tuple(sections[_FIELD_INDICES[field]] for field in STRATA_FIELDS)
+
+
+def _allocate(num_samples, sizes):
+    """
+    Share the samples between the strata in proportion to their sizes, using
+    the largest remainder method, and make sure that every stratum is sampled
+    at least once when there are enough samples to do so.
+
+    :param int num_samples: The total number of samples
+    :param dict sizes: The number of files in each stratum
+    :returns: A dictionary of the number of files to sample from each stratum
+    """
+    total = sum(sizes.values())
+    if not total:
+        return {}
+
+    exact = {stratum: num_samples * size / total
+             for stratum, size in sizes.items()}
+    quotas = {stratum: int(math.floor(value))
+              for stratum, value in exact.items()}
+    by_remainder = sorted(sizes, key=lambda stratum:
+                          (quotas[stratum] - exact[stratum], stratum))
+    for stratum in by_remainder[:num_samples - sum(quotas.values())]:
+        quotas[stratum] += 1
+
+    if num_samples >= len(sizes):
+        for stratum in sorted(sizes):
+            if quotas[stratum] == 0:
+                donor = max(sorted(quotas), key=lambda name: quotas[name])
+                quotas[donor] -= 1
+                quotas[stratum] = 1
+
+    return quotas
+
+
+def _generalise_message(message, filename):
+    """
+    Remove the details that are specific to a single file from a validation
+    failure message so that the same failure in different files can be
+    counted together.
+    """
+    message = message.replace(filename, '<file>')
+    message = message.replace(os.path.basename(filename), '<file>')
+    message = re.sub(r'\(.*?\)', '(...)', message)
+    return message.splitlines()[0] if message else message
+
+
+def _wilson_interval(rate, sample_size, z=Z_95):
+    """
+    Calculate the Wilson score interval of a proportion.
+
+    :param float rate: The observed proportion
+    :param float sample_size: The (effective) number of observations
+    :param float z: The standard normal quantile of the desired confidence
+    :returns: A tuple of the lower and upper bounds of the interval
+    """
+    denominator = 1. + z ** 2 / sample_size
+    centre = (rate + z ** 2 / (2. * sample_size)) / denominator
+    half_width = (z * math.sqrt(rate * (1. - rate) / sample_size +
+                                z ** 2 / (4. * sample_size ** 2)) /
+                  denominator)
+    return max(0., centre - half_width), min(1., centre + half_width)
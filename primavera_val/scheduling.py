@@ -0,0 +1,605 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+Schedule the validation of files across a pool of worker processes.
+
+The time taken to validate a file grows with its size and the files in a
+submission range from kilobytes to tens of gigabytes. If the files are handed
+out in directory order then a run can end with one worker validating a few
+huge files while the others are idle. Instead the files are handed out
+largest first (longest processing time first scheduling), one at a time, so
+that the small files fill in the gaps at the end of the run.
+
+The best number of workers depends on whether a run is limited by the latency
+of the filesystem's metadata, its bandwidth or the CPU, so the number of
+workers can also be tuned automatically while the files are validated by
+measuring the throughput achieved with each number of workers.
+
+When a submission spans several filesystems, the files can be grouped by the
+filesystem that they are on and each group given its own limits on the number
+of files validated at once and the rate at which bytes are read, so that a
+slow filesystem isn't overloaded while the workers are busy on the others.
+Most checks read only a file's header and coordinates and a sample of its
+data, so the bytes read from a file are estimated from the checks being run
+rather than taken to be its size.
+
+The files are validated in worker processes by default, or in any of the
+executors in primavera_val.executors. Only a few more files than there are
+workers are submitted at a time, so that the order the files are started in
+is kept and the results are streamed back as they complete.
+"""
+from __future__ import unicode_literals, division, absolute_import
+from collections import namedtuple
+import heapq
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import time
+
+from primavera_val.executors import ProcessExecutor
+from primavera_val.object_store import (S3_SCHEME, absolute_path, is_s3_url,
+                                        object_size, split_url)
+from primavera_val.zarr_store import store_size
+
+
+# The relative change in throughput that is treated as an improvement or
+# a degradation rather than noise
+THROUGHPUT_TOLERANCE = 0.05
+
+logger = logging.getLogger(__name__)
+
+# The maximum number of files from a group of files on the same storage to
+# validate at once and the maximum rate in bytes per second at which to start
+# validating them. None means no limit.
+GroupLimits = namedtuple('GroupLimits', ['jobs', 'bandwidth'])
+
+NO_LIMITS = GroupLimits(None, None)
+
+# The estimated number of bytes read from a file by the checks that don't
+# read the whole of it: its header and coordinate variables, and the chunk
+# that the data check samples a point from
+HEADER_BYTES = 1024 ** 2
+SAMPLE_BYTES = 4 * 1024 ** 2
+
+
+class ThroughputTuner(object):
+    """
+    Choose the number of files to validate concurrently by hill-climbing on
+    the measured throughput.
+
+    The throughput is measured over a window of completed files. The number
+    of workers is increased one at a time while the throughput keeps
+    improving. When it stops improving the tuner settles on the best number
+    found, backing off half way if the throughput fell, and every few windows
+    it probes one more worker in case the conditions have changed.
+
+    Because the largest files are validated first, the files per second rise
+    and the bytes per second fall as a run progresses. The throughput of two
+    windows is therefore compared using the geometric mean of the ratios of
+    both rates, which is less biased by the changing mix of file sizes.
+    """
+    def __init__(self, max_jobs, initial_jobs=2, min_window_files=4,
+                 min_window_seconds=1., probe_every=10,
+                 tolerance=THROUGHPUT_TOLERANCE):
+        """
+        :param int max_jobs: The maximum number of concurrent files
+        :param int initial_jobs: The number of concurrent files to start with
+        :param int min_window_files: The minimum number of files to measure
+            the throughput over. The window is also at least twice the number
+            of concurrent files.
+        :param float min_window_seconds: The minimum time to measure the
+            throughput over
+        :param int probe_every: The number of windows after settling before
+            trying one more concurrent file
+        :param float tolerance: The relative change in throughput treated as
+            noise
+        """
+        self.max_jobs = max_jobs
+        self.jobs = max(1, min(initial_jobs, max_jobs))
+        self.min_window_files = min_window_files
+        self.min_window_seconds = min_window_seconds
+        self.probe_every = probe_every
+        self.tolerance = tolerance
+        self.settled = False
+
+        self._previous = None
+        self._windows_settled = 0
+        self._start_window(time.time())
+
+    def record(self, num_bytes, now=None):
+        """
+        Record that a file has finished validating and adjust the number of
+        concurrent files at the end of each window.
+
+        :param int num_bytes: The size of the file
+        :param float now: The time that the file finished (default: now)
+        :returns: The number of files to validate concurrently
+        """
+        now = time.time() if now is None else now
+        self._files += 1
+        self._bytes += num_bytes
+
+        elapsed = now - self._window_start
+        if (self._files >= max(self.min_window_files, 2 * self.jobs) and
+                elapsed >= self.min_window_seconds):
+            self._adjust(self._files / elapsed, self._bytes / elapsed)
+            self._start_window(now)
+
+        return self.jobs
+
+    def _start_window(self, now):
+        self._window_start = now
+        self._files = 0
+        self._bytes = 0
+
+    def _adjust(self, files_rate, bytes_rate):
+        """
+        Choose the number of concurrent files for the next window from the
+        throughput measured in the window that has just finished.
+        """
+        current = (self.jobs, files_rate, bytes_rate)
+        previous = self._previous
+
+        if self.settled:
+            self._windows_settled += 1
+            if (self._windows_settled >= self.probe_every and
+                    self.jobs < self.max_jobs):
+                self.settled = False
+                self._change(self.jobs + 1, 'probing for higher throughput',
+                             current)
+            else:
+                self._previous = current
+            return
+
+        if previous is None:
+            if self.jobs < self.max_jobs:
+                self._change(self.jobs + 1, 'measuring the effect of more '
+                             'workers', current)
+            else:
+                self._settle(current, 'the maximum has been reached')
+            return
+
+        score = _throughput_ratio(current, previous)
+        if score > 1. + self.tolerance:
+            if self.jobs < self.max_jobs:
+                self._change(self.jobs + 1, 'throughput improved by '
+                             '{:.0%}'.format(score - 1.), current)
+            else:
+                self._settle(current, 'the maximum has been reached')
+        elif score < 1. - self.tolerance:
+            # back off to half way between the previous number, which was
+            # better, and this one
+            better = previous[0]
+            self._change(better + (self.jobs - better) // 2,
+                         'throughput fell by {:.0%}'.format(1. - score),
+                         current)
+            self._settle(previous, 'throughput stopped improving')
+        else:
+            self._settle(current, 'throughput stopped improving')
+
+    def _change(self, jobs, reason, measured):
+        logger.info('Changing from %s to %s concurrent files (%s): %.2f '
+                    'files/s and %.1f MB/s measured with %s', self.jobs,
+                    jobs, reason, measured[1], measured[2] / 1024 ** 2,
+                    measured[0])
+        self._previous = measured
+        self.jobs = jobs
+
+    def _settle(self, measured, reason):
+        logger.info('Settled on %s concurrent files (%s): %.2f files/s, '
+                    '%.1f MB/s', self.jobs, reason, measured[1],
+                    measured[2] / 1024 ** 2)
+        self.settled = True
+        self._windows_settled = 0
+        self._previous = measured
+
+
+def file_cost(filename):
+    """
+    Estimate the relative cost of validating a file from its size.
+
+    :param str filename: The path of the file or Zarr store, or the s3:// URL
+        of the file
+    :returns: The size of the file in bytes, or zero if it can't be found
+    :rtype: int
+    """
+    try:
+        if is_s3_url(filename):
+            return object_size(filename)
+        if os.path.isdir(filename):
+            return store_size(filename)
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def estimate_bytes_read(size, whole_file=False):
+    """
+    Estimate the number of bytes that validating a file reads from it.
+
+    :param int size: The size of the file in bytes
+    :param bool whole_file: True if a check that reads the whole of the
+        file, like the checksum check, is run
+    :returns: The estimated number of bytes read
+    :rtype: int
+    """
+    if whole_file:
+        return size
+    return min(size, HEADER_BYTES + SAMPLE_BYTES)
+
+
+def order_longest_first(filenames, costs=None):
+    """
+    Sort files so that the most expensive files are validated first. Files
+    with the same cost keep their original order.
+
+    :param list filenames: The paths of the files
+    :param dict costs: The cost of each file (default: the size of each file)
+    :returns: A new list of the paths sorted by decreasing cost
+    """
+    if costs is None:
+        costs = {filename: file_cost(filename) for filename in filenames}
+    return sorted(filenames, key=lambda filename: -costs[filename])
+
+
+def estimate_makespan(costs, workers):
+    """
+    Calculate how long a set of tasks takes when each task is given, in
+    order, to the next worker to become free.
+
+    :param list costs: The cost of each task in the order they are given out
+    :param int workers: The number of workers
+    :returns: The total time taken, in the same units as `costs`
+    """
+    finish_times = [0] * max(min(workers, len(costs)), 1)
+    for cost in costs:
+        heapq.heapreplace(finish_times, finish_times[0] + cost)
+    return max(finish_times)
+
+
+def run_files(function, filenames, jobs, costs=None, executor=None):
+    """
+    Apply `function` to each file in a pool of worker processes, starting
+    with the most expensive files, and yield the results as they complete.
+
+    :param function: A picklable function that takes the path of a file
+    :param list filenames: The paths of the files
+    :param int jobs: The number of worker processes, if `executor` isn't
+        given
+    :param dict costs: The cost of each file (default: the size of each file)
+    :param primavera_val.executors.Executor executor: The executor to
+        validate the files in, which is left running (default: a pool of
+        `jobs` worker processes)
+    :returns: A generator of the results of `function`, in the order that
+        they complete
+    """
+    ordered = order_longest_first(filenames, costs)
+    owned = executor is None
+    if owned:
+        executor = ProcessExecutor(jobs)
+    logger.debug('Validating %s files with %s', len(ordered), executor)
+
+    completed = queue.Queue()
+    pending = iter(ordered)
+    in_flight = 0
+    try:
+        while True:
+            # only a few more files than workers are submitted, so each
+            # worker takes the next largest file as soon as it is free
+            while in_flight < executor.capacity:
+                filename = next(pending, None)
+                if filename is None:
+                    break
+                executor.submit(function, filename, completed)
+                in_flight += 1
+
+            if not in_flight:
+                break
+
+            _filename, result, error = completed.get()
+            in_flight -= 1
+            if error is not None:
+                raise error
+            yield result
+    finally:
+        if owned:
+            executor.shutdown()
+
+
+def run_files_adaptive(function, filenames, max_jobs=None, costs=None,
+                       tuner=None, executor=None):
+    """
+    Apply `function` to each file in a pool of worker processes, starting
+    with the most expensive files, and yield the results as they complete.
+    The number of files validated at once is tuned automatically from the
+    measured throughput.
+
+    :param function: A picklable function that takes the path of a file
+    :param list filenames: The paths of the files
+    :param int max_jobs: The maximum number of worker processes (default:
+        the number of workers in `executor`, or twice the number of CPUs)
+    :param dict costs: The cost of each file in bytes (default: the size of
+        each file)
+    :param ThroughputTuner tuner: The tuner that chooses the number of
+        concurrent files (default: a tuner that starts with two)
+    :param primavera_val.executors.Executor executor: The executor to
+        validate the files in, which is left running (default: a pool of up
+        to `max_jobs` worker processes, which are started as the tuner
+        increases the number of concurrent files)
+    :returns: A generator of the results of `function`, in the order that
+        they complete
+    """
+    if costs is None:
+        costs = {filename: file_cost(filename) for filename in filenames}
+    ordered = order_longest_first(filenames, costs)
+    if not max_jobs:
+        max_jobs = (executor.workers if executor else
+                    2 * multiprocessing.cpu_count())
+    tuner = tuner or ThroughputTuner(max_jobs)
+
+    completed = queue.Queue()
+    pending = iter(ordered)
+    in_flight = 0
+
+    owned = executor is None
+    if owned:
+        executor = ProcessExecutor(max_jobs, initial_workers=tuner.jobs)
+    try:
+        while True:
+            while in_flight < tuner.jobs:
+                filename = next(pending, None)
+                if filename is None:
+                    break
+                executor.submit(function, filename, completed)
+                in_flight += 1
+
+            if not in_flight:
+                break
+
+            filename, result, error = completed.get()
+            in_flight -= 1
+            if error is not None:
+                raise error
+            tuner.record(costs[filename])
+            yield result
+
+        logger.info('Finished with %s concurrent files', tuner.jobs)
+    finally:
+        if owned:
+            executor.shutdown()
+
+
+def storage_group(filename, prefixes=()):
+    """
+    Identify the storage that a file is on: the longest of `prefixes` that
+    contains the file or otherwise the device that the file is on, or the
+    bucket for a file in S3.
+
+    :param str filename: The path or s3:// URL of the file
+    :param list prefixes: Directories or s3:// prefixes that should each be
+        treated as a separate group of storage
+    :returns: The matching prefix, the device number, the s3://bucket URL or
+        None if the file can't be found
+    """
+    path = absolute_path(filename)
+    for prefix in sorted(prefixes, key=len, reverse=True):
+        directory = absolute_path(prefix)
+        if path == directory or path.startswith(os.path.join(directory, '')):
+            return prefix
+    if is_s3_url(path):
+        return S3_SCHEME + split_url(path)[0]
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+class GroupScheduler(object):
+    """
+    Choose the next file to validate so that the files being validated are
+    interleaved across groups of storage without exceeding any group's
+    limits.
+
+    Within each group the files are validated largest first. The groups take
+    turns to start a file, skipping any group that has reached its limit on
+    concurrent files or whose bandwidth limit means that its next file can't
+    be started yet. A group's bandwidth is limited by spacing out the start
+    of each file by the time that the bytes estimated to be read from it
+    take at that bandwidth.
+    """
+    def __init__(self, filenames, groups, costs, limits=None,
+                 default_limits=NO_LIMITS, whole_file=False):
+        """
+        :param list filenames: The paths of the files
+        :param dict groups: The group of each file
+        :param dict costs: The size of each file in bytes
+        :param dict limits: The GroupLimits of each group
+        :param GroupLimits default_limits: The limits of the groups not in
+            `limits`, or whose limits are None
+        :param bool whole_file: True if the whole of each file is read, for
+            example by the checksum check
+        """
+        self.costs = costs
+        self.whole_file = whole_file
+        self._groups = groups
+        self._limits = limits or {}
+        self._default_limits = default_limits
+
+        self._pending = {}
+        for filename in order_longest_first(filenames, costs):
+            self._pending.setdefault(groups[filename], []).append(filename)
+        for group_files in self._pending.values():
+            group_files.reverse()
+        self._order = list(self._pending)
+        self._next_group = 0
+        self._in_flight = {group: 0 for group in self._order}
+        self._next_start = {group: 0. for group in self._order}
+
+    def __len__(self):
+        """
+        :returns: The number of files not yet started
+        """
+        return sum(len(group_files) for group_files in self._pending.values())
+
+    @property
+    def group_sizes(self):
+        """
+        :returns: The number of files not yet started in each group
+        """
+        return {group: len(group_files)
+                for group, group_files in self._pending.items()}
+
+    def limits(self, group):
+        """
+        :param group: The group
+        :returns: The GroupLimits of the group
+        """
+        return self._limits.get(group) or self._default_limits
+
+    def next_file(self, now=None):
+        """
+        Start the next file, taking the groups in turn.
+
+        :param float now: The current time (default: now)
+        :returns: The path of the file, or None if no file can be started
+            now
+        """
+        now = time.time() if now is None else now
+        for offset in range(len(self._order)):
+            index = (self._next_group + offset) % len(self._order)
+            group = self._order[index]
+            if self._can_start(group, now):
+                self._next_group = index + 1
+                return self._start(group, now)
+        return None
+
+    def wait_time(self, now=None):
+        """
+        :param float now: The current time (default: now)
+        :returns: The time in seconds until a group that is only held back by
+            its bandwidth limit can start a file, or None if there is no such
+            group
+        """
+        now = time.time() if now is None else now
+        waits = [self._next_start[group] - now for group in self._order
+                 if self._pending[group] and self._below_jobs_limit(group)]
+        return max(min(waits), 0.) if waits else None
+
+    def finished(self, filename):
+        """
+        Record that a file has finished validating.
+
+        :param str filename: The path of the file
+        """
+        self._in_flight[self._groups[filename]] -= 1
+
+    def _below_jobs_limit(self, group):
+        jobs = self.limits(group).jobs
+        return jobs is None or self._in_flight[group] < jobs
+
+    def _can_start(self, group, now):
+        return (bool(self._pending[group]) and
+                self._below_jobs_limit(group) and
+                now >= self._next_start[group])
+
+    def _start(self, group, now):
+        filename = self._pending[group].pop()
+        self._in_flight[group] += 1
+        bandwidth = self.limits(group).bandwidth
+        if bandwidth:
+            num_bytes = estimate_bytes_read(self.costs[filename],
+                                            self.whole_file)
+            self._next_start[group] = (max(now, self._next_start[group]) +
+                                       num_bytes / bandwidth)
+        return filename
+
+
+def run_files_grouped(function, filenames, jobs, groups=None, limits=None,
+                      default_limits=NO_LIMITS, costs=None, executor=None,
+                      whole_file=False):
+    """
+    Apply `function` to each file in a pool of worker processes, interleaving
+    the files across groups of storage and keeping within each group's limits,
+    and yield the results as they complete.
+
+    :param function: A picklable function that takes the path of a file
+    :param list filenames: The paths of the files
+    :param int jobs: The maximum number of files to validate at once
+    :param dict groups: The group of each file (default: the device that
+        each file is on)
+    :param dict limits: The GroupLimits of each group
+    :param GroupLimits default_limits: The limits of the groups not in
+        `limits`
+    :param dict costs: The cost of each file in bytes (default: the size of
+        each file)
+    :param primavera_val.executors.Executor executor: The executor to
+        validate the files in, which is left running (default: a pool of
+        `jobs` worker processes)
+    :param bool whole_file: True if `function` reads the whole of each
+        file, so that the bandwidth limits are applied to the file sizes
+    :returns: A generator of the results of `function`, in the order that
+        they complete
+    """
+    if costs is None:
+        costs = {filename: file_cost(filename) for filename in filenames}
+    if groups is None:
+        groups = {filename: storage_group(filename) for filename in filenames}
+    scheduler = GroupScheduler(filenames, groups, costs, limits,
+                               default_limits, whole_file)
+    for group, size in scheduler.group_sizes.items():
+        logger.debug('%s files in storage group %s limited to %s', size,
+                     group, scheduler.limits(group))
+
+    completed = queue.Queue()
+    in_flight = 0
+
+    owned = executor is None
+    if owned:
+        executor = ProcessExecutor(jobs)
+    try:
+        while True:
+            while in_flight < jobs:
+                filename = scheduler.next_file()
+                if filename is None:
+                    break
+                executor.submit(function, filename, completed)
+                in_flight += 1
+
+            if not in_flight and not len(scheduler):
+                break
+
+            # wake up when a group held back by its bandwidth can start
+            timeout = scheduler.wait_time() if in_flight < jobs else None
+            try:
+                filename, result, error = completed.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            in_flight -= 1
+            scheduler.finished(filename)
+            if error is not None:
+                raise error
+            yield result
+    finally:
+        if owned:
+            executor.shutdown()
+
+
+def _throughput_ratio(current, previous):
+    """
+    Compare the throughput in two windows.
+
+    :param tuple current: The number of concurrent files, files per second
+        and bytes per second in the latest window
+    :param tuple previous: The same for the window to compare with
+    :returns: The geometric mean of the ratios of the files per second and of
+        the bytes per second, or just the ratio of the files per second if no
+        bytes were read
+    """
+    if not previous[1]:
+        return float('inf') if current[1] else 1.
+    files_ratio = current[1] / previous[1]
+    if not (current[2] and previous[2]):
+        return files_ratio
+    return math.sqrt(files_ratio * current[2] / previous[2])
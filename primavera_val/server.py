@@ -0,0 +1,337 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+A long-running validation server that keeps a pool of warm worker processes
+behind a Unix domain socket, and a client to send files to it.
+
+Starting Python, importing Iris and initialising the netCDF and HDF5
+libraries takes longer than validating a typical file, so when files are
+validated one at a time as they arrive, the server avoids paying that cost for
+every file. Each worker also keeps the outcomes of the identical cell
+measures and fixed fields that it has checked, when asked to with "dedupe",
+from one request to the next. The workers can be given a memory budget and a
+maximum number of files, after which they are replaced by new warm workers.
+
+The protocol is one JSON object per line. The client sends a single request:
+
+    {"paths": [...], "file_format": "CMIP6", "cell_measure": false,
+     "checks": ["contents", "times"],
+     "options": {"layout": {"max_map_chunks": 100},
+                 "checksum": {"algorithms": ["sha256", "md5"]}},
+     "dedupe": false}
+
+where all but "paths" are optional and all of the default checks are run if
+"checks" is not given. The server replies with one line for each file, in the
+order that the files finish validating, where "checksums" is only included
+when the checksum check is run:
+
+    {"filename": ..., "status": "passed", "metadata": {...},
+     "checksums": {...}}
+    {"filename": ..., "status": "failed", "message": ...}
+
+followed by a final line of {"done": true}. If a file cannot be validated,
+for example because its worker process failed, then its line is
+{"filename": ..., "error": ...} and the other files carry on. If the request
+cannot be processed then a single line of {"error": ...} is sent instead. The
+largest files in a request are validated first.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import errno
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import socketserver
+import stat
+
+from primavera_val import validate_file, select_checks, FileValidationError
+from primavera_val.consistency import consistency_metadata
+from primavera_val.journal import PASSED, FAILED
+from primavera_val.checksums import validate_algorithms
+from primavera_val.executors import ProcessExecutor
+from primavera_val.layout import validate_thresholds
+from primavera_val.object_store import absolute_path
+from primavera_val.scheduling import order_longest_first
+from primavera_val.workers import NO_WORKER_LIMITS
+
+
+logger = logging.getLogger(__name__)
+
+
+class ValidationServerError(Exception):
+    """
+    An exception to indicate that the validation server could not process a
+    request.
+    """
+    pass
+
+
+def check_file(filename, file_format='CMIP6', cell_measure=False,
+               checks=None, options=None, dedupe=False):
+    """
+    Validate a single file and return its outcome rather than raising an
+    exception, so that the outcome can be sent between processes.
+
+    :param str filename: The file's complete path
+    :param str file_format: The CMOR version of the netCDF files, one out of-
+        CMIP5 or CMIP6
+    :param bool cell_measure: True if the file contains a cell measure
+    :param list checks: The names of the checks to run (default: all of the
+        checks that are run by default)
+    :param dict options: Dictionaries of keyword arguments for the checks,
+        keyed by the name of the check
+    :param bool dedupe: Reuse the outcome of checking an identical cell
+        measure or fixed field
+    :returns: A dictionary containing the filename, the status and either the
+        file's metadata as a FileRecord or the reason that the file failed,
+        and the file's checksums if they were calculated
+    """
+    try:
+        metadata = validate_file(filename, file_format, cell_measure, checks,
+                                 options, dedupe)
+    except FileValidationError as exc:
+        return failed_result(filename, exc.__str__())
+    else:
+        result = {'filename': filename, 'status': PASSED,
+                  'metadata': metadata}
+        if 'checksums' in metadata:
+            result['checksums'] = metadata['checksums']
+        return result
+
+
+def failed_result(filename, message):
+    """
+    The outcome of a file that failed validation, in the format returned by
+    check_file().
+
+    :param str filename: The file's complete path
+    :param str message: The reason that the file failed
+    :returns: A dictionary containing the filename, the status and the
+        message
+    """
+    return {'filename': filename, 'status': FAILED, 'message': message}
+
+
+def _warm_worker():
+    """
+    Initialise a worker process so that the first file that it validates
+    doesn't pay the cost of loading the netCDF and HDF5 libraries.
+    """
+    import iris.fileformats.netcdf  # noqa: F401
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Validate the files in a single request and stream the results back.
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        if not line.strip():
+            # the client disconnected without a request, for example a new
+            # server checking whether this one is running
+            return
+        try:
+            request = json.loads(line.decode('utf-8'))
+            paths = request['paths']
+            file_format = request.get('file_format', 'CMIP6')
+            cell_measure = request.get('cell_measure', False)
+            dedupe = bool(request.get('dedupe', False))
+            checks = request.get('checks')
+            options = request.get('options')
+            if file_format not in ('CMIP5', 'CMIP6'):
+                raise ValueError('file_format must be CMIP5 or CMIP6')
+            select_checks(checks, cell_measure)
+            if options:
+                select_checks(list(options), cell_measure)
+                validate_thresholds(options.get('layout'))
+                checksum_options = options.get('checksum') or {}
+                if set(checksum_options) - {'algorithms'}:
+                    raise ValueError('the only checksum option is '
+                                     'algorithms')
+                validate_algorithms(checksum_options.get('algorithms'))
+        except (ValueError, KeyError, TypeError, AttributeError) as exc:
+            self._send({'error': 'Invalid request: {}'.format(exc)})
+            return
+
+        logger.debug('Validating %s files', len(paths))
+        function = functools.partial(check_file, file_format=file_format,
+                                     cell_measure=cell_measure,
+                                     checks=checks, options=options,
+                                     dedupe=dedupe)
+        completed = queue.Queue()
+        for path in order_longest_first(paths):
+            self.server.executor.submit(function, path, completed)
+        for _path in paths:
+            filename, result, error = completed.get()
+            if error is not None:
+                logger.error('Unable to validate %s: %s', filename, error)
+                self._send({'filename': filename, 'error': str(error)})
+                continue
+            if 'metadata' in result:
+                result['metadata'] = consistency_metadata(result['metadata'])
+            self._send(result)
+        self._send({'done': True})
+
+    def _send(self, message):
+        line = json.dumps(message, sort_keys=True) + '\n'
+        self.wfile.write(line.encode('utf-8'))
+        self.wfile.flush()
+
+
+class ValidationServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    """
+    A server that validates the files sent to it on a Unix domain socket
+    using a pool of warm worker processes.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, processes=None,
+                 limits=NO_WORKER_LIMITS):
+        """
+        :param str socket_path: The path of the Unix domain socket to listen
+            on
+        :param int processes: The number of worker processes (default: the
+            number of CPUs)
+        :param primavera_val.workers.WorkerLimits limits: The memory budget
+            and maximum number of files of each worker process
+        :raises ValidationServerError: If `socket_path` isn't a socket or
+            another server is listening on it
+        """
+        _remove_stale_socket(socket_path)
+        self.socket_path = socket_path
+        self.executor = ProcessExecutor(
+            processes or multiprocessing.cpu_count(), limits,
+            initializer=_warm_worker, failed=failed_result)
+        socketserver.UnixStreamServer.__init__(self, socket_path,
+                                               _RequestHandler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.executor.shutdown()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def _remove_stale_socket(socket_path):
+    """
+    Remove the socket left behind by a server that is no longer running, so
+    that a new server can listen on the same path.
+
+    :param str socket_path: The path of the Unix domain socket
+    :raises ValidationServerError: If `socket_path` exists and isn't a
+        socket, or another server is listening on it
+    """
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ValidationServerError('{} already exists and is not a '
+                                    'socket'.format(socket_path))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (IOError, OSError) as exc:
+        if exc.errno != errno.ECONNREFUSED:
+            raise ValidationServerError('Unable to check the socket at {}: '
+                                        '{}'.format(socket_path, exc))
+    else:
+        raise ValidationServerError('A validation server is already '
+                                    'listening on {}'.format(socket_path))
+    finally:
+        sock.close()
+    logger.debug('Removing stale socket %s', socket_path)
+    os.remove(socket_path)
+
+
+def serve(socket_path, processes=None, limits=NO_WORKER_LIMITS):
+    """
+    Run a validation server until it is interrupted or terminated.
+
+    :param str socket_path: The path of the Unix domain socket to listen on
+    :param int processes: The number of worker processes (default: the number
+        of CPUs)
+    :param primavera_val.workers.WorkerLimits limits: The memory budget and
+        maximum number of files of each worker process
+    """
+    server = ValidationServer(socket_path, processes, limits)
+
+    def _terminate(_signum, _frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, _terminate)
+
+    logger.info('Validation server listening on %s', socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Validation server shutting down')
+    finally:
+        server.server_close()
+
+
+def request_validation(socket_path, paths, file_format='CMIP6',
+                       cell_measure=False, checks=None, options=None,
+                       dedupe=False):
+    """
+    Send files to a running validation server and yield the outcome of each
+    file as soon as it is available.
+
+    :param str socket_path: The path of the server's Unix domain socket
+    :param list paths: The paths of the files to validate
+    :param str file_format: The CMOR version of the netCDF files, one out of-
+        CMIP5 or CMIP6
+    :param bool cell_measure: True if the files contain cell measures
+    :param list checks: The names of the checks to run (default: all of the
+        checks that are run by default)
+    :param dict options: Dictionaries of keyword arguments for the checks,
+        keyed by the name of the check
+    :param bool dedupe: Reuse the outcome of checking an identical cell
+        measure or fixed field
+    :returns: A generator of dictionaries in the format returned by
+        check_file(), where a file that the server was unable to validate
+        has failed
+    :raises ValidationServerError: If the server cannot be contacted or
+        cannot process the request
+    """
+    request = {'paths': [absolute_path(path) for path in paths],
+               'file_format': file_format, 'cell_measure': cell_measure}
+    if checks is not None:
+        request['checks'] = checks
+    if options:
+        request['options'] = options
+    if dedupe:
+        request['dedupe'] = True
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except (IOError, OSError) as exc:
+            raise ValidationServerError('Unable to connect to validation '
+                                        'server at {}: {}'.
+                                        format(socket_path, exc))
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+        with sock.makefile('rb') as responses:
+            for line in responses:
+                response = json.loads(line.decode('utf-8'))
+                if 'error' in response and 'filename' in response:
+                    yield failed_result(
+                        response['filename'], 'Unable to validate the file: '
+                        '{}'.format(response['error']))
+                    continue
+                if 'error' in response:
+                    raise ValidationServerError(response['error'])
+                if response.get('done'):
+                    return
+                yield response
+
+        raise ValidationServerError('Connection to validation server closed '
+                                    'before all files were validated')
+    finally:
+        sock.close()
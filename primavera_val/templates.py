@@ -0,0 +1,142 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+Reuse the coordinates of the earlier files in a dataset.
+
+All of the files in a dataset normally have the same latitude, longitude,
+vertical level and bounds coordinates and differ only in their times and
+data. When a Zarr store or a netCDF-4 file, local or in object storage, is
+loaded, the coordinates that don't span the time dimension are kept as a
+template for the file's dataset. A later file in the same dataset reuses the
+template's coordinates, rather than reading their values and building them
+again, if a fingerprint of those coordinate variables matches. The
+fingerprint covers each variable's name, shape, type, chunking and
+attributes, the size of each of its stored chunks and SAMPLE_BYTES bytes
+from the start and end of its first and last chunks, and so it can be
+calculated without reading the variables.
+
+The templates belong to the process that loads the files.
+"""
+from __future__ import unicode_literals, division, absolute_import
+from collections import OrderedDict
+import os
+import re
+
+
+# The name of the time dimension, whose coordinates differ between files
+TIME_DIMENSION = 'time'
+
+# The number of bytes sampled from each end of the first and last stored
+# chunks of a coordinate variable for its fingerprint
+SAMPLE_BYTES = 4 * 1024
+
+# The maximum total size in bytes of the coordinate values kept
+MAX_BYTES = 256 * 1024 ** 2
+
+# The date range at the end of a filename, which varies within a dataset
+_DATE_RANGE = re.compile(r'^\d+-\d+(-clim)?$')
+
+
+def dataset_of(filename):
+    """
+    Identify the dataset that a file is in from its name: the variable,
+    table, model, experiment, variant and grid, without the date range.
+
+    :param str filename: The path of the file
+    :returns: The name of the dataset
+    :rtype: str
+    """
+    stem = os.path.basename(filename.rstrip('/')).rpartition('.')[0]
+    components = stem.split('_')
+    if len(components) > 1 and _DATE_RANGE.match(components[-1]):
+        components.pop()
+    return '_'.join(components)
+
+
+def sample_ranges(size):
+    """
+    The byte ranges sampled from a stored chunk for a fingerprint: the whole
+    of a small chunk, or SAMPLE_BYTES bytes from each end of a larger one.
+
+    :param int size: The size of the chunk in bytes
+    :returns: The start and stop of each range
+    :rtype: list
+    """
+    if size <= 2 * SAMPLE_BYTES:
+        return [(0, size)]
+    return [(0, SAMPLE_BYTES), (size - SAMPLE_BYTES, size)]
+
+
+class TemplateCache(object):
+    """
+    The coordinates of the files that have been loaded, keyed by the dataset
+    and the fingerprint of the coordinate variables. The templates that were
+    used least recently are dropped when the coordinates kept exceed
+    `max_bytes`.
+    """
+    def __init__(self, max_bytes=MAX_BYTES):
+        """
+        :param int max_bytes: The maximum total size of the coordinates'
+            points and bounds to keep
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self._templates = OrderedDict()
+        self._sizes = {}
+
+    def __len__(self):
+        return len(self._templates)
+
+    @property
+    def num_bytes(self):
+        """
+        The total size of the coordinates' points and bounds that are kept.
+        """
+        return sum(self._sizes.values())
+
+    def lookup(self, key):
+        """
+        :param tuple key: The name of a dataset and the fingerprint of the
+            coordinate variables in a file
+        :returns: The coordinates keyed by the name of their variable and
+            whether they are auxiliary coordinates, or None if there isn't a
+            template
+        :rtype: dict
+        """
+        coords = self._templates.get(key)
+        if coords is not None:
+            self._templates.move_to_end(key)
+            self.hits += 1
+        return coords
+
+    def add(self, key, coords):
+        """
+        Keep the coordinates from a file as the template for other files
+        with the same key.
+
+        :param tuple key: The name of a dataset and the fingerprint of the
+            coordinate variables in a file
+        :param dict coords: The coordinates keyed by the name of their
+            variable and whether they are auxiliary coordinates
+        """
+        size = sum(coord.core_points().nbytes +
+                   (coord.core_bounds().nbytes if coord.has_bounds() else 0)
+                   for coord in coords.values())
+        if size > self.max_bytes:
+            return
+        self._templates[key] = coords
+        self._sizes[key] = size
+        while self.num_bytes > self.max_bytes:
+            oldest, _coords = self._templates.popitem(last=False)
+            del self._sizes[oldest]
+
+    def clear(self):
+        """
+        Forget all of the templates.
+        """
+        self._templates.clear()
+        self._sizes.clear()
+
+
+# The templates used by primavera_val.zarr_store.make_cubes() in this process
+TEMPLATE_CACHE = TemplateCache()
@@ -0,0 +1,191 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.checksums.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from primavera_val import validate_file, FileValidationError
+from primavera_val.checksums import (file_checksums, read_manifest,
+                                     validate_algorithms, Manifest,
+                                     ManifestEntry)
+from primavera_val.server import check_file
+from primavera_val.tests.test_zarr_store import write_cmip6_store
+
+
+FILENAME = ('tas_Amon_HadGEM3-GC31-HM_highres-future_r1i1p1f1_gn_'
+            '195001-195012.zarr')
+
+
+class TestFileChecksums(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'a.nc')
+        self.contents = os.urandom(100000)
+        with open(self.path, 'wb') as handle:
+            handle.write(self.contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_default(self):
+        self.assertEqual(file_checksums(self.path),
+                         {'sha256': hashlib.sha256(self.contents).hexdigest()})
+
+    def test_all_algorithms_small_reads(self):
+        self.assertEqual(
+            file_checksums(self.path, ['sha256', 'adler32', 'md5'],
+                           read_size=1000),
+            {'sha256': hashlib.sha256(self.contents).hexdigest(),
+             'adler32': '{:08x}'.format(zlib.adler32(self.contents) &
+                                        0xffffffff),
+             'md5': hashlib.md5(self.contents).hexdigest()}
+        )
+
+    def test_empty_file(self):
+        open(self.path, 'wb').close()
+        self.assertEqual(file_checksums(self.path, ['adler32']),
+                         {'adler32': '00000001'})
+
+    def test_zarr_store(self):
+        store = os.path.join(self.temp_dir, FILENAME)
+        write_cmip6_store(store)
+        contents = b''
+        for relpath in sorted(
+                os.path.relpath(os.path.join(dirpath, name), store)
+                for dirpath, _dirnames, names in os.walk(store)
+                for name in names):
+            with open(os.path.join(store, relpath), 'rb') as handle:
+                contents += handle.read()
+        self.assertEqual(file_checksums(store, ['md5']),
+                         {'md5': hashlib.md5(contents).hexdigest()})
+
+    def test_unknown_algorithm(self):
+        self.assertRaises(ValueError, file_checksums, self.path, ['crc32'])
+
+    def test_validate_algorithms(self):
+        validate_algorithms(None)
+        validate_algorithms(['md5', 'adler32'])
+        self.assertRaises(ValueError, validate_algorithms, 'md5')
+        self.assertRaises(ValueError, validate_algorithms, [])
+
+
+class TestChecksumCheck(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, FILENAME)
+        write_cmip6_store(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_validate_file(self):
+        metadata = validate_file(self.path, checks=['checksum'],
+                                 options={'checksum': {'algorithms': ['md5']}})
+        self.assertEqual(metadata['checksums'],
+                         file_checksums(self.path, ['md5']))
+
+    def test_check_file_result(self):
+        result = check_file(self.path, checks=['times', 'checksum'])
+        self.assertEqual(result['checksums'], file_checksums(self.path))
+
+    def test_not_calculated_by_default(self):
+        self.assertNotIn('checksums', check_file(self.path))
+
+    def test_unreadable(self):
+        os.chmod(os.path.join(self.path, '.zmetadata'), 0)
+        try:
+            if os.access(os.path.join(self.path, '.zmetadata'), os.R_OK):
+                self.skipTest('files are readable without permission')
+            self.assertRaises(FileValidationError, validate_file, self.path,
+                              checks=['checksum'])
+        finally:
+            os.chmod(os.path.join(self.path, '.zmetadata'), 0o644)
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.manifest = Manifest({
+            '/data/a/x.nc': ManifestEntry(10, {'sha256': 'AB', 'md5': 'cd'}),
+            '/data/a/y.nc': ManifestEntry(None, {}),
+            '/data/b/y.nc': ManifestEntry(20, {}),
+        })
+
+    def test_algorithms(self):
+        self.assertEqual(self.manifest.algorithms, ['sha256', 'md5'])
+
+    def test_find(self):
+        self.assertEqual(self.manifest.find('/data/a/y.nc'), '/data/a/y.nc')
+        self.assertEqual(self.manifest.find('/other/x.nc'), '/data/a/x.nc')
+        self.assertIsNone(self.manifest.find('/other/y.nc'))
+
+    def test_matches(self):
+        self.assertEqual(self.manifest.verify('/data/a/x.nc', 10,
+                                              {'sha256': 'ab'}), [])
+        self.assertEqual(self.manifest.verify('/data/a/y.nc', 5, None), [])
+
+    def test_mismatches(self):
+        self.assertEqual(
+            self.manifest.verify('/data/a/x.nc', 11,
+                                 {'sha256': 'ab', 'md5': 'ef'}),
+            ['size 11 does not match 10 in the manifest',
+             'md5 checksum ef does not match cd in the manifest']
+        )
+        self.assertEqual(self.manifest.verify('/data/z.nc', 1, None),
+                         ['not in the manifest'])
+
+    def test_no_checksums_calculated(self):
+        self.assertEqual(
+            self.manifest.verify('/data/a/x.nc', 10, {'adler32': '01'}),
+            ['none of its checksums in the manifest (sha256, md5) were '
+             'calculated']
+        )
+        self.assertEqual(self.manifest.verify('/data/b/y.nc', 20,
+                                              {'adler32': '01'}), [])
+
+    def test_missing(self):
+        self.assertEqual(self.manifest.missing(['/new/x.nc', '/data/b/y.nc']),
+                         ['/data/a/y.nc'])
+
+
+class TestReadManifest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'manifest.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, lines):
+        with io.open(self.path, 'w', encoding='utf-8') as handle:
+            handle.write('\n'.join(lines) + '\n')
+
+    def test_read(self):
+        self._write([json.dumps({'filename': 'a/x.nc', 'filesize': 10,
+                                 'adler32': '0a0b0c0d', 'other': 1}),
+                     '',
+                     json.dumps({'filename': '/abs/y.nc'})])
+        manifest = read_manifest(self.path)
+        self.assertEqual(manifest.entries, {
+            os.path.join(self.temp_dir, 'a', 'x.nc'):
+                ManifestEntry(10, {'adler32': '0a0b0c0d'}),
+            '/abs/y.nc': ManifestEntry(None, {}),
+        })
+
+    def test_bad_line(self):
+        self._write([json.dumps({'filename': 'x.nc'}), '{"filesize": 1}'])
+        self.assertRaisesRegex(ValueError, 'line 2', read_manifest,
+                               self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
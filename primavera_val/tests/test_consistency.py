@@ -0,0 +1,112 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.consistency.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import unittest
+
+from primavera_val.consistency import (MetadataTable, dataset_name,
+                                       consistency_metadata)
+
+
+def _make_metadata(basename, **kwargs):
+    metadata = {'basename': basename, 'cmor_name': 'tas', 'table': 'Amon',
+                'climate_model': 'HadGEM3', 'experiment': 'hist-1950',
+                'rip_code': 'r1i1p1f1', 'grid': 'gn', 'units': 'K',
+                'calendar': '360_day',
+                'time_units': 'days since 1950-01-01',
+                'institute': 'MOHC', 'standard_name': 'air_temperature',
+                'activity_id': 'HighResMIP'}
+    metadata.update(kwargs)
+    return metadata
+
+
+class TestDatasetName(unittest.TestCase):
+    def test_cmip6(self):
+        self.assertEqual(dataset_name(_make_metadata('a.nc')),
+                         'tas_Amon_HadGEM3_hist-1950_r1i1p1f1_gn')
+
+    def test_cmip5(self):
+        metadata = _make_metadata('a.nc')
+        del metadata['grid']
+        self.assertEqual(dataset_name(metadata),
+                         'tas_Amon_HadGEM3_hist-1950_r1i1p1f1')
+
+
+class TestConsistencyMetadata(unittest.TestCase):
+    def test_extra_items_removed(self):
+        metadata = _make_metadata('a.nc', filesize=1234)
+        self.assertNotIn('filesize', consistency_metadata(metadata))
+        self.assertEqual(consistency_metadata(metadata)['calendar'],
+                         '360_day')
+
+
+class TestMetadataTable(unittest.TestCase):
+    def setUp(self):
+        self.table = MetadataTable()
+        for year in range(1950, 1955):
+            self.table.append(_make_metadata('tas_{}.nc'.format(year)))
+            self.table.append(_make_metadata('pr_{}.nc'.format(year),
+                                             cmor_name='pr',
+                                             units='kg m-2 s-1'))
+
+    def test_length(self):
+        self.assertEqual(len(self.table), 10)
+
+    def test_consistent(self):
+        self.assertEqual(self.table.inconsistencies(), [])
+
+    def test_empty(self):
+        self.assertEqual(MetadataTable().inconsistencies(), [])
+
+    def test_calendar_changes(self):
+        self.table.append(_make_metadata('tas_1955.nc', calendar='gregorian'))
+        self.table.append(_make_metadata('tas_1956.nc', calendar='gregorian'))
+
+        inconsistencies = self.table.inconsistencies()
+
+        self.assertEqual(len(inconsistencies), 1)
+        self.assertEqual(inconsistencies[0].dataset,
+                         'tas_Amon_HadGEM3_hist-1950_r1i1p1f1_gn')
+        self.assertEqual(inconsistencies[0].field, 'calendar')
+        self.assertEqual(inconsistencies[0].values,
+                         {'360_day': (5, 'tas_1950.nc'),
+                          'gregorian': (2, 'tas_1955.nc')})
+
+    def test_several_fields(self):
+        self.table.append(_make_metadata('pr_1955.nc', cmor_name='pr',
+                                         units='mm day-1',
+                                         institute='NERC'))
+
+        inconsistencies = self.table.inconsistencies()
+
+        self.assertEqual([(inconsistency.dataset, inconsistency.field)
+                          for inconsistency in inconsistencies],
+                         [('pr_Amon_HadGEM3_hist-1950_r1i1p1f1_gn', 'units'),
+                          ('pr_Amon_HadGEM3_hist-1950_r1i1p1f1_gn',
+                           'institute')])
+
+    def test_different_datasets_may_differ(self):
+        self.table.append(_make_metadata('tas_1950.nc', experiment='control',
+                                         calendar='gregorian'))
+        self.assertEqual(self.table.inconsistencies(), [])
+
+    def test_missing_values(self):
+        self.table.append(_make_metadata('tas_1955.nc', time_units=None))
+        inconsistencies = self.table.inconsistencies()
+        self.assertEqual(inconsistencies[0].values[None], (1, 'tas_1955.nc'))
+
+    def test_message(self):
+        self.table.append(_make_metadata('tas_1955.nc', calendar='gregorian'))
+        self.assertEqual(
+            str(self.table.inconsistencies()[0]),
+            "Dataset tas_Amon_HadGEM3_hist-1950_r1i1p1f1_gn has inconsistent "
+            "calendar: '360_day' in 5 files (e.g. tas_1950.nc); 'gregorian' "
+            "in 1 files (e.g. tas_1955.nc)"
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
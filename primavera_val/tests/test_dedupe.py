@@ -0,0 +1,190 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.dedupe.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import netCDF4
+import numpy as np
+
+import primavera_val
+from primavera_val import validate_file, FileValidationError
+from primavera_val import dedupe
+from primavera_val.dedupe import fingerprint, ContentCache, CONTENT_CACHE
+
+
+def write_cell_measure(path, values=None, units='m2'):
+    """
+    Write a CMIP6 areacella file.
+    """
+    with netCDF4.Dataset(path, 'w') as dataset:
+        dataset.institution_id = 'MOHC'
+        dataset.activity_id = 'HighResMIP'
+        dataset.createDimension('lat', 3)
+        dataset.createDimension('lon', 4)
+        variable = dataset.createVariable('areacella', 'f4', ('lat', 'lon'))
+        variable.units = units
+        variable.long_name = 'Grid-Cell Area for Atmospheric Grid Variables'
+        variable.standard_name = 'cell_area'
+        variable[:] = (np.arange(12).reshape(3, 4) if values is None
+                       else values)
+
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as handle:
+            handle.write(contents)
+        return path
+
+    def test_identical(self):
+        contents = os.urandom(500000)
+        self.assertEqual(fingerprint(self._write('a', contents)),
+                         fingerprint(self._write('b', contents)))
+
+    def test_size(self):
+        self.assertNotEqual(fingerprint(self._write('a', b'x' * 10)),
+                            fingerprint(self._write('b', b'x' * 11)))
+
+    def test_header(self):
+        self.assertNotEqual(fingerprint(self._write('a', b'xy' * 100)),
+                            fingerprint(self._write('b', b'yx' * 100)))
+
+    def test_unsampled_difference(self):
+        # a difference between the sampled blocks isn't seen
+        contents = bytearray(1000000)
+        first = fingerprint(self._write('a', bytes(contents)))
+        contents[dedupe.HEADER_BYTES + dedupe.SAMPLE_BYTES + 10] = 1
+        self.assertEqual(first, fingerprint(self._write('b',
+                                                        bytes(contents))))
+
+
+class TestContentCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = ContentCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as handle:
+            handle.write(contents)
+        return path
+
+    def test_reused(self):
+        first = self._write('a', b'abc')
+        second = self._write('b', b'abc')
+        self.cache.add(first, ('fp', 'tas'), metadata={'units': 'K'})
+        outcome = self.cache.lookup(second, ('fp', 'tas'))
+        self.assertEqual(outcome.filename, first)
+        self.assertEqual(outcome.metadata, {'units': 'K'})
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_different_key(self):
+        first = self._write('a', b'abc')
+        self.cache.add(first, ('fp', 'tas'), message='bad')
+        self.assertIsNone(self.cache.lookup(self._write('b', b'abc'),
+                                            ('fp', 'pr')))
+
+    def test_full_hash_differs(self):
+        first = self._write('a', b'abc')
+        self.cache.add(first, ('fp', ), message='bad')
+        self.assertIsNone(self.cache.lookup(self._write('b', b'abd'),
+                                            ('fp', )))
+
+    def test_same_file(self):
+        first = self._write('a', b'abc')
+        self.cache.add(first, ('fp', ), message='bad')
+        self.assertIsNone(self.cache.lookup(first, ('fp', )))
+
+    def test_first_kept(self):
+        self.cache.add('a', ('fp', ), message='first')
+        self.cache.add('b', ('fp', ), message='second')
+        self.assertEqual(len(self.cache), 1)
+
+    def test_full(self):
+        cache = ContentCache(max_entries=1)
+        cache.add('a', ('fp1', ))
+        cache.add('b', ('fp2', ))
+        self.assertEqual(len(cache), 1)
+
+
+class TestValidateFileDedupe(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.paths = []
+        for experiment in ['hist-1950', 'control-1950']:
+            directory = os.path.join(self.temp_dir, experiment)
+            os.makedirs(directory)
+            path = os.path.join(directory, 'areacella_fx_HadGEM3_{}_'
+                                           'r1i1p1f1_gn.nc'.format(experiment))
+            write_cell_measure(path)
+            self.paths.append(path)
+        CONTENT_CACHE.clear()
+        self.addCleanup(CONTENT_CACHE.clear)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _validate(self, path, **kwargs):
+        mock_load = mock.Mock(wraps=primavera_val.load_cfreader)
+        with mock.patch.dict('primavera_val._LOADERS',
+                             {'cfreader': mock_load}):
+            try:
+                return validate_file(path, cell_measure=True, **kwargs)
+            finally:
+                self.num_loads = mock_load.call_count
+
+    def test_copy_not_opened(self):
+        first = self._validate(self.paths[0], dedupe=True)
+        self.assertEqual(self.num_loads, 1)
+        second = self._validate(self.paths[1], dedupe=True)
+        self.assertEqual(self.num_loads, 0)
+        self.assertEqual(second['units'], 'm2')
+        self.assertEqual(second['experiment'], 'control-1950')
+        self.assertEqual(second['duplicate_of'], self.paths[0])
+        self.assertEqual(first['standard_name'], second['standard_name'])
+
+    def test_without_dedupe(self):
+        self._validate(self.paths[0])
+        self._validate(self.paths[1])
+        self.assertEqual(self.num_loads, 1)
+        self.assertEqual(len(CONTENT_CACHE), 0)
+
+    def test_different_contents(self):
+        write_cell_measure(self.paths[1], units='km2')
+        self._validate(self.paths[0], dedupe=True)
+        second = self._validate(self.paths[1], dedupe=True)
+        self.assertEqual(self.num_loads, 1)
+        self.assertEqual(second['units'], 'km2')
+
+    def test_failure_reused(self):
+        for path in self.paths:
+            with netCDF4.Dataset(path, 'a') as dataset:
+                dataset.delncattr('institution_id')
+        self.assertRaises(FileValidationError, self._validate,
+                          self.paths[0], dedupe=True)
+        with self.assertRaisesRegex(FileValidationError,
+                                    'same contents as {}'.format(
+                                        self.paths[0])):
+            self._validate(self.paths[1], dedupe=True)
+        self.assertEqual(self.num_loads, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
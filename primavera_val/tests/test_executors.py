@@ -0,0 +1,165 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.executors.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import queue
+import unittest
+
+from primavera_val.executors import (make_executor, available_executors,
+                                     SerialExecutor, distributed)
+from primavera_val.scheduling import (run_files, run_files_adaptive,
+                                      run_files_grouped)
+from primavera_val.workers import WorkerLimits
+
+
+COSTS = {1: 1, 2: 2, 3: 3, 4: 4}
+
+
+def _square(value):
+    if value < 0:
+        raise ValueError('negative value {}'.format(value))
+    return value * value
+
+
+class _Counting(SerialExecutor):
+    """
+    A serial executor that records the most files submitted at once.
+    """
+    def __init__(self):
+        super(_Counting, self).__init__()
+        self.queued = []
+        self.most_pending = 0
+
+    @property
+    def capacity(self):
+        return 2
+
+    def submit(self, function, filename, completed):
+        self.queued.append((function, filename, completed))
+        self.most_pending = max(self.most_pending, len(self.queued))
+        if len(self.queued) == self.capacity:
+            # finish the oldest file only once the executor is full
+            super(_Counting, self).submit(*self.queued.pop(0))
+
+
+class TestExecutors(unittest.TestCase):
+    def _check(self, name):
+        with make_executor(name, 2) as executor:
+            self.assertEqual(
+                sorted(run_files(_square, [1, 2, 3, 4], 2, COSTS,
+                                 executor=executor)),
+                [1, 4, 9, 16]
+            )
+            # the executor can be used again
+            self.assertEqual(list(run_files(_square, [3], 2, {3: 3},
+                                            executor=executor)), [9])
+
+    def test_serial(self):
+        self._check('serial')
+
+    def test_thread(self):
+        self._check('thread')
+
+    def test_process(self):
+        self._check('process')
+
+    def test_error(self):
+        for name in ['serial', 'thread']:
+            with make_executor(name, 2) as executor:
+                with self.assertRaisesRegex(ValueError, 'negative value -1'):
+                    list(run_files(_square, [2, -1], 2, {2: 2, -1: 1},
+                                   executor=executor))
+
+    def test_outcome_on_queue(self):
+        completed = queue.Queue()
+        with make_executor('thread', 1) as executor:
+            executor.submit(_square, 3, completed)
+            executor.submit(_square, -2, completed)
+            self.assertEqual(completed.get(timeout=10), (3, 9, None))
+            filename, result, error = completed.get(timeout=10)
+        self.assertEqual((filename, result), (-2, None))
+        self.assertIsInstance(error, ValueError)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, make_executor, 'bogus')
+
+    def test_worker_limits(self):
+        limits = WorkerLimits(None, 1)
+        self.assertRaises(ValueError, make_executor, 'thread', 2,
+                          limits=limits)
+        with make_executor('process', 1, limits=limits) as executor:
+            self.assertEqual(sorted(run_files(_square, [1, 2, 3], 1,
+                                              {1: 1, 2: 2, 3: 3},
+                                              executor=executor)),
+                             [1, 4, 9])
+            self.assertEqual(executor.replaced, 3)
+
+    def test_available(self):
+        self.assertEqual(available_executors()[:3],
+                         ['serial', 'thread', 'process'])
+
+
+class TestBackpressure(unittest.TestCase):
+    def test_run_files(self):
+        executor = _Counting()
+        results = run_files(_square, [1, 2, 3, 4], 2, COSTS,
+                            executor=executor)
+        # the first result is yielded before all of the files are submitted
+        self.assertEqual(next(results), 16)
+        self.assertEqual(len(executor.queued), 1)
+        self.assertEqual(next(results), 9)
+        self.assertEqual(executor.most_pending, 2)
+
+    def test_adaptive_and_grouped(self):
+        self.assertEqual(
+            sorted(run_files_adaptive(_square, [1, 2, 3], 1, {1: 1, 2: 2,
+                                                             3: 3},
+                                      executor=make_executor('serial'))),
+            [1, 4, 9]
+        )
+        self.assertEqual(
+            sorted(run_files_grouped(_square, [1, 2, 3], 1,
+                                     {1: 'a', 2: 'b', 3: 'a'},
+                                     costs={1: 1, 2: 2, 3: 3},
+                                     executor=make_executor('serial'))),
+            [1, 4, 9]
+        )
+
+
+@unittest.skipIf(distributed is None, 'dask.distributed is not installed')
+class TestDaskExecutor(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cluster = distributed.LocalCluster(
+            n_workers=2, threads_per_worker=1, processes=False,
+            dashboard_address=None)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.cluster.close()
+
+    def test_results(self):
+        executor = make_executor('dask',
+                                 address=self.cluster.scheduler_address)
+        with executor:
+            self.assertEqual(executor.workers, 2)
+            self.assertEqual(
+                sorted(run_files(_square, [1, 2, 3, 4], 2, COSTS,
+                                 executor=executor)),
+                [1, 4, 9, 16]
+            )
+
+    def test_error(self):
+        executor = make_executor('dask',
+                                 address=self.cluster.scheduler_address)
+        with executor:
+            with self.assertRaisesRegex(ValueError, 'negative value -1'):
+                list(run_files(_square, [-1, 2], 2, {-1: 1, 2: 2},
+                               executor=executor))
+
+
+if __name__ == '__main__':
+    unittest.main()
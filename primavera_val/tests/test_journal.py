@@ -0,0 +1,98 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.journal.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from primavera_val.journal import (ValidationJournal, read_journal, PASSED,
+                                   FAILED)
+
+
+class TestValidationJournal(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'journal.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_round_trip(self):
+        with ValidationJournal(self.path) as journal:
+            journal.record('/a/b.nc', PASSED)
+            journal.record('/a/c.nc', FAILED, 'bad file')
+
+        records = read_journal(self.path)
+        self.assertEqual(records['/a/b.nc'], {'filename': '/a/b.nc',
+                                              'status': PASSED})
+        self.assertEqual(records['/a/c.nc'], {'filename': '/a/c.nc',
+                                              'status': FAILED,
+                                              'message': 'bad file'})
+
+    def test_overwritten_without_resume(self):
+        with ValidationJournal(self.path) as journal:
+            journal.record('/a/b.nc', PASSED)
+        with ValidationJournal(self.path) as journal:
+            journal.record('/a/c.nc', PASSED)
+
+        self.assertEqual(list(read_journal(self.path)), ['/a/c.nc'])
+
+    def test_resume_appends(self):
+        with ValidationJournal(self.path) as journal:
+            journal.record('/a/b.nc', PASSED)
+        with ValidationJournal(self.path, resume=True) as journal:
+            journal.record('/a/c.nc', FAILED, 'bad file')
+
+        self.assertEqual(sorted(read_journal(self.path)),
+                         ['/a/b.nc', '/a/c.nc'])
+
+    def test_last_record_wins(self):
+        with ValidationJournal(self.path) as journal:
+            journal.record('/a/b.nc', FAILED, 'bad file')
+            journal.record('/a/b.nc', PASSED)
+
+        self.assertEqual(read_journal(self.path)['/a/b.nc']['status'],
+                         PASSED)
+
+    def test_partial_line_ignored(self):
+        with ValidationJournal(self.path) as journal:
+            journal.record('/a/b.nc', PASSED)
+        with io.open(self.path, 'ab') as handle:
+            handle.write(b'{"filename": "/a/c.nc", "sta')
+
+        self.assertEqual(list(read_journal(self.path)), ['/a/b.nc'])
+
+        with ValidationJournal(self.path, resume=True) as journal:
+            journal.record('/a/d.nc', PASSED)
+
+        self.assertEqual(sorted(read_journal(self.path)),
+                         ['/a/b.nc', '/a/d.nc'])
+
+    def test_absolute_paths(self):
+        with ValidationJournal(self.path) as journal:
+            journal.record('b.nc', PASSED)
+
+        self.assertEqual(list(read_journal(self.path)),
+                         [os.path.abspath('b.nc')])
+
+    def test_batched_sync(self):
+        journal = ValidationJournal(self.path, sync_every=2,
+                                    sync_interval=3600)
+        journal.record('/a/b.nc', PASSED)
+        self.assertEqual(read_journal(self.path), {})
+        journal.record('/a/c.nc', PASSED)
+        self.assertEqual(len(read_journal(self.path)), 2)
+        journal.close()
+
+    def test_missing_journal(self):
+        self.assertEqual(read_journal(self.path), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
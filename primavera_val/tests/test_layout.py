@@ -0,0 +1,155 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.layout.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+import netCDF4
+import numpy as np
+
+from primavera_val import FileValidationError, _check_layout
+from primavera_val.layout import (ChunkLayout, AccessCost, read_layout,
+                                  map_cost, series_cost, layout_problems,
+                                  validate_thresholds, describe_layout)
+from primavera_val.tests.test_zarr_store import write_store
+
+
+def _layout(chunks, shape=(2920, 180, 360), dimensions=('time', 'lat', 'lon'),
+            compression=('zlib level 4', )):
+    return ChunkLayout('tas', dimensions, shape, chunks, 4, list(compression))
+
+
+class TestCosts(unittest.TestCase):
+    def test_cmor_chunks(self):
+        layout = _layout((1, 180, 360))
+        self.assertEqual(map_cost(layout),
+                         AccessCost(1, 180 * 360 * 4, 180 * 360 * 4))
+        self.assertEqual(series_cost(layout),
+                         AccessCost(2920, 2920 * 180 * 360 * 4, 2920 * 4))
+        self.assertEqual(layout_problems(layout), [])
+
+    def test_one_chunk_per_element(self):
+        layout = _layout((1, 1, 1))
+        self.assertEqual(map_cost(layout).chunks, 180 * 360)
+        problems = layout_problems(layout)
+        self.assertEqual(len(problems), 2)
+        self.assertIn('chunks of 4 bytes are smaller', problems[0])
+        self.assertIn('reading a map reads 64800 chunks', problems[1])
+
+    def test_whole_time_axis(self):
+        layout = _layout((2920, 18, 36))
+        self.assertEqual(map_cost(layout).chunks, 100)
+        self.assertEqual(series_cost(layout).chunks, 1)
+        problems = layout_problems(layout)
+        self.assertEqual(len(problems), 1)
+        self.assertIn('decompresses 2920 times the bytes wanted',
+                      problems[0])
+
+    def test_contiguous(self):
+        layout = _layout(None, compression=())
+        self.assertEqual(map_cost(layout).chunks, 1)
+        self.assertEqual(series_cost(layout).chunks, 2920)
+        self.assertEqual(layout_problems(layout), [])
+
+    def test_small_whole_map_chunks(self):
+        self.assertEqual(layout_problems(_layout((1, 10, 20),
+                                                 (12, 10, 20))), [])
+
+    def test_no_time(self):
+        layout = _layout((10, 20), (10, 20), ('lat', 'lon'))
+        self.assertEqual(map_cost(layout), AccessCost(1, 800, 800))
+        self.assertIsNone(series_cost(layout))
+        self.assertEqual(layout_problems(layout), [])
+
+    def test_thresholds(self):
+        layout = _layout((1, 180, 360))
+        self.assertEqual(len(layout_problems(
+            layout, {'max_series_amplification': 1000})), 1)
+        self.assertEqual(layout_problems(_layout((1, 1, 1)),
+                                         {'min_chunk_bytes': None,
+                                          'max_map_chunks': None}), [])
+
+
+class TestValidateThresholds(unittest.TestCase):
+    def test_valid(self):
+        validate_thresholds({'max_map_chunks': 5, 'min_chunk_bytes': None})
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, validate_thresholds, {'bogus': 1})
+
+    def test_not_number(self):
+        self.assertRaises(ValueError, validate_thresholds,
+                          {'max_map_chunks': '5'})
+
+
+class TestReadLayout(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_netcdf(self):
+        filename = os.path.join(self.temp_dir, 'tas_Amon.nc')
+        with netCDF4.Dataset(filename, 'w') as dataset:
+            dataset.createDimension('time', None)
+            dataset.createDimension('lat', 10)
+            variable = dataset.createVariable('tas', 'f4', ('time', 'lat'),
+                                              zlib=True, complevel=2,
+                                              shuffle=True,
+                                              chunksizes=(1, 5))
+            variable[0:3] = np.zeros((3, 10))
+        layout = read_layout(filename)
+        self.assertEqual(layout, ChunkLayout('tas', ('time', 'lat'), (3, 10),
+                                             (1, 5), 4,
+                                             ['shuffle', 'zlib level 2']))
+        self.assertEqual(describe_layout(layout),
+                         'chunks 1x5 of 3x10, shuffle, zlib level 2')
+
+    def test_netcdf_contiguous(self):
+        filename = os.path.join(self.temp_dir, 'tas_fx.nc')
+        with netCDF4.Dataset(filename, 'w', format='NETCDF3_CLASSIC') as \
+                dataset:
+            dataset.createDimension('lat', 10)
+            dataset.createVariable('tas', 'f8', ('lat', ))
+        layout = read_layout(filename)
+        self.assertIsNone(layout.chunks)
+        self.assertEqual(layout.itemsize, 8)
+        self.assertEqual(describe_layout(layout), 'contiguous')
+
+    def test_zarr(self):
+        path = os.path.join(self.temp_dir, 'tas_Amon.zarr')
+        write_store(path, {'tas': (np.zeros((4, 6), dtype='f4'), (2, 3),
+                                   {'_ARRAY_DIMENSIONS': ['time', 'lat']})})
+        self.assertEqual(read_layout(path),
+                         ChunkLayout('tas', ('time', 'lat'), (4, 6), (2, 3),
+                                     4, ['zlib level 1']))
+
+
+class TestCheckLayout(unittest.TestCase):
+    def test_passes(self):
+        self.assertTrue(_check_layout(_layout((1, 180, 360)),
+                                      {'basename': 'a.nc'}))
+
+    def test_fails(self):
+        message = ('Inefficient chunk layout \\(chunks 1x1x1 of '
+                   '2920x180x360, zlib level 4\\) in file a.nc: chunks of 4 '
+                   'bytes')
+        with self.assertRaisesRegex(FileValidationError, message):
+            _check_layout(_layout((1, 1, 1)), {'basename': 'a.nc'})
+
+    def test_thresholds(self):
+        self.assertTrue(_check_layout(_layout((1, 1, 1)),
+                                      {'basename': 'a.nc'},
+                                      min_chunk_bytes=None,
+                                      max_map_chunks=None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,326 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.object_store.
+"""
+from __future__ import unicode_literals, division, absolute_import
+from collections import OrderedDict
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import iris
+import mock
+import netCDF4
+import numpy as np
+
+try:
+    import moto
+except ImportError:
+    moto = None
+
+from primavera_val import (list_files, load_cube, validate_file,
+                           identify_filename_metadata, FileValidationError)
+from primavera_val import object_store, zarr_store
+from primavera_val.checksums import file_checksums
+from primavera_val.layout import read_layout, ChunkLayout
+from primavera_val.object_store import (NetCDFObject, S3File,
+                                        absolute_path, coalesce_ranges,
+                                        is_s3_url, split_url)
+from primavera_val.scheduling import file_cost, storage_group
+from primavera_val.server import check_file
+from primavera_val.templates import TemplateCache
+
+
+BUCKET = 'primavera'
+
+FILENAME = ('tas_Amon_HadGEM3-GC31-HM_highres-future_r1i1p1f1_gn_'
+            '195001-195012.nc')
+
+
+def write_cmip6_file(path, start_day=0., climatology=False, packed=False):
+    """
+    Write a netCDF-4 file like a CMIP6 file of monthly data for 1950, or of a
+    monthly climatology of the 1950s, with a chunk for each time. If `packed`
+    then the data is packed into 16-bit integers with a scale factor and
+    offset.
+    """
+    with netCDF4.Dataset(path, 'w') as dataset:
+        dataset.institution_id = 'MOHC'
+        dataset.activity_id = 'HighResMIP'
+        dataset.createDimension('time', None)
+        dataset.createDimension('bnds', 2)
+        dataset.createDimension('lat', 180)
+        dataset.createDimension('lon', 360)
+        time = dataset.createVariable('time', 'f8', ('time', ))
+        time.units = 'days since 1950-01-01'
+        time.calendar = '360_day'
+        time.standard_name = 'time'
+        time.axis = 'T'
+        if climatology:
+            time.climatology = 'climatology_bnds'
+        else:
+            time.bounds = 'time_bnds'
+        time_bnds = dataset.createVariable(
+            'climatology_bnds' if climatology else 'time_bnds', 'f8',
+            ('time', 'bnds'))
+        lat = dataset.createVariable('lat', 'f8', ('lat', ))
+        lat.units = 'degrees_north'
+        lat.standard_name = 'latitude'
+        lon = dataset.createVariable('lon', 'f8', ('lon', ))
+        lon.units = 'degrees_east'
+        lon.standard_name = 'longitude'
+        tas = dataset.createVariable('tas', 'i2' if packed else 'f4',
+                                     ('time', 'lat', 'lon'),
+                                     zlib=True, complevel=1,
+                                     chunksizes=(1, 180, 360),
+                                     fill_value=-32767 if packed else 1e20)
+        if packed:
+            tas.scale_factor = np.float32(0.01)
+            tas.add_offset = np.float32(250.)
+        tas.units = 'K'
+        tas.standard_name = 'air_temperature'
+        tas.long_name = 'Near-Surface Air Temperature'
+        if climatology:
+            tas.cell_methods = ('area: mean time: mean within years '
+                                'time: mean over years')
+        else:
+            tas.cell_methods = 'area: time: mean'
+
+        points = np.arange(12) * 30. + 15. + start_day
+        time[:] = points
+        bounds = np.stack([points - 15., points + 15.], axis=1)
+        if climatology:
+            bounds[:, 1] += 9 * 360.
+        time_bnds[:] = bounds
+        lat[:] = np.linspace(-89.5, 89.5, 180)
+        lon[:] = np.linspace(0.5, 359.5, 360)
+        tas[:] = np.random.RandomState(0).uniform(
+            200., 300., (12, 180, 360))
+
+
+class TestUrls(unittest.TestCase):
+    def test_is_s3_url(self):
+        self.assertTrue(is_s3_url('s3://bucket/a/b.nc'))
+        self.assertFalse(is_s3_url('/data/s3/b.nc'))
+
+    def test_split_url(self):
+        self.assertEqual(split_url('s3://bucket/a/b.nc'),
+                         ('bucket', 'a/b.nc'))
+        self.assertEqual(split_url('s3://bucket'), ('bucket', ''))
+        self.assertRaises(ValueError, split_url, 's3:///a/b.nc')
+
+    def test_absolute_path(self):
+        self.assertEqual(absolute_path('s3://bucket/a.nc'),
+                         's3://bucket/a.nc')
+        self.assertEqual(absolute_path('a.nc'), os.path.abspath('a.nc'))
+
+    def test_storage_group(self):
+        self.assertEqual(storage_group('s3://bucket/a/b.nc'), 's3://bucket')
+        self.assertEqual(storage_group('s3://bucket/a/b.nc',
+                                       ['s3://bucket/a', '/data']),
+                         's3://bucket/a')
+
+
+class TestCoalesceRanges(unittest.TestCase):
+    def test_merge(self):
+        self.assertEqual(coalesce_ranges([(100, 200), (0, 50), (60, 80),
+                                          (1000, 1100)], max_gap=20),
+                         [(0, 80), (100, 200), (1000, 1100)])
+
+    def test_overlapping(self):
+        self.assertEqual(coalesce_ranges([(0, 100), (50, 80), (90, 150)],
+                                         max_gap=0),
+                         [(0, 150)])
+
+    def test_empty(self):
+        self.assertEqual(coalesce_ranges([]), [])
+
+
+@unittest.skipIf(moto is None or object_store.boto3 is None or
+                 object_store.h5netcdf is None,
+                 'boto3, h5netcdf and moto are required')
+class TestObjectStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, FILENAME)
+        write_cmip6_file(self.path)
+        self.url = 's3://{}/HighResMIP/{}'.format(BUCKET, FILENAME)
+
+        patches = [
+            mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'testing',
+                                         'AWS_SECRET_ACCESS_KEY': 'testing',
+                                         'AWS_DEFAULT_REGION': 'us-east-1'}),
+            mock.patch.object(object_store, '_client', None),
+            mock.patch.object(object_store, '_sizes', OrderedDict()),
+            moto.mock_aws(),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        client = object_store.s3_client()
+        client.create_bucket(Bucket=BUCKET)
+        self._upload(self.path, 'HighResMIP/' + FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _upload(self, path, key):
+        object_store.s3_client().upload_file(path, BUCKET, key)
+
+    def test_list_files(self):
+        for key in ['HighResMIP/sub/b.nc', 'HighResMIP/c.txt',
+                    'HighResMIPx/d.nc']:
+            self._upload(self.path, key)
+        with mock.patch.object(object_store, 'LIST_PAGE_SIZE', 1):
+            files = list_files('s3://{}/HighResMIP'.format(BUCKET))
+        self.assertEqual(sorted(files), sorted([
+            self.url, 's3://{}/HighResMIP/sub/b.nc'.format(BUCKET)]))
+        self.assertEqual(object_store._sizes[self.url],
+                         os.path.getsize(self.path))
+
+    def test_sizes_bounded(self):
+        for key in ['HighResMIP/b.nc', 'HighResMIP/c.nc']:
+            self._upload(self.path, key)
+        with mock.patch.object(object_store, 'MAX_CACHED_SIZES', 2):
+            urls = list_files('s3://{}/HighResMIP'.format(BUCKET))
+            self.assertEqual(len(object_store._sizes), 2)
+            self.assertEqual(object_store.object_size(urls[0]),
+                             os.path.getsize(self.path))
+            self.assertEqual(list(object_store._sizes)[-1], urls[0])
+            self.assertEqual(len(object_store._sizes), 2)
+
+    def test_read(self):
+        with open(self.path, 'rb') as handle:
+            contents = handle.read()
+        s3_file = S3File(self.url, block_size=1000, max_blocks=3)
+        s3_file.seek(2500)
+        self.assertEqual(s3_file.read(2000), contents[2500:4500])
+        self.assertEqual(s3_file.requests, 1)
+        s3_file.seek(-10, os.SEEK_END)
+        self.assertEqual(s3_file.read(), contents[-10:])
+        s3_file.seek(3000)
+        self.assertEqual(s3_file.read(100), contents[3000:3100])
+        self.assertEqual(s3_file.requests, 2)
+
+    def test_prefetch(self):
+        with mock.patch.object(object_store, 'MAX_GAP', 1000):
+            s3_file = S3File(self.url, block_size=100)
+            s3_file.prefetch([(0, 150), (250, 300), (5000, 5001)])
+        self.assertEqual(s3_file.requests, 2)
+        self.assertEqual(s3_file.bytes_fetched, 400)
+
+    def test_missing_object(self):
+        self.assertRaises(IOError, S3File, 's3://{}/missing.nc'.format(BUCKET))
+        self.assertEqual(file_cost('s3://{}/missing.nc'.format(BUCKET)), 0)
+
+    def test_identify_filename_metadata(self):
+        metadata = identify_filename_metadata(self.url)
+        self.assertEqual(metadata['filesize'], os.path.getsize(self.path))
+        self.assertEqual(metadata['directory'],
+                         's3://{}/HighResMIP'.format(BUCKET))
+
+    def test_validate_file(self):
+        s3_files = []
+        original = S3File.__init__
+
+        def init(s3_file, *args, **kwargs):
+            original(s3_file, *args, **kwargs)
+            s3_files.append(s3_file)
+
+        # read the first data point, which is in the same block as the
+        # header and coordinates
+        with mock.patch.object(S3File, '__init__', init), \
+                mock.patch('random.random', return_value=0.):
+            metadata = validate_file(self.url)
+        self.assertEqual(metadata['units'], 'K')
+        self.assertEqual(metadata['calendar'], '360_day')
+        self.assertEqual(metadata['institute'], 'MOHC')
+        self.assertEqual(len(s3_files), 1)
+        self.assertLess(s3_files[0].bytes_fetched,
+                        os.path.getsize(self.path) / 2)
+
+    def test_reuse_coordinates(self):
+        second = FILENAME.replace('1950', '1951')
+        write_cmip6_file(self.path, start_day=360.)
+        self._upload(self.path, 'HighResMIP/' + second)
+        names = []
+        original = NetCDFObject.read_arrays
+
+        def read_arrays(store, arrays):
+            names.append(arrays)
+            return original(store, arrays)
+
+        with mock.patch.object(zarr_store, 'TEMPLATE_CACHE',
+                               TemplateCache()), \
+                mock.patch.object(NetCDFObject, 'read_arrays', read_arrays):
+            validate_file(self.url)
+            metadata = validate_file(
+                's3://{}/HighResMIP/{}'.format(BUCKET, second))
+        self.assertEqual(names, [['lat', 'lon', 'time', 'time_bnds'],
+                                 ['time', 'time_bnds']])
+        self.assertEqual(metadata['start_date'].year, 1951)
+
+    def test_cell_methods_and_climatology(self):
+        write_cmip6_file(self.path, climatology=True)
+        key = 'HighResMIP/' + FILENAME.replace('1950', '1959').replace(
+            '195901', '195001').replace('.nc', '-clim.nc')
+        self._upload(self.path, key)
+        url = 's3://{}/{}'.format(BUCKET, key)
+        cube = load_cube(url)
+        expected = iris.load_cube(self.path)
+        self.assertEqual(cube.cell_methods, expected.cell_methods)
+        self.assertTrue(cube.coord('time').climatological)
+        self.assertEqual(cube.coord('time'), expected.coord('time'))
+        self.assertNotIn('cell_methods', cube.attributes)
+        validate_file(url, checks=['contents', 'data'])
+
+    def test_packed(self):
+        write_cmip6_file(self.path, packed=True)
+        self._upload(self.path, 'HighResMIP/' + FILENAME)
+        cube = load_cube(self.url)
+        expected = iris.load_cube(self.path)
+        self.assertEqual(cube.dtype, expected.dtype)
+        np.testing.assert_array_equal(cube.data, expected.data)
+        self.assertNotIn('scale_factor', cube.attributes)
+        validate_file(self.url, checks=['contents', 'data'])
+
+    def test_bad_times(self):
+        write_cmip6_file(self.path, start_day=30.)
+        self._upload(self.path, 'HighResMIP/' + FILENAME)
+        result = check_file(self.url)
+        self.assertEqual(result['status'], 'failed')
+        self.assertIn('Start date in filename', result['message'])
+
+    def test_not_netcdf4(self):
+        with netCDF4.Dataset(self.path, 'w', format='NETCDF3_CLASSIC') as \
+                dataset:
+            dataset.createDimension('lat', 2)
+        self._upload(self.path, 'HighResMIP/' + FILENAME)
+        self.assertRaises(FileValidationError, validate_file, self.url)
+
+    def test_cell_measure(self):
+        self.assertRaises(FileValidationError, validate_file, self.url,
+                          cell_measure=True)
+
+    def test_layout(self):
+        layout = read_layout(self.url)
+        self.assertEqual(layout, read_layout(self.path))
+        self.assertEqual(layout,
+                         ChunkLayout('tas', ('time', 'lat', 'lon'),
+                                     (12, 180, 360), (1, 180, 360), 4,
+                                     ['shuffle', 'zlib level 1']))
+
+    def test_checksums(self):
+        with open(self.path, 'rb') as handle:
+            expected = hashlib.md5(handle.read()).hexdigest()
+        self.assertEqual(file_checksums(self.url, ['md5'], read_size=1000),
+                         {'md5': expected})
+
+
+if __name__ == '__main__':
+    unittest.main()
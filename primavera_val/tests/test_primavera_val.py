@@ -7,7 +7,10 @@ Tests for primavera_val.
 from __future__ import unicode_literals, division, absolute_import
 import datetime
 import mock
+import os
 import six
+import subprocess
+import sys
 import unittest
 
 import cftime
@@ -18,7 +21,9 @@ from iris.tests.stock import realistic_3d
 from primavera_val import (identify_filename_metadata, _get_frequency,
                            identify_contents_metadata, _check_contiguity,
                            _check_start_end_times, _round_time,
-                           FileValidationError)
+                           FileValidationError, validate_file, select_checks,
+                           available_checks, Check, COST_HEADER, COST_DATA,
+                           NETCDF_LOCK)
 
 
 class TestIdentifyFilenameMetadata(unittest.TestCase):
@@ -269,6 +274,123 @@ class TestCheckContiguity(unittest.TestCase):
             _check_contiguity(self.bad_cube, {'basename': 'file.nc'}))
 
 
+class TestSelectChecks(unittest.TestCase):
+    def test_all_checks(self):
+        self.assertEqual([check.name for check in select_checks()],
+                         ['contents', 'times', 'contiguity', 'data'])
+
+    def test_cheapest_first(self):
+        self.assertEqual(
+            [check.name for check in select_checks(['data', 'contents'])],
+            ['contents', 'data']
+        )
+
+    def test_filename_always_allowed(self):
+        self.assertEqual(select_checks(['filename']), [])
+
+    def test_cell_measures(self):
+        self.assertEqual([check.name for check in
+                          select_checks(cell_measure=True)],
+                         ['contents', 'data'])
+
+    def test_unknown(self):
+        six.assertRaisesRegex(self, ValueError, 'Unknown checks: bogus',
+                              select_checks, ['bogus', 'data'])
+
+    def test_optional_checks(self):
+        self.assertEqual(
+            [check.name for check in select_checks(['data', 'layout'])],
+            ['layout', 'data']
+        )
+
+    def test_available_checks(self):
+        self.assertEqual(available_checks(),
+                         ['filename', 'contents', 'layout', 'times',
+                          'contiguity', 'data', 'checksum'])
+
+    def test_available_cell_measure_checks(self):
+        self.assertEqual(available_checks(cell_measure=True),
+                         ['filename', 'contents', 'data', 'checksum'])
+
+    def test_checksum_last(self):
+        self.assertEqual(
+            [check.name for check in select_checks(['checksum', 'data'],
+                                                   cell_measure=True)],
+            ['data', 'checksum']
+        )
+
+
+class TestValidateFile(unittest.TestCase):
+    def setUp(self):
+        self.filename = ('/a/tas_Amon_HadGEM3_hist-1950_r1i1p1f1_gn_'
+                         '195001-195012.nc')
+        self.run_order = []
+
+        def make_check(name, cost, fail=False):
+            def check(cube, metadata):
+                self.run_order.append(name)
+                if fail:
+                    raise FileValidationError(name)
+                return {name: cube}
+            return Check(name, cost, 'cube', check)
+
+        self.make_check = make_check
+
+        patch = mock.patch('primavera_val.os.path.getsize')
+        self.addCleanup(patch.stop)
+        patch.start().return_value = 1234
+
+        patch = mock.patch.dict('primavera_val._LOADERS',
+                                {'cube': mock.Mock(return_value='cube')})
+        self.addCleanup(patch.stop)
+        self.mock_loaders = patch.start()
+
+    def test_cheapest_first(self):
+        checks = [self.make_check('expensive', COST_DATA),
+                  self.make_check('cheap', COST_HEADER)]
+        with mock.patch('primavera_val.FILE_CHECKS', checks):
+            metadata = validate_file(self.filename)
+        self.assertEqual(self.run_order, ['cheap', 'expensive'])
+        self.assertEqual(metadata['cheap'], 'cube')
+        self.assertEqual(metadata['cmor_name'], 'tas')
+
+    def test_stops_at_first_failure(self):
+        checks = [self.make_check('expensive', COST_DATA),
+                  self.make_check('cheap', COST_HEADER, fail=True)]
+        with mock.patch('primavera_val.FILE_CHECKS', checks):
+            self.assertRaises(FileValidationError, validate_file,
+                              self.filename)
+        self.assertEqual(self.run_order, ['cheap'])
+
+    def test_loaded_once(self):
+        checks = [self.make_check('first', COST_HEADER),
+                  self.make_check('second', COST_DATA)]
+        with mock.patch('primavera_val.FILE_CHECKS', checks):
+            validate_file(self.filename)
+        self.mock_loaders['cube'].assert_called_once_with(self.filename)
+
+    def test_filename_only_not_loaded(self):
+        checks = [self.make_check('first', COST_HEADER)]
+        with mock.patch('primavera_val.FILE_CHECKS', checks):
+            metadata = validate_file(self.filename, checks=['filename'])
+        self.mock_loaders['cube'].assert_not_called()
+        self.assertEqual(metadata['table'], 'Amon')
+
+    def test_netcdf_serialised(self):
+        held = []
+
+        def check(_loaded, _metadata):
+            # the lock is an RLock, so another thread can't acquire it
+            # while this one holds it
+            held.append(NETCDF_LOCK._is_owned())
+
+        checks = [Check('contents', COST_HEADER, 'cube', check),
+                  Check('data', COST_DATA, 'path', check)]
+        with mock.patch('primavera_val.FILE_CHECKS', checks):
+            validate_file(self.filename)
+        self.assertEqual(held, [True, False])
+
+
 class TestRoundTime(unittest.TestCase):
     def test_minute_down(self):
         input_time = datetime.datetime(2018, 11, 19, 12, 29, 22)
@@ -391,5 +513,18 @@ class TestGetFrequency(unittest.TestCase):
                              self.mip_tables[mip_table])
 
 
+class TestImport(unittest.TestCase):
+    def test_back_ends_not_imported(self):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        output = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, primavera_val; '
+             'print(sorted(sys.modules))'],
+            cwd=root, universal_newlines=True)
+        for name in ['primavera_val.layout', 'primavera_val.zarr_store']:
+            self.assertNotIn("'{}'".format(name), output)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,135 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.progress.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from primavera_val.journal import PASSED, FAILED
+from primavera_val.progress import ProgressReporter
+
+
+def passed(filename, filesize):
+    return {'filename': filename, 'status': PASSED,
+            'metadata': {'filesize': filesize}}
+
+
+class TestProgressReporter(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+
+    def test_status(self):
+        reporter = ProgressReporter(10, self.stream, now=0.)
+        for index in range(4):
+            reporter.add(passed('f{}.nc'.format(index), 1024 ** 2), now=1.)
+        self.assertEqual(
+            reporter.status(now=2.),
+            '4/10 files (40.0%), 2.00 files/s, 2.0 MB/s, 0 failed, '
+            'elapsed 0:00:02, ETA 0:00:03'
+        )
+
+    def test_eta_from_bytes(self):
+        # the largest files go first, so the files per second would
+        # overestimate the time remaining
+        reporter = ProgressReporter(10, self.stream, now=0.,
+                                    total_bytes=10 * 1024 ** 2)
+        reporter.add(passed('big.nc', 8 * 1024 ** 2), now=1.)
+        self.assertTrue(reporter.status(now=4.).endswith('ETA 0:00:01'))
+
+    def test_eta_unknown_sizes(self):
+        reporter = ProgressReporter(10, self.stream, now=0., total_bytes=0)
+        reporter.add(passed('a.nc', 0), now=1.)
+        self.assertTrue(reporter.status(now=1.).endswith('ETA 0:00:09'))
+
+    def test_no_files_yet(self):
+        reporter = ProgressReporter(10, self.stream, now=0.)
+        self.assertTrue(reporter.status(now=5.).endswith('ETA unknown'))
+
+    def test_finished(self):
+        reporter = ProgressReporter(1, self.stream, now=0.)
+        reporter.add(passed('a.nc', 1), now=1.)
+        self.assertTrue(reporter.status(now=1.).endswith('ETA 0:00:00'))
+
+    def test_resumed(self):
+        reporter = ProgressReporter(10, self.stream, completed=6, failed=2,
+                                    now=0.)
+        reporter.add(passed('a.nc', 1), now=1.)
+        status = reporter.status(now=2.)
+        self.assertTrue(status.startswith('7/10 files (70.0%), 0.50 '
+                                          'files/s'))
+        self.assertIn('2 failed', status)
+        self.assertTrue(status.endswith('ETA 0:00:06'))
+
+    def test_failed_size_from_disk(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp_dir, 'a.nc')
+            with open(filename, 'wb') as handle:
+                handle.write(b'x' * 100)
+            reporter = ProgressReporter(2, self.stream, now=0.)
+            reporter.add({'filename': filename, 'status': FAILED,
+                          'message': 'bad'}, now=1.)
+            reporter.add({'filename': os.path.join(temp_dir, 'b.nc'),
+                          'status': FAILED, 'message': 'bad'}, now=1.)
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(reporter.num_bytes, 100)
+        self.assertEqual(reporter.num_failed, 2)
+
+    def test_periodic_lines(self):
+        reporter = ProgressReporter(10, self.stream, interval=60., now=0.)
+        self.assertFalse(reporter.live)
+        for now in [10., 59., 61., 100., 125.]:
+            reporter.add(passed('a.nc', 1), now=now)
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn(' 3/10 files ', lines[0])
+        self.assertIn(' 5/10 files ', lines[1])
+
+    def test_timer(self):
+        reporter = ProgressReporter(10, self.stream, interval=0.05)
+        reporter.start()
+        time.sleep(0.3)
+        reporter.finish()
+        lines = self.stream.getvalue().splitlines()
+        self.assertGreaterEqual(len(lines), 3)
+        self.assertTrue(all(' 0/10 files ' in line for line in lines))
+
+    def test_no_timer_when_live(self):
+        reporter = ProgressReporter(10, self.stream, live=True)
+        reporter.start()
+        self.assertIsNone(reporter._thread)
+        reporter.finish()
+
+    def test_live(self):
+        reporter = ProgressReporter(10, self.stream, live=True, now=0.)
+        reporter.add(passed('a.nc', 1), now=1.)
+        reporter.add(passed('b.nc', 1), now=1.1)
+        reporter.add(passed('c.nc', 1), now=2.)
+        reporter.finish(now=3.)
+        output = self.stream.getvalue()
+        self.assertEqual(output.count('\r'), 3)
+        self.assertNotIn('2/10', output)
+        self.assertTrue(output.endswith('ETA 0:00:07\n'))
+
+    def test_live_failure_clears_line(self):
+        reporter = ProgressReporter(10, self.stream, live=True, now=0.)
+        reporter.add(passed('a.nc', 1), now=1.)
+        reporter.add({'filename': 'b.nc', 'status': FAILED,
+                      'message': 'bad', 'metadata': {'filesize': 1}},
+                     now=1.1)
+        self.assertTrue(self.stream.getvalue().endswith('\r'))
+        # redrawn straight after the next file
+        reporter.add(passed('c.nc', 1), now=1.2)
+        self.assertIn('3/10 files', self.stream.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.records.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import pickle
+import unittest
+
+from iris.time import PartialDateTime
+
+from primavera_val.records import FileRecord, encode_date, decode_date
+
+
+def _make_metadata(basename='tas_Amon_HadGEM3_exp1_r1i1p1f1_gn_'
+                            '195001-195012.nc'):
+    return {'basename': basename, 'directory': '/data', 'cmor_name': 'tas',
+            'table': 'Amon', 'climate_model': 'HadGEM3',
+            'experiment': 'exp1', 'rip_code': 'r1i1p1f1', 'grid': 'gn',
+            'start_date': PartialDateTime(year=1950, month=1),
+            'end_date': PartialDateTime(year=1950, month=12),
+            'filesize': 1234, 'frequency': 'mon', 'units': 'K',
+            'calendar': '360_day'}
+
+
+class TestEncodeDate(unittest.TestCase):
+    def test_month(self):
+        self.assertEqual(encode_date(PartialDateTime(year=1950, month=1)),
+                         195001000000002)
+
+    def test_round_trip(self):
+        for date in [PartialDateTime(year=850),
+                     PartialDateTime(year=1950, month=12, day=30),
+                     PartialDateTime(year=1950, month=1, day=1, hour=0,
+                                     minute=0),
+                     PartialDateTime(year=2014, month=12, day=31, hour=23,
+                                     minute=52, second=30)]:
+            decoded = decode_date(encode_date(date))
+            self.assertEqual(decoded, date)
+            self.assertEqual(repr(decoded), repr(date))
+
+    def test_none(self):
+        self.assertIsNone(encode_date(None))
+        self.assertIsNone(decode_date(None))
+
+
+class TestFileRecord(unittest.TestCase):
+    def setUp(self):
+        self.metadata = _make_metadata()
+        self.record = FileRecord(self.metadata)
+
+    def test_items(self):
+        self.assertEqual(self.record['cmor_name'], 'tas')
+        self.assertEqual(self.record['start_date'],
+                         PartialDateTime(year=1950, month=1))
+        self.assertEqual(self.record.get('institute', 'none'), 'none')
+        self.assertIn('grid', self.record)
+        self.assertNotIn('institute', self.record)
+        self.assertRaises(KeyError, lambda: self.record['institute'])
+
+    def test_to_dict(self):
+        self.assertEqual(self.record.to_dict(), self.metadata)
+        self.assertEqual(self.record, self.metadata)
+
+    def test_update(self):
+        self.record.update({'institute': 'MOHC', 'cheap': 'cube'})
+        self.assertEqual(self.record['institute'], 'MOHC')
+        self.assertEqual(self.record['cheap'], 'cube')
+        self.assertIn('cheap', self.record.keys())
+
+    def test_strings_shared(self):
+        other = FileRecord(_make_metadata('other.nc'))
+        self.assertIs(other['climate_model'], self.record['climate_model'])
+
+    def test_pickle(self):
+        self.record['cheap'] = 'cube'
+        unpickled = pickle.loads(pickle.dumps(self.record))
+        self.assertEqual(unpickled, self.record)
+        self.assertIs(unpickled['experiment'], self.record['experiment'])
+
+    def test_pickle_smaller_than_dict(self):
+        self.assertLess(len(pickle.dumps(self.record)),
+                        len(pickle.dumps(self.metadata)))
+
+    def test_from_dict(self):
+        self.assertIs(FileRecord.from_dict(self.record), self.record)
+        self.assertEqual(FileRecord.from_dict(self.metadata), self.record)
+
+
+if __name__ == '__main__':
+    unittest.main()
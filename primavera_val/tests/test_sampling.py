@@ -0,0 +1,161 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.sampling.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import unittest
+
+import mock
+
+from primavera_val.sampling import (StratifiedSample, UNKNOWN_STRATUM,
+                                    _allocate, _generalise_message,
+                                    _wilson_interval)
+
+
+def _make_filenames(experiment, table, number):
+    return ['/data/tas_{}_HadGEM3_{}_r{}i1p1f1_gn_195001-195012.nc'.format(
+        table, experiment, index) for index in range(number)]
+
+
+class TestAllocate(unittest.TestCase):
+    def test_proportional(self):
+        self.assertEqual(_allocate(10, {'a': 50, 'b': 30, 'c': 20}),
+                         {'a': 5, 'b': 3, 'c': 2})
+
+    def test_largest_remainder(self):
+        quotas = _allocate(10, {'a': 34, 'b': 33, 'c': 33})
+        self.assertEqual(sum(quotas.values()), 10)
+        self.assertEqual(quotas['a'], 4)
+
+    def test_small_strata_sampled(self):
+        self.assertEqual(_allocate(3, {'a': 1000, 'b': 1, 'c': 1}),
+                         {'a': 1, 'b': 1, 'c': 1})
+
+    def test_too_few_samples(self):
+        quotas = _allocate(1, {'a': 1000, 'b': 1, 'c': 1})
+        self.assertEqual(quotas, {'a': 1, 'b': 0, 'c': 0})
+
+    def test_empty(self):
+        self.assertEqual(_allocate(5, {}), {})
+
+
+class TestWilsonInterval(unittest.TestCase):
+    def test_all_passed(self):
+        lower, upper = _wilson_interval(1., 100)
+        self.assertAlmostEqual(lower, 0.963, places=3)
+        self.assertEqual(upper, 1.)
+
+    def test_half(self):
+        lower, upper = _wilson_interval(0.5, 100)
+        self.assertAlmostEqual(lower, 0.404, places=3)
+        self.assertAlmostEqual(upper, 0.596, places=3)
+
+
+class TestGeneraliseMessage(unittest.TestCase):
+    def test_filename_and_details_removed(self):
+        self.assertEqual(
+            _generalise_message('Unable to extract data point (1, 2) from '
+                                'file: a_b.nc', '/data/a_b.nc'),
+            'Unable to extract data point (...) from file: <file>'
+        )
+
+    def test_first_line(self):
+        self.assertEqual(
+            _generalise_message('Unable to extract metadata from the '
+                                'contents of file /data/a_b.nc\n'
+                                "'institution_id'", '/data/a_b.nc'),
+            'Unable to extract metadata from the contents of file <file>'
+        )
+
+
+class TestStratifiedSample(unittest.TestCase):
+    def setUp(self):
+        self.filenames = (_make_filenames('exp1', 'Amon', 60) +
+                          _make_filenames('exp2', 'Amon', 30) +
+                          _make_filenames('exp1', 'Omon', 10))
+
+    def test_fraction(self):
+        sample = StratifiedSample(self.filenames, 0.1, seed=1)
+        self.assertEqual(len(sample.files), 10)
+        self.assertEqual(
+            sum(1 for filename in sample.files if '_Omon_' in filename), 1)
+        self.assertEqual(
+            sum(1 for filename in sample.files if '_exp2_' in filename), 3)
+
+    def test_number(self):
+        sample = StratifiedSample(self.filenames, 20, seed=1)
+        self.assertEqual(len(sample.files), 20)
+
+    def test_larger_than_population(self):
+        sample = StratifiedSample(self.filenames, 1000, seed=1)
+        self.assertEqual(sorted(sample.files), sorted(self.filenames))
+
+    def test_repeatable(self):
+        self.assertEqual(StratifiedSample(self.filenames, 10, seed=7).files,
+                         StratifiedSample(self.filenames, 10, seed=7).files)
+
+    def test_population(self):
+        sample = StratifiedSample(self.filenames, 10, seed=1)
+        self.assertEqual(sample.population,
+                         {('HadGEM3', 'exp1', 'Amon'): 60,
+                          ('HadGEM3', 'exp2', 'Amon'): 30,
+                          ('HadGEM3', 'exp1', 'Omon'): 10})
+
+    def test_unknown_stratum(self):
+        sample = StratifiedSample(['/data/bad.nc'], 1)
+        self.assertEqual(sample.population, {UNKNOWN_STRATUM: 1})
+
+    def test_files_not_accessed(self):
+        with mock.patch('os.stat') as mock_stat:
+            StratifiedSample(self.filenames, 10, seed=1)
+        mock_stat.assert_not_called()
+
+    def test_present_day(self):
+        sample = StratifiedSample(
+            ['/data/tas_Amon_HadGEM3_present_day_r1i1p1_195001-195012.nc',
+             '/data/tas_Amon_HadGEM3_historical_r1i1p1.zarr/'], 2,
+            file_format='CMIP5')
+        self.assertEqual(sample.population,
+                         {('HadGEM3', 'present_day', 'Amon'): 1,
+                          ('HadGEM3', 'historical', 'Amon'): 1})
+
+    def test_strata_not_covered(self):
+        sample = StratifiedSample(self.filenames, 2, seed=1)
+        for filename in sample.files:
+            sample.record(filename, True)
+        self.assertEqual(sample.num_covered, 90)
+        self.assertAlmostEqual(sample.pass_rate()[0], 1.)
+
+    def test_no_results(self):
+        sample = StratifiedSample(self.filenames, 10, seed=1)
+        self.assertIsNone(sample.pass_rate())
+
+    def test_all_passed(self):
+        sample = StratifiedSample(self.filenames, 10, seed=1)
+        for filename in sample.files:
+            sample.record(filename, True)
+        rate, lower, upper = sample.pass_rate()
+        self.assertAlmostEqual(rate, 1.)
+        self.assertLess(lower, 0.9)
+        self.assertAlmostEqual(upper, 1.)
+        self.assertEqual(sample.common_failures(), [])
+
+    def test_weighted_by_stratum(self):
+        sample = StratifiedSample(self.filenames, 10, seed=1)
+        for filename in sample.files:
+            passed = '_Omon_' not in filename
+            sample.record(filename, passed,
+                          None if passed else 'Bad file {}'.format(filename))
+        rate, lower, upper = sample.pass_rate()
+        self.assertAlmostEqual(rate, 0.9)
+        self.assertLess(lower, rate)
+        self.assertGreater(upper, rate)
+        self.assertEqual(sample.common_failures(), [('Bad file <file>', 1)])
+        self.assertEqual(sample.num_sampled, 10)
+        self.assertEqual(sample.num_passed, 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
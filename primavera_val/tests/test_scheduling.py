@@ -0,0 +1,264 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.scheduling.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from primavera_val.executors import ProcessExecutor
+from primavera_val.scheduling import (file_cost, order_longest_first,
+                                      estimate_makespan, run_files,
+                                      run_files_adaptive, ThroughputTuner,
+                                      _throughput_ratio, storage_group,
+                                      GroupScheduler, GroupLimits,
+                                      run_files_grouped,
+                                      estimate_bytes_read)
+
+
+MIB = 1024 ** 2
+
+
+def _square(value):
+    return value ** 2
+
+
+def _simulate(tuner, files_per_second, num_files):
+    """
+    Feed a tuner with files that complete at a rate that depends on the
+    number of concurrent files and return the number chosen after each file.
+    """
+    now = tuner._window_start
+    chosen = []
+    for _ in range(num_files):
+        now += 1. / files_per_second(tuner.jobs)
+        chosen.append(tuner.record(1024, now))
+    return chosen
+
+
+class TestFileCost(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_size(self):
+        filename = os.path.join(self.temp_dir, 'a.nc')
+        with open(filename, 'wb') as handle:
+            handle.write(b'abcd')
+        self.assertEqual(file_cost(filename), 4)
+
+    def test_missing(self):
+        self.assertEqual(file_cost(os.path.join(self.temp_dir, 'b.nc')), 0)
+
+
+class TestOrderLongestFirst(unittest.TestCase):
+    def test_order(self):
+        costs = {'a': 1, 'b': 30, 'c': 5, 'd': 30}
+        self.assertEqual(order_longest_first(['a', 'b', 'c', 'd'], costs),
+                         ['b', 'd', 'c', 'a'])
+
+
+class TestEstimateMakespan(unittest.TestCase):
+    def test_one_worker(self):
+        self.assertEqual(estimate_makespan([1, 2, 3], 1), 6)
+
+    def test_longest_first_better(self):
+        costs = [1] * 8 + [8]
+        self.assertEqual(estimate_makespan(costs, 2), 12)
+        self.assertEqual(estimate_makespan(sorted(costs, reverse=True), 2), 8)
+
+    def test_more_workers_than_tasks(self):
+        self.assertEqual(estimate_makespan([3, 2], 4), 3)
+
+    def test_no_tasks(self):
+        self.assertEqual(estimate_makespan([], 4), 0)
+
+
+class TestRunFiles(unittest.TestCase):
+    def test_results(self):
+        results = run_files(_square, [1, 2, 3, 4], 2,
+                            {1: 1, 2: 2, 3: 3, 4: 4})
+        self.assertEqual(sorted(results), [1, 4, 9, 16])
+
+
+
+class TestRunFilesAdaptive(unittest.TestCase):
+    def test_results(self):
+        results = run_files_adaptive(_square, [1, 2, 3, 4], 2,
+                                     {1: 1, 2: 2, 3: 3, 4: 4})
+        self.assertEqual(sorted(results), [1, 4, 9, 16])
+
+    def test_workers_started_as_needed(self):
+        with mock.patch('primavera_val.scheduling.ProcessExecutor',
+                        wraps=ProcessExecutor) as mock_executor:
+            results = run_files_adaptive(_square, [1, 2, 3], 8,
+                                         {1: 1, 2: 2, 3: 3})
+            self.assertEqual(sorted(results), [1, 4, 9])
+        mock_executor.assert_called_once_with(8, initial_workers=2)
+
+
+class TestThroughputRatio(unittest.TestCase):
+    def test_both_rates(self):
+        self.assertAlmostEqual(_throughput_ratio((2, 4., 100.), (1, 1., 25.)),
+                               4.)
+
+    def test_changing_file_sizes(self):
+        # twice the files per second but each file half the size
+        self.assertAlmostEqual(_throughput_ratio((2, 2., 50.), (1, 1., 100.)),
+                               1.)
+
+    def test_no_bytes(self):
+        self.assertEqual(_throughput_ratio((2, 3., 0.), (1, 1., 0.)), 3.)
+
+
+class TestThroughputTuner(unittest.TestCase):
+    def _make_tuner(self, max_jobs=16):
+        return ThroughputTuner(max_jobs, min_window_seconds=0.,
+                               probe_every=1000)
+
+    def test_climbs_until_flat(self):
+        tuner = self._make_tuner()
+        _simulate(tuner, lambda jobs: 10. * min(jobs, 5), 500)
+        self.assertTrue(tuner.settled)
+        self.assertIn(tuner.jobs, (5, 6))
+
+    def test_backs_off_when_worse(self):
+        tuner = self._make_tuner()
+        _simulate(tuner, lambda jobs: 10. * jobs if jobs <= 4 else 5.,
+                  500)
+        self.assertTrue(tuner.settled)
+        self.assertEqual(tuner.jobs, 4)
+
+    def test_maximum(self):
+        tuner = self._make_tuner(max_jobs=3)
+        chosen = _simulate(tuner, lambda jobs: 10. * jobs, 500)
+        self.assertEqual(max(chosen), 3)
+        self.assertEqual(tuner.jobs, 3)
+
+    def test_probes_after_settling(self):
+        tuner = ThroughputTuner(16, min_window_seconds=0., probe_every=2)
+        chosen = _simulate(tuner, lambda jobs: 10. * min(jobs, 3) if
+                           tuner.settled or jobs < 6 else 100., 2000)
+        self.assertGreater(max(chosen), 4)
+
+
+
+class TestStorageGroup(unittest.TestCase):
+    def test_longest_prefix(self):
+        self.assertEqual(storage_group('/gws/pool1/fast/a.nc',
+                                       ['/gws/pool1', '/gws/pool1/fast']),
+                         '/gws/pool1/fast')
+
+    def test_prefix_is_a_directory(self):
+        with mock.patch('primavera_val.scheduling.os.stat') as mock_stat:
+            mock_stat.return_value.st_dev = 42
+            self.assertEqual(storage_group('/gws/pool10/a.nc',
+                                           ['/gws/pool1']), 42)
+
+    def test_device(self):
+        with mock.patch('primavera_val.scheduling.os.stat') as mock_stat:
+            mock_stat.return_value.st_dev = 42
+            self.assertEqual(storage_group('/data/a.nc'), 42)
+
+    def test_missing(self):
+        self.assertIsNone(storage_group('/does/not/exist.nc'))
+
+
+class TestEstimateBytesRead(unittest.TestCase):
+    def test_small(self):
+        self.assertEqual(estimate_bytes_read(1000), 1000)
+
+    def test_large(self):
+        self.assertEqual(estimate_bytes_read(100 * MIB), 5 * MIB)
+
+    def test_whole_file(self):
+        self.assertEqual(estimate_bytes_read(100 * MIB, True), 100 * MIB)
+
+
+class TestGroupScheduler(unittest.TestCase):
+    def setUp(self):
+        self.filenames = ['a1', 'a2', 'a3', 'b1', 'b2']
+        self.groups = {filename: filename[0] for filename in self.filenames}
+        self.costs = {'a1': 10, 'a2': 30, 'a3': 20, 'b1': 5, 'b2': 50}
+
+    def _start_all(self, scheduler, now=0.):
+        started = []
+        while True:
+            filename = scheduler.next_file(now)
+            if filename is None:
+                return started
+            started.append(filename)
+
+    def test_interleaved_largest_first(self):
+        scheduler = GroupScheduler(self.filenames, self.groups, self.costs)
+        self.assertEqual(self._start_all(scheduler),
+                         ['b2', 'a2', 'b1', 'a3', 'a1'])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_jobs_limit(self):
+        scheduler = GroupScheduler(self.filenames, self.groups, self.costs,
+                                   {'a': GroupLimits(1, None)})
+        self.assertEqual(self._start_all(scheduler), ['b2', 'a2', 'b1'])
+        self.assertIsNone(scheduler.wait_time(0.))
+        scheduler.finished('a2')
+        self.assertEqual(self._start_all(scheduler), ['a3'])
+
+    def test_default_limits(self):
+        scheduler = GroupScheduler(self.filenames, self.groups, self.costs,
+                                   {'a': None}, GroupLimits(1, None))
+        self.assertEqual(self._start_all(scheduler), ['b2', 'a2'])
+
+    def test_bandwidth_limit(self):
+        scheduler = GroupScheduler(self.filenames, self.groups, self.costs,
+                                   {'b': GroupLimits(None, 10.)})
+        self.assertEqual(self._start_all(scheduler, 100.),
+                         ['b2', 'a2', 'a3', 'a1'])
+        # b2 is 50 bytes at 10 bytes per second
+        self.assertAlmostEqual(scheduler.wait_time(101.), 4.)
+        self.assertIsNone(scheduler.next_file(104.))
+        self.assertEqual(scheduler.next_file(105.), 'b1')
+
+    def test_bandwidth_bytes_read(self):
+        costs = {'a1': 10 * MIB, 'a2': 100 * MIB}
+        scheduler = GroupScheduler(['a1', 'a2'], {'a1': 'a', 'a2': 'a'},
+                                   costs, default_limits=GroupLimits(None,
+                                                                     MIB))
+        self.assertEqual(scheduler.next_file(0.), 'a2')
+        # only the header and a sample are read from a2
+        self.assertAlmostEqual(scheduler.wait_time(0.), 5.)
+
+    def test_bandwidth_whole_file(self):
+        costs = {'a1': 10 * MIB, 'a2': 100 * MIB}
+        scheduler = GroupScheduler(['a1', 'a2'], {'a1': 'a', 'a2': 'a'},
+                                   costs, default_limits=GroupLimits(None,
+                                                                     MIB),
+                                   whole_file=True)
+        self.assertEqual(scheduler.next_file(0.), 'a2')
+        self.assertAlmostEqual(scheduler.wait_time(0.), 100.)
+
+
+class TestRunFilesGrouped(unittest.TestCase):
+    def test_results(self):
+        results = run_files_grouped(
+            _square, [1, 2, 3, 4], 2, {1: 'a', 2: 'b', 3: 'a', 4: 'b'},
+            {'a': GroupLimits(1, None)}, costs={1: 1, 2: 2, 3: 3, 4: 4})
+        self.assertEqual(sorted(results), [1, 4, 9, 16])
+
+    def test_bandwidth(self):
+        results = run_files_grouped(
+            _square, [1, 2, 3], 2, {1: 'a', 2: 'a', 3: 'a'},
+            default_limits=GroupLimits(None, 1000.),
+            costs={1: 10, 2: 10, 3: 10})
+        self.assertEqual(sorted(results), [1, 4, 9])
+
+
+if __name__ == '__main__':
+    unittest.main()
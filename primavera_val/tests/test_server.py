@@ -0,0 +1,154 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.server.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from primavera_val import FileValidationError
+from primavera_val.journal import PASSED, FAILED
+from primavera_val.records import FileRecord
+from primavera_val.server import (check_file, request_validation,
+                                  ValidationServer, ValidationServerError,
+                                  _RequestHandler)
+
+
+class TestCheckFile(unittest.TestCase):
+    @mock.patch('primavera_val.server.validate_file')
+    def test_passes(self, mock_validate):
+        mock_validate.return_value = FileRecord({'basename': 'a.nc',
+                                                 'units': 'K',
+                                                 'filesize': 1234})
+        result = check_file('/a/a.nc')
+        self.assertEqual(result['filename'], '/a/a.nc')
+        self.assertEqual(result['status'], PASSED)
+        self.assertIsInstance(result['metadata'], FileRecord)
+        self.assertEqual(result['metadata']['units'], 'K')
+
+    @mock.patch('primavera_val.server.validate_file')
+    def test_fails(self, mock_validate):
+        mock_validate.side_effect = FileValidationError('bad file')
+        self.assertEqual(check_file('/a/a.nc'),
+                         {'filename': '/a/a.nc', 'status': FAILED,
+                          'message': 'bad file'})
+
+
+class TestValidationServer(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.temp_dir, 'server.sock')
+        self.server = ValidationServer(self.socket_path, processes=1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_results_streamed(self):
+        bad_date = os.path.join(
+            self.temp_dir, 'clt_Amon_Monty_historical_r1i1p1_1859-1884.nc'
+        )
+        results = list(request_validation(self.socket_path, [bad_date],
+                                          file_format='CMIP5'))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['filename'], bad_date)
+        self.assertEqual(results[0]['status'], FAILED)
+        self.assertIn('Unknown date format', results[0]['message'])
+
+    def test_invalid_request(self):
+        results = request_validation(self.socket_path, ['a.nc'],
+                                     file_format='CMIP4')
+        self.assertRaises(ValidationServerError, list, results)
+
+    def test_no_server(self):
+        results = request_validation(os.path.join(self.temp_dir, 'no.sock'),
+                                     ['a.nc'])
+        self.assertRaises(ValidationServerError, list, results)
+
+    def test_file_error(self):
+        class FailingExecutor(object):
+            def submit(self, function, path, completed):
+                if path.endswith('bad.nc'):
+                    completed.put((path, None, RuntimeError('worker died')))
+                else:
+                    completed.put((path, function(path), None))
+
+        executor = self.server.executor
+        self.server.executor = FailingExecutor()
+        try:
+            paths = [os.path.join(self.temp_dir, name) for name in [
+                'bad.nc', 'clt_Amon_Monty_historical_r1i1p1_1859-1884.nc']]
+            results = list(request_validation(self.socket_path, paths,
+                                              file_format='CMIP5'))
+        finally:
+            self.server.executor = executor
+        self.assertEqual(len(results), 2)
+        bad = [result for result in results
+               if result['filename'] == paths[0]][0]
+        self.assertEqual(bad['status'], FAILED)
+        self.assertIn('worker died', bad['message'])
+        other = [result for result in results
+                 if result['filename'] == paths[1]][0]
+        self.assertEqual(other['status'], FAILED)
+        self.assertIn('Unknown date format', other['message'])
+
+    def test_socket_removed(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_already_listening(self):
+        self.assertRaises(ValidationServerError, ValidationServer,
+                          self.socket_path, processes=1)
+        self.assertTrue(os.path.exists(self.socket_path))
+
+    def test_disconnected_client(self):
+        server_end, client_end = socket.socketpair()
+        client_end.close()
+        try:
+            with mock.patch.object(_RequestHandler, '_send') as mock_send:
+                _RequestHandler(server_end, '', self.server)
+        finally:
+            server_end.close()
+        mock_send.assert_not_called()
+
+
+class TestSocketPath(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.temp_dir, 'server.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_not_a_socket(self):
+        with open(self.socket_path, 'w') as handle:
+            handle.write('data')
+        self.assertRaises(ValidationServerError, ValidationServer,
+                          self.socket_path, processes=1)
+        with open(self.socket_path) as handle:
+            self.assertEqual(handle.read(), 'data')
+
+    def test_stale_socket(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.close()
+        server = ValidationServer(self.socket_path, processes=1)
+        server.server_close()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.templates.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+import iris
+import iris.coords
+import mock
+import netCDF4
+import numpy as np
+
+from primavera_val import load_cube, zarr_store
+from primavera_val.object_store import NetCDFObject, h5netcdf
+from primavera_val.templates import (TemplateCache, dataset_of,
+                                     sample_ranges)
+from primavera_val.tests.test_object_store import write_cmip6_file
+from primavera_val.tests.test_zarr_store import write_cmip6_store
+from primavera_val.zarr_store import ZarrStore, load_zarr
+
+
+STEM = 'tas_Amon_HadGEM3-GC31-HM_highres-future_r1i1p1f1_gn'
+
+
+class TestDatasetOf(unittest.TestCase):
+    def test_date_range(self):
+        self.assertEqual(dataset_of('/data/{}_195001-195012.nc'.format(STEM)),
+                         STEM)
+
+    def test_climatology(self):
+        self.assertEqual(dataset_of('{}_195001-195012-clim.nc'.format(STEM)),
+                         STEM)
+
+    def test_zarr_store(self):
+        self.assertEqual(
+            dataset_of('/data/{}_195001-195012.zarr/'.format(STEM)), STEM)
+
+    def test_fixed_field(self):
+        self.assertEqual(
+            dataset_of('s3://bucket/areacella_fx_HadGEM3-GC31-HM_'
+                       'highres-future_r1i1p1f1_gn.nc'),
+            'areacella_fx_HadGEM3-GC31-HM_highres-future_r1i1p1f1_gn')
+
+
+class TestSampleRanges(unittest.TestCase):
+    def test_small(self):
+        self.assertEqual(sample_ranges(100), [(0, 100)])
+
+    def test_large(self):
+        self.assertEqual(sample_ranges(10 ** 6),
+                         [(0, 4096), (10 ** 6 - 4096, 10 ** 6)])
+
+
+class TestTemplateCache(unittest.TestCase):
+    @staticmethod
+    def _coords(length):
+        return {('lat', False): iris.coords.DimCoord(
+            np.arange(length, dtype='f8'), var_name='lat')}
+
+    def test_lookup(self):
+        cache = TemplateCache()
+        self.assertIsNone(cache.lookup('a'))
+        coords = self._coords(10)
+        cache.add('a', coords)
+        self.assertIs(cache.lookup('a'), coords)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.num_bytes, 80)
+
+    def test_least_recently_used(self):
+        cache = TemplateCache(max_bytes=200)
+        cache.add('a', self._coords(10))
+        cache.add('b', self._coords(10))
+        cache.lookup('a')
+        cache.add('c', self._coords(10))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.lookup('b'))
+        self.assertIsNotNone(cache.lookup('a'))
+
+    def test_too_large(self):
+        cache = TemplateCache(max_bytes=50)
+        cache.add('a', self._coords(10))
+        self.assertEqual(len(cache), 0)
+
+
+class TestReuseCoordinates(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.paths = [
+            os.path.join(self.temp_dir, '{}_{}.zarr'.format(STEM, dates))
+            for dates in ['195001-195012', '195101-195112']
+        ]
+        for path in self.paths:
+            write_cmip6_store(path)
+        patch = mock.patch.object(zarr_store, 'TEMPLATE_CACHE',
+                                  TemplateCache())
+        self.cache = patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _load(self, path):
+        names = []
+        original = ZarrStore.read_arrays
+
+        def read_arrays(store, arrays):
+            names.append(arrays)
+            return original(store, arrays)
+
+        with mock.patch.object(ZarrStore, 'read_arrays', read_arrays):
+            cube, = load_zarr(path)
+        return cube, names[0]
+
+    def test_reuse(self):
+        first, names = self._load(self.paths[0])
+        self.assertEqual(names, ['lat', 'lon', 'time', 'time_bnds'])
+        second, names = self._load(self.paths[1])
+        self.assertEqual(names, ['time', 'time_bnds'])
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(second.coord('latitude'), first.coord('latitude'))
+        self.assertIsNot(second.coord('latitude'), first.coord('latitude'))
+        self.assertEqual(second[11, 1, 1].data, 320.)
+
+    def test_different_values(self):
+        lat_chunk = os.path.join(self.paths[1], 'lat', '0')
+        with open(lat_chunk, 'wb') as handle:
+            handle.write(zlib.compress(np.array([-30., 30.]).tobytes()))
+        self._load(self.paths[0])
+        second, names = self._load(self.paths[1])
+        self.assertEqual(names, ['lat', 'lon', 'time', 'time_bnds'])
+        self.assertEqual(self.cache.hits, 0)
+        self.assertEqual(list(second.coord('latitude').points), [-30., 30.])
+
+    def test_other_dataset(self):
+        other = os.path.join(self.temp_dir,
+                             'pr' + STEM[3:] + '_195001-195012.zarr')
+        write_cmip6_store(other)
+        self._load(self.paths[0])
+        _cube, names = self._load(other)
+        self.assertEqual(names, ['lat', 'lon', 'time', 'time_bnds'])
+
+
+@unittest.skipIf(h5netcdf is None, 'h5netcdf is not installed')
+class TestReuseLocalCoordinates(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.paths = [
+            os.path.join(self.temp_dir, '{}_{}.nc'.format(STEM, dates))
+            for dates in ['195001-195012', '195101-195112']
+        ]
+        for index, path in enumerate(self.paths):
+            write_cmip6_file(path, start_day=360. * index)
+        patch = mock.patch.object(zarr_store, 'TEMPLATE_CACHE',
+                                  TemplateCache())
+        self.cache = patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _load(self, path):
+        names = []
+        original = NetCDFObject.read_arrays
+
+        def read_arrays(store, arrays):
+            names.append(arrays)
+            return original(store, arrays)
+
+        with mock.patch.object(NetCDFObject, 'read_arrays', read_arrays):
+            cube = load_cube(path)
+        return cube, names
+
+    def test_reuse(self):
+        first, names = self._load(self.paths[0])
+        self.assertEqual(names, [['lat', 'lon', 'time', 'time_bnds']])
+        second, names = self._load(self.paths[1])
+        self.assertEqual(names, [['time', 'time_bnds']])
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(second.coord('latitude'), first.coord('latitude'))
+        self.assertEqual(second.coord('time'),
+                         iris.load_cube(self.paths[1]).coord('time'))
+
+    def test_same_as_iris(self):
+        cube, _names = self._load(self.paths[0])
+        expected = iris.load_cube(self.paths[0])
+        self.assertEqual(cube.coord('time'), expected.coord('time'))
+        for name in ['latitude', 'longitude']:
+            np.testing.assert_array_equal(cube.coord(name).points,
+                                          expected.coord(name).points)
+        self.assertEqual(cube.cell_methods, expected.cell_methods)
+        self.assertEqual(dict(cube.attributes), dict(expected.attributes))
+        self.assertEqual(cube.units, expected.units)
+        np.testing.assert_array_equal(cube.data, expected.data)
+
+    def test_packed(self):
+        write_cmip6_file(self.paths[0], packed=True)
+        cube, _names = self._load(self.paths[0])
+        expected = iris.load_cube(self.paths[0])
+        self.assertEqual(cube.dtype, expected.dtype)
+        np.testing.assert_array_equal(cube.data, expected.data)
+        self.assertGreater(cube.data.min(), 199.)
+
+    def test_netcdf3(self):
+        path = os.path.join(self.temp_dir, '{}_195201-195212.nc'.format(STEM))
+        with netCDF4.Dataset(path, 'w', format='NETCDF3_CLASSIC') as dataset:
+            dataset.createDimension('time', 1)
+            time = dataset.createVariable('time', 'f8', ('time',))
+            time.units = 'days since 1950-01-01'
+            time.standard_name = 'time'
+            time[:] = [0.]
+            tas = dataset.createVariable('tas', 'f4', ('time',))
+            tas.standard_name = 'air_temperature'
+            tas.units = 'K'
+            tas[:] = [280.]
+        cube, names = self._load(path)
+        self.assertEqual(names, [])
+        self.assertEqual(cube.data[0], 280.)
+
+
+if __name__ == '__main__':
+    unittest.main()
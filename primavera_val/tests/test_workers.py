@@ -0,0 +1,196 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.workers.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import functools
+import os
+import queue
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from primavera_val.server import failed_result
+from primavera_val.workers import (WorkerLimits, WorkerPool, WorkerError,
+                                   memory_usage, reset_peak_memory)
+
+
+MIB = 1024 ** 2
+
+# The arrays leaked by _leak() in each worker process
+_leaked = []
+
+
+def _pid(_value):
+    return os.getpid()
+
+
+def _resident(_value):
+    return memory_usage()[0]
+
+
+def _square(value):
+    if value < 0:
+        raise ValueError('negative value {}'.format(value))
+    return value * value
+
+
+def _leak(size):
+    _leaked.append(np.ones(size // 8))
+    return size
+
+
+def _allocate(log, size):
+    """
+    Use `size` bytes while validating and then free them, unless `log`
+    shows that this is the retry and size is negative.
+    """
+    with open(log, 'a') as handle:
+        handle.write('{}\n'.format(os.getpid()))
+    with open(log) as handle:
+        attempts = len(handle.readlines())
+    if size < 0 and attempts > 1:
+        return 0
+    return int(np.ones(abs(size) // 8).sum())
+
+
+def _exit(_value):
+    os._exit(3)
+
+
+@unittest.skipIf(memory_usage()[0] is None, 'memory usage is not available')
+class TestMemoryUsage(unittest.TestCase):
+    def test_peak(self):
+        resident, peak = memory_usage()
+        self.assertGreater(resident, 0)
+        self.assertGreaterEqual(peak, resident)
+
+    def test_reset(self):
+        if not reset_peak_memory():
+            self.skipTest('the peak memory cannot be reset')
+        array = np.ones(100 * MIB // 8)
+        _resident, peak = memory_usage()
+        del array
+        reset_peak_memory()
+        resident, reset_peak = memory_usage()
+        self.assertLess(reset_peak, peak - 50 * MIB)
+        self.assertLess(reset_peak, resident + 10 * MIB)
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.temp_dir, 'attempts.log')
+        self.pools = []
+        self.budget = None
+        if memory_usage()[0] is not None:
+            _pool, outcomes = self._run(_resident, [0])
+            self.budget = outcomes[0][1] + 100 * MIB
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.shutdown()
+        shutil.rmtree(self.temp_dir)
+
+    def _run(self, function, values, workers=1, limits=None, failed=None):
+        pool = WorkerPool(workers, limits, failed=failed)
+        self.pools.append(pool)
+        completed = queue.Queue()
+        for value in values:
+            pool.submit(function, value, completed)
+        outcomes = [completed.get(timeout=60) for _value in values]
+        return pool, outcomes
+
+    def _attempts(self):
+        with open(self.log) as handle:
+            return len(handle.readlines())
+
+    def test_results(self):
+        _pool, outcomes = self._run(_square, [1, 2, 3, -1], workers=2)
+        self.assertEqual(sorted(result for _value, result, _error in outcomes
+                                if result is not None), [1, 4, 9])
+        value, _result, error = [outcome for outcome in outcomes
+                                 if outcome[2] is not None][0]
+        self.assertEqual(value, -1)
+        self.assertIsInstance(error, ValueError)
+
+    def test_max_files(self):
+        pool, outcomes = self._run(_pid, range(5),
+                                   limits=WorkerLimits(None, 2))
+        self.assertEqual(len({pid for _value, pid, _error in outcomes}), 3)
+        self.assertEqual(pool.replaced, 2)
+
+    def test_no_limits(self):
+        pool, outcomes = self._run(_pid, range(5))
+        self.assertEqual(len({pid for _value, pid, _error in outcomes}), 1)
+        self.assertEqual(pool.replaced, 0)
+
+    @unittest.skipIf(memory_usage()[0] is None,
+                     'memory usage is not available')
+    def test_resident_over_budget(self):
+        pool, outcomes = self._run(_leak, [60 * MIB] * 3,
+                                   limits=WorkerLimits(self.budget, None))
+        self.assertEqual([result for _value, result, _error in outcomes],
+                         [60 * MIB] * 3)
+        self.assertEqual(pool.replaced, 1)
+
+    @unittest.skipIf(not reset_peak_memory(),
+                     'the peak memory cannot be reset')
+    def test_peak_over_budget(self):
+        function = functools.partial(_allocate, self.log)
+        _pool, outcomes = self._run(function, [200 * MIB, MIB],
+                                    limits=WorkerLimits(self.budget, None),
+                                    failed=failed_result)
+        results = {value: result for value, result, _error in outcomes}
+        self.assertEqual(results[MIB], MIB // 8)
+        self.assertEqual(results[200 * MIB]['status'], 'failed')
+        self.assertIn('more than the memory budget',
+                      results[200 * MIB]['message'])
+        self.assertEqual(self._attempts(), 3)
+
+    @unittest.skipIf(not reset_peak_memory(),
+                     'the peak memory cannot be reset')
+    def test_passes_on_retry(self):
+        function = functools.partial(_allocate, self.log)
+        pool, outcomes = self._run(function, [-200 * MIB],
+                                   limits=WorkerLimits(self.budget, None))
+        self.assertEqual(outcomes, [(-200 * MIB, 0, None)])
+        self.assertEqual(self._attempts(), 2)
+        self.assertEqual(pool.replaced, 1)
+
+    def test_worker_exits(self):
+        pool, outcomes = self._run(_exit, [1])
+        _value, result, error = outcomes[0]
+        self.assertIsNone(result)
+        self.assertIsInstance(error, WorkerError)
+        self.assertIn('exited with code 3', str(error))
+        self.assertEqual(pool.replaced, 2)
+
+        # the pool carries on with new workers
+        completed = queue.Queue()
+        pool.submit(_square, 4, completed)
+        self.assertEqual(completed.get(timeout=60), (4, 16, None))
+
+    def test_initial_workers(self):
+        pool = WorkerPool(4, initial_workers=1)
+        self.pools.append(pool)
+        self.assertEqual(len(pool._idle), 1)
+        completed = queue.Queue()
+        for value in range(3):
+            pool.submit(_square, value, completed)
+        self.assertEqual(sorted(completed.get(timeout=60)[1]
+                                for _value in range(3)), [0, 1, 4])
+        self.assertLessEqual(len(pool._idle) + len(pool._busy), 4)
+
+    def test_shutdown(self):
+        pool = WorkerPool(2)
+        pool.shutdown()
+        self.assertRaises(ValueError, pool.submit, _square, 1, queue.Queue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,271 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+# pylint: disable = missing-docstring, invalid-name, too-many-public-methods
+"""
+Tests for primavera_val.zarr_store.
+"""
+from __future__ import unicode_literals, division, absolute_import
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+import numpy as np
+
+from primavera_val import (validate_file, list_files, load_cube,
+                           identify_filename_metadata, FileValidationError)
+from primavera_val.zarr_store import ZarrStore, load_zarr, store_size
+
+
+def write_store(path, arrays, attributes=None, separator='.',
+                compressor=True, skip_chunks=()):
+    """
+    Write a Zarr directory store with consolidated metadata.
+
+    :param str path: The path of the store
+    :param dict arrays: (data, chunks, attributes) keyed by the array names
+    :param dict attributes: The global attributes
+    :param str separator: The separator in the names of the chunk files
+    :param bool compressor: Compress the chunks with zlib
+    :param list skip_chunks: (array name, chunk key) of chunks not to write
+    """
+    metadata = {'.zgroup': {'zarr_format': 2},
+                '.zattrs': attributes or {}}
+    for name, (data, chunks, array_attributes) in arrays.items():
+        os.makedirs(os.path.join(path, name))
+        metadata[name + '/.zarray'] = {
+            'zarr_format': 2, 'shape': list(data.shape),
+            'chunks': list(chunks), 'dtype': data.dtype.str,
+            'compressor': {'id': 'zlib', 'level': 1} if compressor else None,
+            'fill_value': 'NaN' if data.dtype.kind == 'f' else 0,
+            'filters': None, 'order': 'C', 'dimension_separator': separator
+        }
+        metadata[name + '/.zattrs'] = array_attributes
+        grid = [range(0, length, chunk)
+                for length, chunk in zip(data.shape, chunks)]
+        for starts in np.ndindex(*[len(dim) for dim in grid]):
+            key = separator.join(str(index) for index in starts) or '0'
+            if (name, key) in skip_chunks:
+                continue
+            chunk = np.zeros(chunks, dtype=data.dtype)
+            source = tuple(slice(index * size, (index + 1) * size)
+                           for index, size in zip(starts, chunks))
+            part = data[source]
+            chunk[tuple(slice(0, size) for size in part.shape)] = part
+            encoded = chunk.tobytes()
+            if compressor:
+                encoded = zlib.compress(encoded)
+            chunk_path = os.path.join(path, name, key)
+            if not os.path.exists(os.path.dirname(chunk_path)):
+                os.makedirs(os.path.dirname(chunk_path))
+            with open(chunk_path, 'wb') as handle:
+                handle.write(encoded)
+    with open(os.path.join(path, '.zmetadata'), 'w') as handle:
+        json.dump({'zarr_consolidated_format': 1, 'metadata': metadata},
+                  handle)
+
+
+def write_cmip6_store(path, start_day=0., units='K', climatology=False,
+                      cell_methods='area: time: mean'):
+    """
+    Write a store like a CMIP6 file of monthly data for 1950, or of a
+    monthly climatology of the 1950s.
+    """
+    time_points = np.arange(12) * 30. + 15. + start_day
+    time_bounds = np.stack([time_points - 15., time_points + 15.], axis=1)
+    bounds_attribute = 'bounds'
+    if climatology:
+        time_bounds[:, 1] += 9 * 360.
+        cell_methods = ('area: mean time: mean within years '
+                        'time: mean over years')
+        bounds_attribute = 'climatology'
+    lat = np.array([-45., 45.])
+    lon = np.array([90., 270.])
+    tas = np.arange(48, dtype='f4').reshape(12, 2, 2) + 273.
+    write_store(path, {
+        'tas': (tas, (5, 2, 1), {
+            '_ARRAY_DIMENSIONS': ['time', 'lat', 'lon'], 'units': units,
+            'standard_name': 'air_temperature',
+            'long_name': 'Near-Surface Air Temperature',
+            'cell_methods': cell_methods}),
+        'time': (time_points, (12, ), {
+            '_ARRAY_DIMENSIONS': ['time'], bounds_attribute: 'time_bnds',
+            'units': 'days since 1950-01-01', 'calendar': '360_day',
+            'standard_name': 'time', 'axis': 'T'}),
+        'time_bnds': (time_bounds, (12, 2), {
+            '_ARRAY_DIMENSIONS': ['time', 'bnds']}),
+        'lat': (lat, (2, ), {'_ARRAY_DIMENSIONS': ['lat'],
+                             'units': 'degrees_north',
+                             'standard_name': 'latitude'}),
+        'lon': (lon, (2, ), {'_ARRAY_DIMENSIONS': ['lon'],
+                             'units': 'degrees_east',
+                             'standard_name': 'longitude'}),
+    }, {'institution_id': 'MOHC', 'activity_id': 'HighResMIP'})
+
+
+class TestZarrArray(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'a.zarr')
+        self.data = np.arange(1, 36, dtype='i4').reshape(5, 7)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _array(self, **kwargs):
+        write_store(self.path, {'a': (self.data, (2, 3), {})}, **kwargs)
+        return ZarrStore(self.path).arrays['a']
+
+    def test_whole_array(self):
+        np.testing.assert_array_equal(self._array()[...], self.data)
+
+    def test_selections(self):
+        array = self._array()
+        for key in [(1, 2), (slice(1, 4), 6), (-1, slice(None, None, 2)),
+                    (slice(None, None, -1), ), slice(2, 2), 3]:
+            np.testing.assert_array_equal(array[key], self.data[key])
+
+    def test_out_of_bounds(self):
+        self.assertRaises(IndexError, lambda: self._array()[5, 0])
+
+    def test_nested_uncompressed(self):
+        array = self._array(separator='/', compressor=False)
+        np.testing.assert_array_equal(array[...], self.data)
+
+    def test_missing_chunk(self):
+        array = self._array(skip_chunks=[('a', '0.0')])
+        self.assertEqual(array[0, 0], 0)
+        self.assertEqual(array[4, 6], 35)
+
+    def test_unsupported_compressor(self):
+        array = self._array()
+        array.compressor = {'id': 'madeup'}
+        self.assertRaises(ValueError, lambda: array[0, 0])
+
+
+class TestLoadZarr(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(
+            self.temp_dir,
+            'tas_Amon_HadGEM3-GC31-HM_highres-future_r1i1p1f1_gn_'
+            '195001-195012.zarr'
+        )
+        write_cmip6_store(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_cube(self):
+        cubes = load_zarr(self.path)
+        self.assertEqual(len(cubes), 1)
+        cube = cubes[0]
+        self.assertEqual(cube.var_name, 'tas')
+        self.assertEqual(cube.standard_name, 'air_temperature')
+        self.assertEqual(cube.shape, (12, 2, 2))
+        self.assertTrue(cube.has_lazy_data())
+        self.assertEqual(cube.attributes['institution_id'], 'MOHC')
+        time = cube.coord('time')
+        self.assertEqual(time.units.calendar, '360_day')
+        self.assertEqual(time.bounds.shape, (12, 2))
+        self.assertEqual(cube[11, 1, 1].data, 320.)
+
+    def test_no_consolidated_metadata(self):
+        os.remove(os.path.join(self.path, '.zmetadata'))
+        self.assertRaises(FileValidationError, load_cube, self.path)
+
+    def test_identify_filename_metadata(self):
+        metadata = identify_filename_metadata(self.path)
+        self.assertEqual(metadata['experiment'], 'highres-future')
+        self.assertEqual(metadata['grid'], 'gn')
+        self.assertEqual(metadata['filesize'], store_size(self.path))
+
+    def test_validate_file(self):
+        metadata = validate_file(self.path)
+        self.assertEqual(metadata['units'], 'K')
+        self.assertEqual(metadata['calendar'], '360_day')
+        self.assertEqual(metadata['institute'], 'MOHC')
+
+    def test_cell_methods(self):
+        cube = load_cube(self.path)
+        self.assertEqual(
+            [(cell_method.method, cell_method.coord_names)
+             for cell_method in cube.cell_methods],
+            [('mean', ('area', 'time'))])
+        self.assertNotIn('cell_methods', cube.attributes)
+
+    def test_climatology(self):
+        path = os.path.join(
+            self.temp_dir,
+            'tas_Amon_HadGEM3-GC31-HM_highres-future_r1i1p1f1_gn_'
+            '195001-195912-clim.zarr'
+        )
+        write_cmip6_store(path, climatology=True)
+        time = load_cube(path).coord('time')
+        self.assertTrue(time.climatological)
+        self.assertEqual(time.bounds[-1, 1], 12 * 30. + 9 * 360.)
+        metadata = validate_file(path, checks=['contents', 'data'])
+        self.assertEqual(metadata['units'], 'K')
+
+    def _write_gap(self, cell_methods):
+        shutil.rmtree(self.path)
+        write_cmip6_store(self.path, cell_methods=cell_methods)
+        bounds = np.stack([np.arange(12) * 30., np.arange(12) * 30. + 29.],
+                          axis=1)
+        with open(os.path.join(self.path, 'time_bnds', '0.0'), 'wb') as \
+                handle:
+            handle.write(zlib.compress(bounds.tobytes()))
+
+    def test_contiguity(self):
+        self._write_gap('area: time: mean')
+        self.assertRaises(FileValidationError, validate_file, self.path,
+                          checks=['contiguity'])
+
+    def test_point_cell_method(self):
+        # the times of point values aren't checked for contiguity
+        self._write_gap('time: point')
+        validate_file(self.path, checks=['contiguity'])
+
+    def test_validate_file_bad_times(self):
+        shutil.rmtree(self.path)
+        write_cmip6_store(self.path, start_day=30.)
+        self.assertRaises(FileValidationError, validate_file, self.path)
+
+    def test_cell_measure(self):
+        self.assertRaises(FileValidationError, validate_file, self.path,
+                          cell_measure=True)
+
+
+class TestListFiles(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.temp_dir, 'a', 'b.zarr', 'tas'))
+        os.makedirs(os.path.join(self.temp_dir, 'c'))
+        for filename in [os.path.join('a', 'x.nc'), os.path.join('c', 'y.nc'),
+                         os.path.join('c', 'z.txt'),
+                         os.path.join('a', 'b.zarr', 'tas', '0.nc')]:
+            open(os.path.join(self.temp_dir, filename), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_stores_and_files(self):
+        self.assertEqual(
+            sorted(os.path.relpath(path, self.temp_dir)
+                   for path in list_files(self.temp_dir)),
+            [os.path.join('a', 'b.zarr'), os.path.join('a', 'x.nc'),
+             os.path.join('c', 'y.nc')]
+        )
+
+    def test_suffix_in_subdirectories(self):
+        self.assertEqual(
+            sorted(os.path.relpath(path, self.temp_dir)
+                   for path in list_files(self.temp_dir, '.txt')),
+            [os.path.join('a', 'b.zarr'), os.path.join('c', 'z.txt')]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,407 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+A pool of worker processes that are replaced when they use too much memory.
+
+The resident memory of a process that validates thousands of files grows
+steadily, as Iris, netCDF and HDF5 keep caches and leak a little with each
+file, until the process is killed on a shared node. Each worker process in
+the pool therefore measures its resident memory after each file, and its
+peak while validating the file, and a worker is retired and replaced by a
+fresh one when it is over its memory budget or has validated its maximum
+number of files.
+
+A file's own peak is its worker's peak while validating it, less the memory
+that the worker had gained from earlier files, so that it's the peak that the
+file would reach in a fresh worker. A file whose own peak is over the budget
+is retried once in a fresh worker while no other files are being validated,
+and reported as failed if it is over the budget again. The same happens to
+a file whose worker exits while validating it, for example because it was
+killed for running out of memory.
+"""
+from __future__ import unicode_literals, division, absolute_import
+from collections import namedtuple
+import logging
+import multiprocessing
+import multiprocessing.connection
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# The maximum resident memory in bytes of a worker process after a file, and
+# the peak while validating a single file, and the maximum number of files
+# that a worker process validates before it is replaced. None means no
+# limit.
+WorkerLimits = namedtuple('WorkerLimits', ['memory', 'files'])
+
+NO_WORKER_LIMITS = WorkerLimits(None, None)
+
+# The number of seconds to wait for a retired worker process to exit before
+# terminating it
+RETIRE_TIMEOUT = 10.
+
+logger = logging.getLogger(__name__)
+
+# A file submitted to the pool. `retry` is True once it's been found to need
+# more than the budget and is to be validated on its own.
+_Task = namedtuple('_Task', ['function', 'filename', 'completed', 'retry'])
+
+
+class WorkerError(Exception):
+    """
+    An exception to indicate that a file couldn't be validated within the
+    limits of a worker process.
+    """
+    pass
+
+
+def reset_peak_memory():
+    """
+    Reset the peak resident memory of this process, where the operating
+    system allows it, so that the peak of the next file can be measured.
+
+    :returns: True if the peak was reset
+    :rtype: bool
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as handle:
+            handle.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def memory_usage():
+    """
+    Find the resident memory of this process now and its peak since it
+    started or the peak was last reset. Where /proc isn't available both are
+    the peak since the process started.
+
+    :returns: The resident and peak memory in bytes, or None if they can't be
+        found
+    :rtype: tuple
+    """
+    try:
+        with open('/proc/self/status') as handle:
+            status = dict(line.split(':', 1) for line in handle
+                          if ':' in line)
+        return (int(status['VmRSS'].split()[0]) * 1024,
+                int(status['VmHWM'].split()[0]) * 1024)
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    if resource is None:
+        return None, None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak, peak
+
+
+class WorkerPool(object):
+    """
+    Validates files in a pool of worker processes, replacing each worker
+    when it goes over its WorkerLimits.
+
+    Each worker process validates one file at a time, and each file is given
+    to the next worker that is free, in the order that they are submitted.
+    The outcome of each file is put on the queue given with it, as the file,
+    the result and None, or the file, None and the exception raised.
+    """
+    def __init__(self, workers, limits=NO_WORKER_LIMITS, initializer=None,
+                 failed=None, initial_workers=None):
+        """
+        :param int workers: The number of worker processes
+        :param WorkerLimits limits: The limits that a worker is replaced at
+        :param initializer: A function to call in each new worker process
+        :param failed: A function that takes a file and the reason that it
+            couldn't be validated within the limits and returns the result
+            to report for the file (default: report a WorkerError)
+        :param int initial_workers: The number of worker processes to start
+            now, the others being started when there are more files being
+            validated at once than workers (default: all of them)
+        """
+        self.workers = workers
+        self.limits = limits or NO_WORKER_LIMITS
+        self.replaced = 0
+        self._initializer = initializer
+        self._failed = failed
+        self._lock = threading.Lock()
+        self._idle = []
+        self._busy = {}
+        self._retired = []
+        self._pending = []
+        self._isolated = []
+        self._isolating = False
+        self._closed = False
+        self._wakeup_reader, self._wakeup_writer = multiprocessing.Pipe(
+            duplex=False)
+        with self._lock:
+            if initial_workers is None:
+                initial_workers = workers
+            self._idle = [_Worker(initializer) for _worker in
+                          range(min(initial_workers, workers))]
+        self._thread = threading.Thread(target=self._collect,
+                                        name='WorkerPool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, function, filename, completed):
+        """
+        Start applying `function` to a file as soon as a worker is free.
+
+        :param function: A picklable function that takes the path of a file
+        :param str filename: The path of the file
+        :param queue.Queue completed: The queue for the outcome
+        """
+        with self._lock:
+            if self._closed:
+                raise ValueError('The worker pool has been shut down')
+            self._pending.append(_Task(function, filename, completed,
+                                       False))
+            self._dispatch()
+        self._wakeup_writer.send_bytes(b'')
+
+    def shutdown(self):
+        """
+        Stop the worker processes, abandoning any files that haven't
+        finished.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._pending = []
+            self._isolated = []
+        self._wakeup_writer.send_bytes(b'')
+        self._thread.join()
+        for worker in list(self._busy.values()):
+            worker.process.terminate()
+        for worker in self._idle:
+            worker.retire()
+        for worker in self._retired + self._idle + list(self._busy.values()):
+            worker.join()
+        self._idle = []
+        self._busy = {}
+        self._retired = []
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+    def _dispatch(self):
+        """
+        Give the pending files to the free workers. A file that is to be
+        retried on its own waits until no other files are being validated
+        and then holds back the pending files until it has finished. Must be
+        called with the lock held.
+        """
+        if self._closed or self._isolating:
+            return
+        if self._isolated:
+            if self._busy:
+                return
+            fresh = [worker for worker in self._idle if not worker.files]
+            if fresh:
+                worker = fresh[0]
+                self._idle.remove(worker)
+            else:
+                if self._idle:
+                    self._retire(self._idle.pop())
+                worker = _Worker(self._initializer)
+            self._isolating = True
+            self._start(worker, self._isolated.pop(0))
+            return
+        while self._pending and len(self._busy) < self.workers:
+            if self._idle:
+                worker = self._idle.pop(0)
+            else:
+                worker = _Worker(self._initializer)
+            self._start(worker, self._pending.pop(0))
+
+    def _start(self, worker, task):
+        worker.task = task
+        worker.connection.send((task.function, task.filename))
+        self._busy[worker.connection] = worker
+
+    def _collect(self):
+        """
+        Wait for the workers to finish their files, or to exit, and report
+        the outcomes.
+        """
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                busy = dict(self._busy)
+                sentinels = {worker.process.sentinel: worker
+                             for worker in busy.values()}
+            ready = multiprocessing.connection.wait(
+                [self._wakeup_reader] + list(busy) + list(sentinels))
+            if self._wakeup_reader in ready:
+                while self._wakeup_reader.poll():
+                    self._wakeup_reader.recv_bytes()
+
+            finished = set()
+            for item in ready:
+                worker = busy.get(item) or sentinels.get(item)
+                if worker is None or worker in finished:
+                    continue
+                finished.add(worker)
+                try:
+                    if worker.connection.poll():
+                        outcome = worker.connection.recv()
+                    else:
+                        outcome = None
+                except (EOFError, IOError, OSError):
+                    outcome = None
+                if outcome is None:
+                    worker.process.join(RETIRE_TIMEOUT)
+                with self._lock:
+                    if self._closed:
+                        return
+                    self._finished(worker, outcome)
+                    self._dispatch()
+
+    def _finished(self, worker, outcome):
+        """
+        Report the outcome of a worker's file and decide whether the worker
+        should be replaced. Must be called with the lock held.
+
+        :param _Worker worker: The worker
+        :param tuple outcome: The result, the exception raised, and the
+            resident memory of the worker before and after the file and its
+            peak, or None if the worker exited without finishing the file
+        """
+        task = worker.task
+        worker.task = None
+        del self._busy[worker.connection]
+        if task.retry:
+            self._isolating = False
+
+        if outcome is None:
+            self._retired.append(worker)
+            self.replaced += 1
+            self._over_limit(task, 'The worker process validating the file '
+                             'exited with code {}'.format(
+                                 worker.process.exitcode))
+            return
+
+        result, error, start, resident, peak = outcome
+        if worker.baseline is None:
+            worker.baseline = start
+        if peak and start and worker.baseline:
+            peak -= start - worker.baseline
+        worker.files += 1
+        budget = self.limits.memory
+        if budget and peak and peak > budget:
+            self._retire(worker)
+            self._over_limit(task, 'Validating the file needed {:.0f} MiB, '
+                             'more than the memory budget of {:.0f} '
+                             'MiB'.format(peak / 1024 ** 2,
+                                          budget / 1024 ** 2))
+            return
+
+        if budget and resident and resident > budget:
+            logger.debug('Replacing worker process %s: %.0f MiB resident, '
+                         'more than the memory budget of %.0f MiB',
+                         worker.process.pid, resident / 1024 ** 2,
+                         budget / 1024 ** 2)
+            self._retire(worker)
+        elif self.limits.files and worker.files >= self.limits.files:
+            logger.debug('Replacing worker process %s after %s files',
+                         worker.process.pid, worker.files)
+            self._retire(worker)
+        else:
+            self._idle.append(worker)
+        task.completed.put((task.filename, result, error))
+
+    def _over_limit(self, task, reason):
+        """
+        Retry a file that couldn't be validated within the limits on its own
+        in a fresh worker, or report it if it has already been retried.
+        """
+        if not task.retry:
+            logger.warning('%s: %s. Retrying it on its own in a new worker '
+                           'process.', task.filename, reason)
+            self._isolated.append(task._replace(retry=True))
+            return
+        if self._failed is not None:
+            task.completed.put((task.filename,
+                                self._failed(task.filename, reason), None))
+        else:
+            task.completed.put((task.filename, None, WorkerError(reason)))
+
+    def _retire(self, worker):
+        """
+        Ask a worker to exit once it's free. A new worker is started when
+        one is needed.
+        """
+        worker.retire()
+        self._retired.append(worker)
+        self.replaced += 1
+        for retired in list(self._retired):
+            if not retired.process.is_alive():
+                retired.join()
+                self._retired.remove(retired)
+
+
+class _Worker(object):
+    """
+    A worker process and the connection to it.
+    """
+    def __init__(self, initializer=None):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_work, args=(child, initializer), name='WorkerPool')
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.files = 0
+        self.task = None
+        # the resident memory of the worker before its first file
+        self.baseline = None
+
+    def retire(self):
+        try:
+            self.connection.send(None)
+        except (IOError, OSError):
+            pass
+
+    def join(self):
+        self.process.join(RETIRE_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+
+def _work(connection, initializer):
+    """
+    Validate the files sent by the pool until asked to exit, sending the
+    outcome and memory usage after each file.
+    """
+    if initializer is not None:
+        initializer()
+    while True:
+        try:
+            task = connection.recv()
+        except (EOFError, IOError, OSError):
+            return
+        if task is None:
+            return
+        function, filename = task
+        reset_peak_memory()
+        start = memory_usage()[0]
+        try:
+            result, error = function(filename), None
+        except Exception as exc:
+            result, error = None, exc
+        resident, peak = memory_usage()
+        try:
+            connection.send((result, error, start, resident, peak))
+        except Exception as exc:
+            # the result or exception couldn't be pickled
+            connection.send((None, WorkerError(
+                'Unable to return the outcome of {}: {}'.format(filename,
+                                                                exc)),
+                start, resident, peak))
@@ -0,0 +1,573 @@
+# (C) British Crown Copyright 2019, Met Office.
+# Please see LICENSE.rst for license details.
+"""
+Load Zarr directory stores as Iris cubes so that the same checks can be run on
+them as on netCDF files.
+
+Only the consolidated metadata in the store's .zmetadata file is read to find
+the variables, their attributes and the layout of their chunks. The chunk
+files are then read directly, with the chunks needed for a selection read in
+parallel, and the data variables are given lazy data so that only the chunks
+that a check looks at are read. Loading a store therefore takes a single read
+of the metadata and a read of each of the coordinate variables.
+
+Chunks compressed with zlib or gzip, or not compressed, can be read with the
+standard library. Other compressors and filters need numcodecs.
+"""
+from __future__ import unicode_literals, division, absolute_import
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import zlib
+
+import cf_units
+import dask.array
+import iris.coords
+import iris.cube
+import iris.fileformats.netcdf
+import iris.std_names
+import numpy as np
+
+try:
+    import numcodecs
+except ImportError:
+    numcodecs = None
+
+from primavera_val.templates import (TEMPLATE_CACHE, TIME_DIMENSION,
+                                     dataset_of, sample_ranges)
+
+
+ZARR_SUFFIX = '.zarr'
+
+CONSOLIDATED_METADATA = '.zmetadata'
+
+# The number of threads used to read chunk files in each process
+CHUNK_READ_THREADS = 8
+
+# The attribute used by xarray to name the dimensions of each array
+DIMENSIONS_ATTRIBUTE = '_ARRAY_DIMENSIONS'
+
+# The attributes of a coordinate variable that name the variable holding its
+# bounds, for ordinary and climatological bounds
+_BOUNDS_ATTRIBUTES = ['bounds', 'climatology']
+
+# Variable attributes that are used to build the cube and coordinates, or
+# that Iris doesn't allow in the attributes of a cube or coordinate, rather
+# than being copied to their attributes
+_CF_ATTRIBUTES = [DIMENSIONS_ATTRIBUTE, 'units', 'calendar', 'standard_name',
+                  'long_name', 'bounds', 'climatology', 'cell_methods',
+                  'coordinates', '_FillValue', 'missing_value', 'axis',
+                  'leap_month', 'leap_year', 'month_lengths', 'grid_mapping',
+                  'formula_terms', 'compress', 'add_offset', 'scale_factor']
+
+# Compressors that can be decoded without numcodecs
+_DECOMPRESSORS = {'zlib': zlib.decompress, 'gzip': gzip.decompress}
+
+# The thread pool that reads chunk files, and the process that created it
+_readers = None
+_readers_pid = None
+
+
+def is_zarr_store(path):
+    """
+    :param str path: The path to check
+    :returns: True if `path` is a Zarr directory store
+    """
+    return path.endswith(ZARR_SUFFIX) and os.path.isdir(path)
+
+
+def store_size(path):
+    """
+    :param str path: The path of a directory store
+    :returns: The total size in bytes of the files in the store
+    """
+    total = 0
+    for directory, _subdirs, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(directory, filename))
+    return total
+
+
+class ZarrStore(object):
+    """
+    The arrays and attributes in a Zarr directory store, from its
+    consolidated metadata.
+    """
+    def __init__(self, path):
+        """
+        :param str path: The path of the store
+        :raises ValueError: If the store has no consolidated metadata
+        """
+        self.path = path
+        metadata_path = os.path.join(path, CONSOLIDATED_METADATA)
+        if not os.path.exists(metadata_path):
+            raise ValueError('No consolidated metadata in Zarr store: '
+                             '{}'.format(path))
+        with open(metadata_path, 'rb') as handle:
+            metadata = json.loads(handle.read().decode('utf-8'))['metadata']
+
+        self.attributes = metadata.get('.zattrs', {})
+        self.arrays = {}
+        for key, value in metadata.items():
+            name, _sep, item = key.rpartition('/')
+            if item == '.zarray':
+                self.arrays[name] = ZarrArray(
+                    os.path.join(path, name), value,
+                    metadata.get(name + '/.zattrs', {})
+                )
+
+    def read_arrays(self, names):
+        """
+        Read the whole of each of the arrays, in parallel.
+
+        :param list names: The names of the arrays
+        :returns: The values of the arrays keyed by their names
+        :rtype: dict
+        """
+        return dict(zip(names, _chunk_readers().map(
+            lambda name: self.arrays[name][...], names)))
+
+    def fingerprint_arrays(self, names):
+        """
+        Calculate a fingerprint of arrays from their metadata, the sizes of
+        their chunk files and samples of their first and last chunk files,
+        without reading the whole of the arrays.
+
+        :param list names: The names of the arrays
+        :returns: The fingerprint
+        :rtype: str
+        """
+        sha = hashlib.sha256()
+        for name in names:
+            array = self.arrays[name]
+            paths = array.chunk_files()
+            sizes = [os.path.getsize(path) for path in paths]
+            sha.update(json.dumps(
+                [name, array.shape, array.chunks, array.dtype.str,
+                 array.compressor, array.filters, array.attributes,
+                 [os.path.relpath(path, array.path) for path in paths],
+                 sizes], sort_keys=True).encode('utf-8'))
+            chunk_files = list(zip(paths, sizes))
+            for path, size in sorted(set(chunk_files[:1] +
+                                         chunk_files[-1:])):
+                with open(path, 'rb') as handle:
+                    for start, stop in sample_ranges(size):
+                        handle.seek(start)
+                        sha.update(handle.read(stop - start))
+        return sha.hexdigest()
+
+
+class ZarrArray(object):
+    """
+    A single array in a Zarr store whose chunks are read on demand. It can be
+    indexed with integers and slices like a numpy array and wrapped in a dask
+    array.
+    """
+    def __init__(self, path, zarray, attributes):
+        """
+        :param str path: The path of the array's directory in the store
+        :param dict zarray: The array's .zarray metadata
+        :param dict attributes: The array's .zattrs attributes
+        """
+        self.path = path
+        self.shape = tuple(zarray['shape'])
+        self.chunks = tuple(zarray['chunks'])
+        self.dtype = np.dtype(zarray['dtype'])
+        self.order = zarray.get('order', 'C')
+        self.compressor = zarray.get('compressor')
+        self.filters = zarray.get('filters') or []
+        self.separator = zarray.get('dimension_separator', '.')
+        self.fill_value = _decode_fill_value(zarray.get('fill_value'),
+                                             self.dtype)
+        self.attributes = attributes
+        self.dimensions = attributes.get(DIMENSIONS_ATTRIBUTE, [])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __getitem__(self, key):
+        key = _expand_key(key, self.shape)
+
+        # read the smallest region containing the selection and then take
+        # the selection from it
+        lows = []
+        highs = []
+        selections = []
+        for item, length in zip(key, self.shape):
+            if isinstance(item, slice):
+                indices = np.arange(*item.indices(length))
+            else:
+                index = item + length if item < 0 else item
+                if not 0 <= index < length:
+                    raise IndexError('index {} is out of bounds for array '
+                                     'of shape {}'.format(item, self.shape))
+                indices = np.array([index])
+            low = int(indices.min()) if indices.size else 0
+            lows.append(low)
+            highs.append(int(indices.max()) + 1 if indices.size else 0)
+            selections.append(indices - low)
+
+        region = self._read_region(lows, highs)
+        for axis, indices in enumerate(selections):
+            if (indices.size != region.shape[axis] or
+                    np.any(indices != np.arange(indices.size))):
+                region = np.take(region, indices, axis=axis)
+        integer_axes = tuple(axis for axis, item in enumerate(key)
+                             if not isinstance(item, slice))
+        return region.squeeze(axis=integer_axes) if integer_axes else region
+
+    def _read_region(self, lows, highs):
+        """
+        Read the region from `lows` up to `highs` in each dimension, reading
+        the chunks that overlap it in parallel.
+        """
+        region = np.empty([high - low for low, high in zip(lows, highs)],
+                          dtype=self.dtype)
+        if not region.size:
+            return region
+
+        chunk_indices = list(itertools.product(*[
+            range(low // chunk, (high - 1) // chunk + 1)
+            for low, high, chunk in zip(lows, highs, self.chunks)
+        ]))
+        if len(chunk_indices) == 1:
+            chunk_data = [self.read_chunk(chunk_indices[0])]
+        else:
+            chunk_data = _chunk_readers().map(self.read_chunk, chunk_indices)
+
+        for chunk_index, data in zip(chunk_indices, chunk_data):
+            source = []
+            target = []
+            for index, chunk, low, high in zip(chunk_index, self.chunks, lows,
+                                               highs):
+                start = max(index * chunk, low)
+                stop = min((index + 1) * chunk, high)
+                source.append(slice(start - index * chunk,
+                                    stop - index * chunk))
+                target.append(slice(start - low, stop - low))
+            region[tuple(target)] = data[tuple(source)]
+        return region
+
+    def chunk_files(self):
+        """
+        :returns: The paths of the array's chunk files, in order
+        :rtype: list
+        """
+        paths = []
+        for directory, subdirs, filenames in os.walk(self.path):
+            subdirs.sort()
+            paths.extend(os.path.join(directory, filename)
+                         for filename in sorted(filenames)
+                         if not filename.startswith('.'))
+        return paths
+
+    def read_chunk(self, chunk_index):
+        """
+        Read and decode a single chunk. A chunk that hasn't been written is
+        filled with the array's fill value.
+
+        :param tuple chunk_index: The index of the chunk in each dimension
+        :returns: The chunk's data with the full shape of a chunk
+        :rtype: numpy.ndarray
+        """
+        key = self.separator.join(str(index) for index in chunk_index) or '0'
+        try:
+            with open(os.path.join(self.path, key), 'rb') as handle:
+                encoded = handle.read()
+        except (IOError, OSError):
+            if os.path.exists(os.path.join(self.path, key)):
+                raise
+            return np.full(self.chunks, self.fill_value, dtype=self.dtype)
+
+        decoded = _decode(encoded, self.compressor)
+        for codec in reversed(self.filters):
+            decoded = _decode(decoded, codec)
+        return np.frombuffer(decoded, dtype=self.dtype).reshape(
+            self.chunks, order=self.order)
+
+
+def load_zarr(path):
+    """
+    Load the data variables in a Zarr store as cubes with lazy data. The
+    coordinate variables are read in parallel.
+
+    :param str path: The path of the store
+    :returns: A cube for each data variable in the store
+    :rtype: iris.cube.CubeList
+    """
+    return make_cubes(ZarrStore(path), dataset_of(path))
+
+
+def make_cubes(store, dataset=None):
+    """
+    Make cubes with lazy data from the data variables in a store. Any object
+    with `attributes` and `arrays` like a ZarrStore, and `read_arrays()` and
+    `fingerprint_arrays()` methods, can be used.
+
+    If `dataset` is given then the coordinates that don't span the time
+    dimension are reused from the dataset's template in
+    primavera_val.templates.TEMPLATE_CACHE when the fingerprint of their
+    variables matches, rather than being read, and otherwise are kept as the
+    template.
+
+    :param store: The store
+    :param str dataset: The name of the dataset that the store is in
+    :returns: A cube for each data variable in the store
+    :rtype: iris.cube.CubeList
+    """
+    coordinate_names = set()
+    for name, array in store.arrays.items():
+        if name in array.dimensions:
+            coordinate_names.add(name)
+            coordinate_names.update(array.attributes[attribute]
+                                    for attribute in _BOUNDS_ATTRIBUTES
+                                    if attribute in array.attributes)
+        coordinate_names.update(
+            array.attributes.get('coordinates', '').split())
+    coordinate_names &= set(store.arrays)
+    data_names = sorted(set(store.arrays) - coordinate_names)
+
+    key = None
+    template = None
+    coords = {}
+    template_names = []
+    if dataset is not None:
+        template_names = sorted(
+            name for name in coordinate_names
+            if TIME_DIMENSION not in store.arrays[name].dimensions)
+        # the template is only valid for stores whose data variables use
+        # the coordinates in the same way
+        key = (dataset, tuple(
+            (name, tuple(store.arrays[name].dimensions),
+             store.arrays[name].attributes.get('coordinates', ''))
+            for name in data_names), store.fingerprint_arrays(template_names))
+        template = TEMPLATE_CACHE.lookup(key)
+        coords = dict(template or {})
+
+    if template:
+        values = store.read_arrays(sorted(coordinate_names -
+                                          set(template_names)))
+    else:
+        values = store.read_arrays(sorted(coordinate_names))
+
+    cubes = iris.cube.CubeList(
+        _make_cube(store, name, coordinate_names, values, coords)
+        for name in data_names
+    )
+    if key is not None and not template:
+        TEMPLATE_CACHE.add(key, {coord_key: coord for coord_key, coord in
+                                 coords.items()
+                                 if coord_key[0] in template_names})
+    return cubes
+
+
+def _make_cube(store, name, coordinate_names, values, coords):
+    """
+    Make a cube with lazy data from a data variable.
+
+    :param store: The store
+    :param str name: The name of the data variable
+    :param set coordinate_names: The names of the coordinate variables
+    :param dict values: The values of the coordinate variables that have
+        been read
+    :param dict coords: The coordinates that have already been made, keyed
+        by the name of their variable and whether they are auxiliary
+        coordinates, which the cube's new coordinates are added to
+    :returns: The cube
+    :rtype: iris.cube.Cube
+    """
+    array = store.arrays[name]
+    data = dask.array.from_array(array, chunks=array.chunks)
+    for attribute in ('_FillValue', 'missing_value'):
+        if attribute in array.attributes:
+            data = dask.array.ma.masked_equal(data,
+                                              array.attributes[attribute])
+    data = _unpack(data, array.attributes)
+
+    attributes = {key: value for key, value in store.attributes.items()
+                  if key not in _CF_ATTRIBUTES}
+    attributes.update(_other_attributes(array))
+    cube = iris.cube.Cube(data, var_name=name,
+                          units=_units(array.attributes),
+                          attributes=attributes,
+                          cell_methods=_cell_methods(array.attributes),
+                          **_names(array.attributes))
+
+    for dimension, dimension_name in enumerate(array.dimensions):
+        if dimension_name in coordinate_names:
+            coord = _coord(store, dimension_name, values, coords)
+            if isinstance(coord, iris.coords.DimCoord):
+                cube.add_dim_coord(coord, dimension)
+            else:
+                cube.add_aux_coord(coord, dimension)
+
+    for coord_name in array.attributes.get('coordinates', '').split():
+        if coord_name in coordinate_names:
+            coord_array = store.arrays[coord_name]
+            cube.add_aux_coord(
+                _coord(store, coord_name, values, coords, aux=True),
+                [array.dimensions.index(dimension)
+                 for dimension in coord_array.dimensions]
+            )
+
+    return cube
+
+
+def _coord(store, name, values, coords, aux=False):
+    """
+    A copy of a coordinate, which is made from its variable if it hasn't
+    been made already.
+    """
+    if (name, aux) not in coords:
+        coords[(name, aux)] = _make_coord(store, name, values, aux)
+    return coords[(name, aux)].copy()
+
+
+def _make_coord(store, name, values, aux=False):
+    """
+    Make a coordinate from a coordinate variable, as a DimCoord if possible.
+    """
+    array = store.arrays[name]
+    bounds_name = (array.attributes.get('bounds') or
+                   array.attributes.get('climatology'))
+    bounds = values.get(bounds_name)
+    if bounds is not None:
+        bounds = _unpack(bounds, store.arrays[bounds_name].attributes)
+    points = _unpack(values[name], array.attributes)
+    kwargs = dict(_names(array.attributes), var_name=name,
+                  units=_units(array.attributes), bounds=bounds,
+                  attributes=_other_attributes(array))
+    coord = None
+    if not aux:
+        try:
+            coord = iris.coords.DimCoord(points, **kwargs)
+        except ValueError:
+            # not monotonic so can't be a dimension coordinate
+            pass
+    if coord is None:
+        coord = iris.coords.AuxCoord(points, **kwargs)
+    if 'climatology' in array.attributes and coord.has_bounds():
+        coord.climatological = True
+    return coord
+
+
+def _unpack(values, attributes):
+    """
+    Unpack the values of a variable that are packed with the CF scale_factor
+    and add_offset attributes, as they are by Iris when loading netCDF files.
+    The attributes are used as scalars, as netCDF-4 files store them as
+    arrays of one value.
+    """
+    if 'scale_factor' in attributes:
+        values = values * np.squeeze(attributes['scale_factor'])
+    if 'add_offset' in attributes:
+        values = values + np.squeeze(attributes['add_offset'])
+    return values
+
+
+def _names(attributes):
+    """
+    The standard name and long name of a variable from its attributes.
+    Invalid standard names are dropped, as they are by Iris when loading
+    netCDF files.
+    """
+    standard_name = attributes.get('standard_name')
+    if standard_name not in iris.std_names.STD_NAMES:
+        standard_name = None
+    return {'standard_name': standard_name,
+            'long_name': attributes.get('long_name')}
+
+
+def _units(attributes):
+    """
+    The units of a variable from its attributes, including the calendar of
+    time coordinates.
+    """
+    units = attributes.get('units', '1')
+    if 'calendar' in attributes:
+        return cf_units.Unit(units, calendar=attributes['calendar'])
+    return cf_units.Unit(units)
+
+
+def _cell_methods(attributes):
+    """
+    The cell methods of a data variable from its cell_methods attribute,
+    parsed in the same way as by Iris when loading netCDF files.
+    """
+    if not attributes.get('cell_methods'):
+        return None
+    return iris.fileformats.netcdf.parse_cell_methods(
+        attributes['cell_methods'])
+
+
+def _other_attributes(array):
+    """
+    The attributes of a variable that aren't used to build the cube or
+    coordinates.
+    """
+    return {key: value for key, value in array.attributes.items()
+            if key not in _CF_ATTRIBUTES}
+
+
+def _decode(encoded, codec):
+    """
+    Decode a chunk with a compressor or filter.
+
+    :param bytes encoded: The encoded chunk
+    :param dict codec: The configuration of the codec, or None
+    :returns: The decoded chunk
+    :raises ValueError: If the codec isn't supported
+    """
+    if codec is None:
+        return encoded
+    if codec['id'] in _DECOMPRESSORS:
+        return _DECOMPRESSORS[codec['id']](encoded)
+    if numcodecs is None:
+        raise ValueError('numcodecs is required to read chunks encoded with '
+                         '{}'.format(codec['id']))
+    return numcodecs.get_codec(codec).decode(encoded)
+
+
+def _decode_fill_value(fill_value, dtype):
+    """
+    Convert the fill value in a .zarray, which may be a string for
+    non-finite floats, to a value of the array's type.
+    """
+    if fill_value is None:
+        return np.nan if dtype.kind in 'fc' else 0
+    special = {'NaN': np.nan, 'Infinity': np.inf, '-Infinity': -np.inf}
+    return special.get(fill_value, fill_value)
+
+
+def _expand_key(key, shape):
+    """
+    Expand an index to one integer or slice for each dimension.
+    """
+    if not isinstance(key, tuple):
+        key = (key, )
+    if Ellipsis in key:
+        position = key.index(Ellipsis)
+        fill = (slice(None), ) * (len(shape) - len(key) + 1)
+        key = key[:position] + fill + key[position + 1:]
+    key = key + (slice(None), ) * (len(shape) - len(key))
+    if len(key) != len(shape):
+        raise IndexError('too many indices for array of shape {}'.format(
+            shape))
+    return tuple(item if isinstance(item, slice) else int(item)
+                 for item in key)
+
+
+def _chunk_readers():
+    """
+    The thread pool that reads chunk files in this process. A new pool is
+    created in each worker process as threads don't survive a fork.
+    """
+    global _readers, _readers_pid
+    if _readers is None or _readers_pid != os.getpid():
+        _readers = ThreadPoolExecutor(CHUNK_READ_THREADS)
+        _readers_pid = os.getpid()
+    return _readers